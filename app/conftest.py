@@ -1,20 +1,23 @@
 import pytest
+from contextlib import nullcontext
 from unittest.mock import Mock
 from fastapi.testclient import TestClient
 from .main import app
 
-from .dependencies import make_db_connection, get_db_connection, get_db_connection_factory, get_prog_repo, get_rec_repo, get_view_repo, get_dig_repo, get_series_repo
-from .repositories.sqlite.api import (
-    SQLiteProgramRepository, SQLiteRecordingRepository, SQLiteViewRepository, SQLiteDigestionRepository,
-    SQLiteSeriesRepository
+from . import dependencies
+from .dependencies import make_db_connection, get_db_connection_factory, get_prog_repo, get_rec_repo, get_view_repo, get_dig_repo, get_series_repo, get_ingest_repo, get_stats_repo
+from .repositories.sqlite.migrations import migrate
+from .repositories.sqlite.async_api import (
+    SQLiteAsyncProgramRepository, SQLiteAsyncRecordingRepository, SQLiteAsyncViewRepository, SQLiteAsyncDigestionRepository,
+    SQLiteAsyncSeriesRepository, SQLiteAsyncIngestRepository, SQLiteAsyncStatsRepository
 )
+from .repositories.sqlite.executor import SQLiteExecutor
 
 @pytest.fixture
 def con():
     con = make_db_connection(":memory:", check_same_thread=False)
 
-    with open("db/sqlite/schemas.sql") as f:
-        con.executescript(f.read())
+    migrate(con)
 
     yield con
     con.close()
@@ -27,28 +30,51 @@ def con_factory(con):
 
 
 
+class SingleConnectionPool:
+    """SQLiteConnectionPool の代わりに、テストの接続1本を読み取りにも書き込みにも貸す"""
+    size = 1
+
+    def __init__(self, con):
+        self.con = con
+
+    def reader(self):
+        return nullcontext(self.con)
+
+    writer = reader
+
+    def close(self):
+        pass
+
 @pytest.fixture
-def client(con, con_factory):
-    def override_get_db():
-        try:
-            yield con
-        finally:
-            pass
+def pool(con, monkeypatch):
+    # get_db_pool が db/ の DB を開かず、テストの接続を返すようにする
+    pool = SingleConnectionPool(con)
+    monkeypatch.setattr(dependencies, "_db_pool", pool)
+    return pool
+
+@pytest.fixture
+def executor(pool):
+    # テストの接続は1本なので、1スレッドで順に使う
+    executor = SQLiteExecutor(pool.reader, workers=pool.size)
+    yield executor
+    executor.close()
 
+@pytest.fixture
+def client(con_factory, executor):
     def override_get_db_connection_factory():
         try:
             yield con_factory
         finally:
             pass
 
-
-    app.dependency_overrides[get_db_connection] = override_get_db
     app.dependency_overrides[get_db_connection_factory] = override_get_db_connection_factory
-    app.dependency_overrides[get_prog_repo] = lambda: SQLiteProgramRepository(con)
-    app.dependency_overrides[get_rec_repo] = lambda: SQLiteRecordingRepository(con)
-    app.dependency_overrides[get_view_repo] = lambda: SQLiteViewRepository(con)
-    app.dependency_overrides[get_dig_repo] = lambda: SQLiteDigestionRepository(con)
-    app.dependency_overrides[get_series_repo] = lambda: SQLiteSeriesRepository(con)
+    app.dependency_overrides[get_prog_repo] = lambda: SQLiteAsyncProgramRepository(executor)
+    app.dependency_overrides[get_rec_repo] = lambda: SQLiteAsyncRecordingRepository(executor)
+    app.dependency_overrides[get_view_repo] = lambda: SQLiteAsyncViewRepository(executor)
+    app.dependency_overrides[get_dig_repo] = lambda: SQLiteAsyncDigestionRepository(executor)
+    app.dependency_overrides[get_series_repo] = lambda: SQLiteAsyncSeriesRepository(executor)
+    app.dependency_overrides[get_ingest_repo] = lambda: SQLiteAsyncIngestRepository(executor)
+    app.dependency_overrides[get_stats_repo] = lambda: SQLiteAsyncStatsRepository(executor)
 
     # middleware はテストではすべて読み込まない
     app.user_middleware.clear()
@@ -1,54 +1,168 @@
 from typing import Annotated, Callable
 from fastapi import Depends
-from datetime import datetime
+from datetime import datetime, timedelta
+import importlib.util
+import logging
 import os
-import re
 import sqlite3
 
 from .models.api import JST
-from .repositories.interfaces import DigestionRepository, ProgramRepository, RecordingRepository, SeriesRepository, ViewRepository
+from .repositories.interfaces import AsyncDigestionRepository, AsyncIngestRepository, AsyncProgramRepository, AsyncRecordingRepository, AsyncSeriesRepository, AsyncStatsRepository, AsyncViewRepository
+from .repositories.sqlite.analytics import DuckDBAnalytics
+from .repositories.sqlite.backup import SQLiteBackup
+
+logger = logging.getLogger(__name__)
+
+def adapt_datetime_epoch(val):
+    """Adapt datetime.datetime to Unix timestamp."""
+    return int(val.timestamp())
+
+def convert_timestamp(val):
+    """Convert Unix epoch timestamp to datetime.datetime object."""
+    return datetime.fromtimestamp(int(val)).astimezone(JST)
+
+# sqlite3 モジュール全体の設定なので読み込み時に一度だけ登録する
+sqlite3.register_adapter(datetime, adapt_datetime_epoch)
+sqlite3.register_converter("timestamp", convert_timestamp)
 
 def make_db_connection(db_path, **kwargs):
     con = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_COLNAMES, **kwargs)
     con.row_factory = sqlite3.Row
+    con.execute("PRAGMA synchronous = NORMAL")
+    con.execute("PRAGMA busy_timeout = 5000")
+    con.execute("PRAGMA cache_size = -65536")        # 64MiB
+    con.execute("PRAGMA mmap_size = 268435456")      # 256MiB
+    return con
 
-    def adapt_datetime_epoch(val):
-        """Adapt datetime.datetime to Unix timestamp."""
-        return int(val.timestamp())
+DB_PATH = "db/tv.db"
+BIGQUERY_PROJECT_ID = os.getenv("bigquery_project_id")
+BIGQUERY_DATASET_ID = os.getenv("bigquery_dataset_id")
+BIGQUERY_STREAM_VIEWS = os.getenv("BIGQUERY_STREAM_VIEWS", "1") != "0"
+BIGQUERY_CACHE_TTL = float(os.getenv("BIGQUERY_CACHE_TTL", "300"))
 
-    sqlite3.register_adapter(datetime, adapt_datetime_epoch)
+def migrate_db():
+    """起動時にスキーマと未適用のマイグレーションを適用する"""
+    from .repositories.sqlite.migrations import migrate
+    con = make_db_connection(DB_PATH)
+    try:
+        version = migrate(con)
+        logger.info("SQLite schema version: %d", version)
+    finally:
+        con.close()
 
-    def convert_timestamp(val):
-        """Convert Unix epoch timestamp to datetime.datetime object."""
-        return datetime.fromtimestamp(int(val)).astimezone(JST)
+# この日数より前に始まった番組の視聴区間と録画 (消していない録画がないもの) を起動時にアーカイブに移す。0 なら移さない
+ARCHIVE_AFTER_DAYS = int(os.getenv("SQLITE_ARCHIVE_AFTER_DAYS", "365"))
 
-    sqlite3.register_converter("timestamp", convert_timestamp)
+def archive_db():
+    """起動時に古い視聴区間と録画を放送年ごとのアーカイブ (db/archive/tv-YYYY.db) に移す"""
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return
+    from .repositories.sqlite.archive import archive_before
+    con = make_db_connection(DB_PATH)
+    try:
+        counts = archive_before(con, datetime.now(JST) - timedelta(days=ARCHIVE_AFTER_DAYS))
+        for year, count in counts.items():
+            logger.info("Archived %d programs to %s", count, year)
+    finally:
+        con.close()
 
-    def regexp(pattern, value):
-        if value is None:
-            return False
-        return re.search(pattern, value) is not None
+BACKUP_DIR = "db/backup"
+# スナップショットを取る間隔。0 なら定期的には取らない (/api/admin/backup からは取れる)
+BACKUP_INTERVAL_HOURS = float(os.getenv("SQLITE_BACKUP_INTERVAL_HOURS", "24"))
 
-    con.create_function("regexp", 2, regexp)
+_backup = None
 
-    return con
+def get_backup():
+    """SQLite のスナップショットを取るジョブ。SQLite 以外では None"""
+    global _backup
+    if os.getenv("DB") != "sqlite":
+        return None
+    if _backup is None:
+        _backup = SQLiteBackup(
+            lambda: make_db_connection(DB_PATH, check_same_thread=False), BACKUP_DIR,
+            pages=int(os.getenv("SQLITE_BACKUP_PAGES", "256")))
+    return _backup
 
-DB_PATH = "db/tv.db"
-BIGQUERY_PROJECT_ID = os.getenv("bigquery_project_id")
-BIGQUERY_DATASET_ID = os.getenv("bigquery_dataset_id")
+BackupDep = Annotated[SQLiteBackup | None, Depends(get_backup)]
 
-def get_db():
-    db_type = os.getenv("DB")
-    if db_type == "sqlite":
-        con = make_db_connection(DB_PATH)
-        try:
-            yield con
-        finally:
-            con.close()
-    else:
-        yield None
+ANALYTICS_SNAPSHOT_DIR = "db/analytics"
+# sqlite なら DB を、parquet なら db/analytics/ の最新のスナップショットを DuckDB で読む。off なら使わない
+ANALYTICS_SOURCE = os.getenv("SQLITE_ANALYTICS", "sqlite")
+
+_analytics = None
+
+def get_analytics():
+    """/api/analytics の集計を実行する DuckDB。SQLite 以外か、無効か、duckdb が入っていなければ None"""
+    global _analytics
+    if os.getenv("DB") != "sqlite" or ANALYTICS_SOURCE == "off" or importlib.util.find_spec("duckdb") is None:
+        return None
+    if _analytics is None:
+        _analytics = DuckDBAnalytics(DB_PATH, ANALYTICS_SNAPSHOT_DIR, ANALYTICS_SOURCE)
+    return _analytics
+
+AnalyticsDep = Annotated[DuckDBAnalytics | None, Depends(get_analytics)]
+
+_db_pool = None
+
+def get_db_pool():
+    """lifespan で作った接続プールを返す。lifespan を通らないときはここで作る"""
+    global _db_pool
+    if _db_pool is None:
+        from .repositories.sqlite.pool import SQLiteConnectionPool
+        _db_pool = SQLiteConnectionPool(lambda: make_db_connection(DB_PATH, check_same_thread=False))
+    return _db_pool
+
+_write_queue = None
+
+def get_write_queue():
+    """プールの書き込み用接続でまとめてコミットする書き込みキュー"""
+    global _write_queue
+    if _write_queue is None:
+        from .repositories.sqlite.write_queue import SQLiteWriteQueue
+        _write_queue = SQLiteWriteQueue(get_db_pool().writer)
+    return _write_queue
+
+_db_executor = None
+
+def get_db_executor():
+    """リポジトリの処理を読み取り用の接続ごとに1本ずつあるスレッドで実行し、await できるようにする"""
+    global _db_executor
+    if _db_executor is None:
+        from .repositories.sqlite.executor import SQLiteExecutor
+        pool = get_db_pool()
+        _db_executor = SQLiteExecutor(pool.reader, workers=pool.size)
+    return _db_executor
+
+def close_db_pool():
+    global _analytics, _backup, _db_executor, _db_pool, _view_writer, _write_queue
+    if _view_writer is not None:
+        _view_writer.close()
+        _view_writer = None
+    if _db_executor is not None:
+        _db_executor.close()
+        _db_executor = None
+    if _analytics is not None:
+        _analytics.close()
+        _analytics = None
+    if _backup is not None:
+        _backup.close()
+        _backup = None
+    if _write_queue is not None:
+        _write_queue.close()
+        _write_queue = None
+    if _db_pool is not None:
+        _db_pool.close()
+        _db_pool = None
 
-DbDep = Annotated[sqlite3.Connection | None, Depends(get_db)]
+_series_cache = None
+
+def get_series_cache():
+    """取り込みでシリーズ名から id を引くためのキャッシュ。プロセスで1つ"""
+    global _series_cache
+    if _series_cache is None:
+        from .repositories.cache import SeriesIdCache
+        _series_cache = SeriesIdCache()
+    return _series_cache
 
 _bigquery_client = None
 
@@ -62,65 +176,127 @@ def get_bigquery_client():
         )
     return _bigquery_client
 
-def get_prog_repo(db: DbDep):
+_query_cache = None
+
+def get_query_cache():
+    """BigQuery の読み取りの結果のキャッシュ。プロセスで1つ。BIGQUERY_CACHE_TTL=0 なら使わない"""
+    global _query_cache
+    if _query_cache is None and BIGQUERY_CACHE_TTL > 0:
+        from .repositories.cache import QueryResultCache
+        _query_cache = QueryResultCache(ttl=BIGQUERY_CACHE_TTL)
+    return _query_cache
+
+_view_writer = None
+
+def get_bigquery_view_writer():
+    """views にストリーミング挿入でまとめて書き込む。BIGQUERY_STREAM_VIEWS=0 なら使わず DML で1行ずつ入れる"""
+    global _view_writer
+    if _view_writer is None and BIGQUERY_STREAM_VIEWS:
+        from .repositories.bigquery.stream import BigQueryStreamWriter
+        _view_writer = BigQueryStreamWriter(
+            get_bigquery_client(), f"{BIGQUERY_PROJECT_ID}.{BIGQUERY_DATASET_ID}.views")
+    return _view_writer
+
+def get_prog_repo():
     db_type = os.getenv("DB")
     if db_type == "sqlite":
-        from .repositories.sqlite.api import SQLiteProgramRepository
-        return SQLiteProgramRepository(db)
+        from .repositories.sqlite.async_api import SQLiteAsyncProgramRepository
+        return SQLiteAsyncProgramRepository(get_db_executor(), get_write_queue())
     elif db_type == "bigquery":
         from .repositories.bigquery.api import BigQueryProgramRepository
-        return BigQueryProgramRepository(get_bigquery_client(), BIGQUERY_DATASET_ID)
+        return BigQueryProgramRepository(get_bigquery_client(), BIGQUERY_DATASET_ID, result_cache=get_query_cache())
     raise RuntimeError(f"Unsupported DB type: {db_type}")
 
-ProgramRepositoryDep = Annotated[ProgramRepository, Depends(get_prog_repo)]
+ProgramRepositoryDep = Annotated[AsyncProgramRepository, Depends(get_prog_repo)]
 
-def get_rec_repo(db: DbDep):
+def get_rec_repo():
     db_type = os.getenv("DB")
     if db_type == "sqlite":
-        from .repositories.sqlite.api import SQLiteRecordingRepository
-        return SQLiteRecordingRepository(db)
+        from .repositories.sqlite.async_api import SQLiteAsyncRecordingRepository
+        return SQLiteAsyncRecordingRepository(get_db_executor(), get_write_queue())
     elif db_type == "bigquery":
         from .repositories.bigquery.api import BigQueryRecordingRepository
-        return BigQueryRecordingRepository(get_bigquery_client(), BIGQUERY_DATASET_ID)
+        return BigQueryRecordingRepository(get_bigquery_client(), BIGQUERY_DATASET_ID, result_cache=get_query_cache())
     raise RuntimeError(f"Unsupported DB type: {db_type}")
 
-RecordingRepositoryDep = Annotated[RecordingRepository, Depends(get_rec_repo)]
+RecordingRepositoryDep = Annotated[AsyncRecordingRepository, Depends(get_rec_repo)]
 
-def get_view_repo(db: DbDep):
+def get_view_repo():
     db_type = os.getenv("DB")
     if db_type == "sqlite":
-        from .repositories.sqlite.api import SQLiteViewRepository
-        return SQLiteViewRepository(db)
+        from .repositories.sqlite.async_api import SQLiteAsyncViewRepository
+        return SQLiteAsyncViewRepository(get_db_executor(), get_write_queue())
     elif db_type == "bigquery":
         from .repositories.bigquery.api import BigQueryViewRepository
-        return BigQueryViewRepository(get_bigquery_client(), BIGQUERY_DATASET_ID)
+        return BigQueryViewRepository(get_bigquery_client(), BIGQUERY_DATASET_ID, get_bigquery_view_writer(), result_cache=get_query_cache())
     raise RuntimeError(f"Unsupported DB type: {db_type}")
 
-ViewRepositoryDep = Annotated[ViewRepository, Depends(get_view_repo)]
+ViewRepositoryDep = Annotated[AsyncViewRepository, Depends(get_view_repo)]
 
-def get_dig_repo(db: DbDep):
+def get_dig_repo():
     db_type = os.getenv("DB")
     if db_type == "sqlite":
-        from .repositories.sqlite.api import SQLiteDigestionRepository
-        return SQLiteDigestionRepository(db)
+        from .repositories.sqlite.async_api import SQLiteAsyncDigestionRepository
+        return SQLiteAsyncDigestionRepository(get_db_executor())
     elif db_type == "bigquery":
         from .repositories.bigquery.api import BigQueryDigestionRepository
-        return BigQueryDigestionRepository(get_bigquery_client(), BIGQUERY_DATASET_ID)
+        return BigQueryDigestionRepository(get_bigquery_client(), BIGQUERY_DATASET_ID, result_cache=get_query_cache())
     raise RuntimeError(f"Unsupported DB type: {db_type}")
 
-DigestionRepositoryDep = Annotated[DigestionRepository, Depends(get_dig_repo)]
+DigestionRepositoryDep = Annotated[AsyncDigestionRepository, Depends(get_dig_repo)]
 
-def get_series_repo(db: DbDep):
+def get_stats_repo():
     db_type = os.getenv("DB")
     if db_type == "sqlite":
-        from .repositories.sqlite.api import SQLiteSeriesRepository
-        return SQLiteSeriesRepository(db)
+        from .repositories.sqlite.async_api import SQLiteAsyncStatsRepository
+        return SQLiteAsyncStatsRepository(get_db_executor())
+    elif db_type == "bigquery":
+        from .repositories.bigquery.api import BigQueryStatsRepository
+        return BigQueryStatsRepository(get_bigquery_client(), BIGQUERY_DATASET_ID, result_cache=get_query_cache(), streaming=BIGQUERY_STREAM_VIEWS)
+    raise RuntimeError(f"Unsupported DB type: {db_type}")
+
+StatsRepositoryDep = Annotated[AsyncStatsRepository, Depends(get_stats_repo)]
+
+def get_series_repo():
+    db_type = os.getenv("DB")
+    if db_type == "sqlite":
+        from .repositories.sqlite.async_api import SQLiteAsyncSeriesRepository
+        return SQLiteAsyncSeriesRepository(get_db_executor(), get_write_queue(), get_series_cache())
     elif db_type == "bigquery":
         from .repositories.bigquery.api import BigQuerySeriesRepository
-        return BigQuerySeriesRepository(get_bigquery_client(), BIGQUERY_DATASET_ID)
+        return BigQuerySeriesRepository(get_bigquery_client(), BIGQUERY_DATASET_ID, get_series_cache(), result_cache=get_query_cache())
     raise RuntimeError(f"Unsupported DB type: {db_type}")
 
-SeriesRepositoryDep = Annotated[SeriesRepository, Depends(get_series_repo)]
+SeriesRepositoryDep = Annotated[AsyncSeriesRepository, Depends(get_series_repo)]
+
+def get_ingest_repo():
+    db_type = os.getenv("DB")
+    if db_type == "sqlite":
+        from .repositories.sqlite.async_api import SQLiteAsyncIngestRepository
+        return SQLiteAsyncIngestRepository(get_db_executor(), get_write_queue(), get_series_cache())
+    elif db_type == "bigquery":
+        from .repositories.bigquery.api import BigQueryIngestRepository
+        return BigQueryIngestRepository(get_bigquery_client(), BIGQUERY_DATASET_ID, get_series_cache(), result_cache=get_query_cache(), writer=get_bigquery_view_writer())
+    raise RuntimeError(f"Unsupported DB type: {db_type}")
+
+IngestRepositoryDep = Annotated[AsyncIngestRepository, Depends(get_ingest_repo)]
+
+async def warm_series_cache():
+    """起動時に、更新の新しいシリーズから名前 → id のキャッシュを埋めておく"""
+    from .models.api import SeriesQueryParams
+    cache = get_series_cache()
+    params = SeriesQueryParams(size=cache.maxsize)
+    db_type = os.getenv("DB")
+    if db_type == "sqlite":
+        from .repositories.sqlite.api import SQLiteSeriesRepository
+        series = await get_db_executor().run(lambda con: SQLiteSeriesRepository(con).search(params))
+    elif db_type == "bigquery":
+        from .repositories.bigquery.api import BigQuerySeriesRepository
+        series = await BigQuerySeriesRepository(get_bigquery_client(), BIGQUERY_DATASET_ID).search(params)
+    else:
+        return
+    # 新しいものが最近使ったものとして残るよう、古い順に入れる
+    cache.warm((s.name, s.id) for s in reversed(series))
 
 def get_db_connection_factory():
     """BackgroundTasks など別スレッドで接続する用
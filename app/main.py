@@ -1,18 +1,33 @@
+from contextlib import asynccontextmanager
 from typing import Annotated
 from fastapi import FastAPI, Request, Depends
 from fastapi.middleware.gzip import GZipMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
+from markupsafe import Markup, escape
 from starlette.templating import Jinja2Templates
 
 import os
-from .dependencies import DigestionRepositoryDep, ProgramRepositoryDep, RecordingRepositoryDep, SeriesRepositoryDep, ViewRepositoryDep
+from .dependencies import BACKUP_INTERVAL_HOURS, archive_db, close_db_pool, get_backup, get_write_queue, migrate_db, warm_series_cache, DigestionRepositoryDep, ProgramRepositoryDep, RecordingRepositoryDep, SeriesRepositoryDep, ViewRepositoryDep
 from .middlewares.github_auth import GithubAuthMiddleware
-from .routers import api
+from .models.api import SLOT_SECONDS, Digestion, ProgramGet, watched_minutes
+from .routers import analytics, api, stats
 from .routers.auth import github
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if os.getenv("DB") == "sqlite":
+        migrate_db()
+        archive_db()
+        get_write_queue()
+        if BACKUP_INTERVAL_HOURS > 0:
+            get_backup().schedule(BACKUP_INTERVAL_HOURS * 3600)
+    await warm_series_cache()
+    yield
+    close_db_pool()
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(GZipMiddleware, minimum_size=500)
 app.add_middleware(
     SessionMiddleware, 
@@ -23,13 +38,24 @@ app.add_middleware(
 )
 app.add_middleware(GithubAuthMiddleware)
 app.include_router(api.router)
+app.include_router(stats.router)
+app.include_router(analytics.router)
 app.include_router(github.router)
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 templates = Jinja2Templates(directory="app/templates")
+templates.env.filters["mark"] = lambda s: Markup(escape(s)).replace(Markup("&lt;mark&gt;"), Markup("<mark>")).replace(Markup("&lt;/mark&gt;"), Markup("</mark>"))
 templates.env.globals["config"] = {
     "TVREMOCON_API_URL": os.getenv("TVREMOCON_API_URL", "/play")
 }
 
+def next_cursor(items: list, size: int | None) -> str | None:
+    return items[-1].cursor() if size and len(items) >= size else None
+
+def watched_slot_times(p: ProgramGet | Digestion) -> list[int]:
+    """marker-plot 用に、視聴済みの分スロットの中央の時刻を返す"""
+    start_time = int(p.start_time.timestamp())
+    return [start_time + slot * SLOT_SECONDS + SLOT_SECONDS // 2 for slot in watched_minutes(p.bitmap(), p.duration)]
+
 @app.get("/", response_class=HTMLResponse)
 def show_auth_page(request: Request):
     return templates.TemplateResponse(
@@ -39,99 +65,114 @@ def show_auth_page(request: Request):
         })
 
 @app.get("/digestions", response_class=HTMLResponse)
-def digestions(request: Request,
+async def digestions(request: Request,
                params: Annotated[api.DigestionQueryParams, Depends()],
                dig_repo: DigestionRepositoryDep):
     digestions = [{
         **d.model_dump(),
         "start_time_timestamp": int(d.start_time.timestamp()),
         "end_time_timestamp": int(d.end_time.timestamp()),
-        "viewed_times_timestamp": [int(t.timestamp()) for t in d.viewed_times],
-    } for d in api.get_digestions(params, dig_repo)]
+        "watched_slots_timestamp": watched_slot_times(d),
+    } for d in await api.get_digestions(params, dig_repo)]
 
     return templates.TemplateResponse(
         request=request, name="digestions.html", context={"digestions": digestions, "params": params})
 
 @app.get("/programs", response_class=HTMLResponse)
-def programs(request: Request,
+async def programs(request: Request,
              params: Annotated[api.ProgramQueryParams, Depends()],
              prog_repo: ProgramRepositoryDep):
+    result = await api.get_programs(params, prog_repo)
+    # with_facets 指定時は items と facets の封筒で返ってくる
+    facets = result.facets if params.with_facets else None
+    if params.with_facets:
+        result = result.items
     programs = [{
         **p.model_dump(),
         "start_time_timestamp": int(p.start_time.timestamp()),
         "end_time_timestamp": int(p.end_time.timestamp()),
-        "viewed_times_timestamp": [int(t.timestamp()) for t in p.viewed_times],
-    } for p in api.get_programs(params, prog_repo)]
+        "watched_slots_timestamp": watched_slot_times(p),
+    } for p in result]
 
     return templates.TemplateResponse(
-        request=request, name="programs.html", context={"programs": programs, "params": params})
+        request=request, name="programs.html", context={
+            "programs": programs, "params": params, "facets": facets,
+            "next_cursor": next_cursor(result, params.size) if params.sort == "start_time" else None})
 
 @app.get("/programs/{id}", response_class=HTMLResponse)
-def program(request: Request,
+async def program(request: Request,
             id: int | str,
             prog_repo: ProgramRepositoryDep):
-    p = api.get_program(id, prog_repo)
+    p = await api.get_program(id, prog_repo)
     program_context = {
         **p.model_dump(),
         "start_time_timestamp": int(p.start_time.timestamp()),
         "end_time_timestamp": int(p.end_time.timestamp()),
-        "viewed_times_timestamp": [int(t.timestamp()) for t in p.viewed_times],
+        "watched_slots_timestamp": watched_slot_times(p),
     }
 
     return templates.TemplateResponse(
         request=request, name="program.html", context={"program": program_context})
 
 @app.get("/recordings", response_class=HTMLResponse)
-def recordings(request: Request,
+async def recordings(request: Request,
                params: Annotated[api.RecordingQueryParams, Depends()],
                rec_repo: RecordingRepositoryDep):
+    result = await api.get_recordings(params, rec_repo)
+    facets = result.facets if params.with_facets else None
+    if params.with_facets:
+        result = result.items
     recordings = [{
         **r.model_dump(),
         "program": {
             **r.program.model_dump(),
             "start_time_ms": int(r.program.start_time.timestamp() * 1000),
             "end_time_ms": int(r.program.end_time.timestamp() * 1000),
-            "viewed_times_ms": [int(t.timestamp() * 1000) for t in r.program.viewed_times],
+            "watched_slots_ms": [t * 1000 for t in watched_slot_times(r.program)],
         }
-    } for r in api.get_recordings(params, rec_repo)]
+    } for r in result]
 
     return templates.TemplateResponse(
-        request=request, name="recordings.html", context={"recordings": recordings, "params": params})
+        request=request, name="recordings.html", context={
+            "recordings": recordings, "params": params, "facets": facets, "next_cursor": next_cursor(result, params.size)})
 
 @app.get("/recordings/{id}", response_class=HTMLResponse)
-def recording(request: Request,
+async def recording(request: Request,
               id: int | str,
               rec_repo: RecordingRepositoryDep):
-    recording = api.get_recording(id, rec_repo)
+    recording = await api.get_recording(id, rec_repo)
 
     return templates.TemplateResponse(
         request=request, name="recording.html", context={"recording": recording})
 
 @app.get("/views", response_class=HTMLResponse)
-def views(request: Request,
+async def views(request: Request,
           params: Annotated[api.ViewQueryParams, Depends()],
           view_repo: ViewRepositoryDep):
-    views = api.get_views(params, view_repo)
+    views = await api.get_views(params, view_repo)
 
     return templates.TemplateResponse(
-        request=request, name="views.html", context={"views": views, "params": params})
+        request=request, name="views.html", context={
+            "views": views, "params": params, "next_cursor": next_cursor(views, params.size)})
 
 @app.get("/series", response_class=HTMLResponse)
-def series(request: Request,
+async def series(request: Request,
           params: Annotated[api.SeriesQueryParams, Depends()],
           series_repo: SeriesRepositoryDep):
-    series = api.get_series(params, series_repo)
+    series = await api.get_series(params, series_repo)
 
     return templates.TemplateResponse(
-        request=request, name="series.html", context={"series": series, "params": params})
+        request=request, name="series.html", context={
+            "series": series, "params": params,
+            "next_cursor": next_cursor(series, params.size) if params.sort == "modified_at" else None})
 
 @app.get("/series/{id}", response_class=HTMLResponse)
-def series_by_id(request: Request,
+async def series_by_id(request: Request,
           id: int | str,
           series_repo: SeriesRepositoryDep,
           page: int = 1,
           size: int = 100):
-    series_with_programs = api.get_series_by_id(id, series_repo, page=page, size=size)
+    series_with_programs = await api.get_series_by_id(id, series_repo, page=page, size=size)
 
     return templates.TemplateResponse(
         request=request, name="series_by_id.html", context={"series_with_programs": series_with_programs})
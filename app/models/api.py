@@ -1,8 +1,9 @@
 from typing import Annotated, Literal
 from fastapi import Query
-from pydantic import AfterValidator, BaseModel, Field, computed_field
+from pydantic import AfterValidator, BaseModel, Field, PrivateAttr, computed_field
 from zoneinfo import ZoneInfo
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timedelta, timezone
+import base64
 import json
 
 JST = ZoneInfo("Asia/Tokyo")
@@ -14,13 +15,46 @@ def localize_to_jst(dt: datetime) -> datetime:
 
 JSTDatetime = Annotated[datetime, AfterValidator(localize_to_jst)]
 
+def encode_cursor(*values) -> str:
+    """キーセットページング用の不透明なカーソル。datetime は ISO 8601 文字列にする"""
+    payload = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip("=")
+
+def _load_cursor(cursor: str) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor")
+    return values
+
+def decode_cursor(cursor: str, *types: type | None) -> tuple:
+    """encode_cursor の逆。types で datetime を指定した位置は datetime に戻す"""
+    values = _load_cursor(cursor)
+    if len(values) != len(types):
+        raise ValueError("Invalid cursor")
+    return tuple(
+        localize_to_jst(datetime.fromisoformat(v)) if t is datetime else v
+        for v, t in zip(values, types)
+    )
+
+def validate_cursor(cursor: str) -> str:
+    _load_cursor(cursor)
+    return cursor
+
+Cursor = Annotated[str, AfterValidator(validate_cursor)]
+
 class ProgramQueryParams(BaseModel):
     model_config = {"slots": True}
     page: int = Query(default=1)
     size: int = Query(default=100)
+    cursor: Cursor | None = Query(default=None, title="指定時は page を無視して X-Next-Cursor の続きから取得します")
     from_: JSTDatetime | None | Literal[""] = Query(default=None)
     to: JSTDatetime | None | Literal[""] = Query(default=None)
-    name: str = Query(default="")
+    name: str = Query(default="", title="3文字以上なら name, text, ext_text を全文検索します")
+    sort: Literal["start_time", "rank"] = Query(default="start_time", title="rank は全文検索時の関連度順で、cursor は使えません")
+    with_facets: bool = Query(default=False, title="指定時は items と、絞り込んだ全件の件数 facets を返します")
 
 class ProgramBase(BaseModel):
     model_config = {"slots": True}
@@ -48,34 +82,54 @@ class ProgramGetBase(ProgramBase):
         return self.start_time + timedelta(seconds=self.duration)
 
 class ProgramGet(ProgramGetBase):
-    viewed_times_json: str | None = Field(default=None, exclude=True)
-    recordings_json: str | None = Field(default=None, exclude=True)
+    viewed_times: list[JSTDatetime] = Field(default_factory=list)
+    recordings: list[int | str] = Field(default_factory=list)
+    watched_bitmap: bytes | None = Field(default=None, exclude=True)
+
+    def bitmap(self) -> bytes:
+        """視聴済みの分スロット。集計されたものがなければ viewed_times から作る (再生速度は1倍とみなす)"""
+        if self.watched_bitmap is not None:
+            return self.watched_bitmap
+        start_time = int(self.start_time.timestamp())
+        return build_watched_bitmap(start_time, self.duration, ((int(t.timestamp()), None) for t in self.viewed_times))
 
     @computed_field
     @property
-    def viewed_times(self) -> list[datetime]:
-        times = json.loads(self.viewed_times_json or '[]') or []
-        result = []
-        for t in times:
-            if isinstance(t, int):
-                dt = datetime.fromtimestamp(t).astimezone(JST)
-            elif isinstance(t, str):
-                dt = datetime.fromisoformat(t).astimezone(JST)
-            else:
-                continue
-            result.append(dt)
-        return result
+    def coverage(self) -> float:
+        return watched_coverage(self.bitmap(), self.duration)
 
     @computed_field
     @property
-    def recordings(self) -> list[int | str]:
-        return json.loads(self.recordings_json or '[]') or []
+    def first_unwatched_minute(self) -> int | None:
+        return first_unwatched_minute(self.bitmap(), self.duration)
+
+    def cursor(self) -> str:
+        """start_time DESC, id DESC の並びでこの行の次から取得するカーソル"""
+        return encode_cursor(self.start_time, self.id)
+
+class ProgramSearchResult(ProgramGet):
+    snippet: str | None = Field(default=None, title="全文検索時、一致箇所を <mark> で囲んだ抜粋")
+    rank: float | None = Field(default=None, title="全文検索時の関連度 (小さいほど関連が高い)")
+
+class ProgramFacets(BaseModel):
+    """ページングやカーソルに関係なく、条件に合う番組全体の件数"""
+    model_config = {"slots": True}
+    total: int = 0
+    viewed: int = Field(default=0, title="視聴した番組数")
+    recorded: int = Field(default=0, title="消していない録画がある番組数")
+
+class ProgramSearchPage(BaseModel):
+    model_config = {"slots": True}
+    items: list[ProgramSearchResult]
+    facets: ProgramFacets
+    next_cursor: str | None = Field(default=None, title="続きがあれば、その続きから取得するカーソル (X-Next-Cursor と同じ)")
 
 class ViewQueryParams(BaseModel):
     model_config = {"slots": True}
     program_id: int | str | None = Query(default=None)
     page: int | None = Query(default=1, gt=0, title="program_id 指定時は無視されて全件取得します")
     size: int | None = Query(default=500, gt=0, title="program_id 指定時は無視されて全件取得します")
+    cursor: Cursor | None = Query(default=None, title="program_id 指定時は無視されます。指定時は page を無視して X-Next-Cursor の続きから取得します")
 
 class ViewBase(BaseModel):
     model_config = {"slots": True}
@@ -83,9 +137,65 @@ class ViewBase(BaseModel):
     created_at: datetime
     speed: float | None = 1.0
 
+def expand_view_segment(start: int, end: int, samples: int) -> list[int]:
+    """まとめた視聴区間を samples 個の視聴時刻に戻す。両端以外は等間隔で補間する"""
+    if samples <= 1:
+        return [start]
+    return [start + (end - start) * k // (samples - 1) for k in range(samples)]
+
+SLOT_SECONDS = 60
+SAMPLE_SECONDS = 5 * 60
+
+def program_slots(duration: int) -> int:
+    """番組の分スロット数"""
+    return (duration + SLOT_SECONDS - 1) // SLOT_SECONDS
+
+def mark_watched(bitmap: bytearray, start_time: int, duration: int, viewed_time: int, speed: float | None) -> None:
+    """視聴サンプル1件 (viewed_time までの5分を speed 倍で再生) が覆う分スロットのビットを立てる"""
+    end = viewed_time - start_time
+    begin = end - SAMPLE_SECONDS * (1.0 if speed is None else speed)
+    first = max(int((begin + SLOT_SECONDS // 2) // SLOT_SECONDS), 0)
+    last = min(int((end + SLOT_SECONDS // 2) // SLOT_SECONDS), program_slots(duration))
+    for slot in range(first, last):
+        bitmap[slot // 8] |= 1 << (slot % 8)
+
+def build_watched_bitmap(start_time: int, duration: int, samples) -> bytes:
+    """(viewed_time, speed) の列から、分スロットごとの視聴済みビットマップを作る"""
+    bitmap = bytearray((program_slots(duration) + 7) // 8)
+    for viewed_time, speed in samples:
+        mark_watched(bitmap, start_time, duration, viewed_time, speed)
+    return bytes(bitmap)
+
+def watched_coverage(bitmap: bytes, duration: int) -> float:
+    """視聴済みの分スロットの割合"""
+    slots = program_slots(duration)
+    if slots == 0:
+        return 0.0
+    return int.from_bytes(bitmap, "little").bit_count() / slots
+
+def first_unwatched_minute(bitmap: bytes, duration: int) -> int | None:
+    """最初の未視聴の分スロット。すべて視聴済みなら None"""
+    unwatched = ~int.from_bytes(bitmap, "little") & ((1 << program_slots(duration)) - 1)
+    if unwatched == 0:
+        return None
+    return (unwatched & -unwatched).bit_length() - 1
+
+def watched_minutes(bitmap: bytes, duration: int) -> list[int]:
+    """視聴済みの分スロットの一覧"""
+    bits = int.from_bytes(bitmap, "little")
+    return [slot for slot in range(program_slots(duration)) if bits >> slot & 1]
+
 class ViewGet(ViewBase):
     model_config = {"slots": True}
     program_id: int | str
+    # リポジトリが自前のキーで並べるときに、その並びでのカーソルを持たせる
+    _cursor: str | None = PrivateAttr(default=None)
+
+    def cursor(self) -> str:
+        """created_at DESC, program_id DESC, viewed_time DESC の並びでこの行の次から取得するカーソル"""
+        if self._cursor is not None:
+            return self._cursor
+        return encode_cursor(self.created_at, self.program_id, self.viewed_time)
 
 class ViewPost(ViewBase):
     model_config = {"slots": True}
@@ -103,6 +213,8 @@ class RecordingQueryParams(BaseModel):
     file_folder: str = Query(default="")
     page: int = Query(default=1)
     size: int = Query(default=100)
+    cursor: Cursor | None = Query(default=None, title="指定時は page を無視して X-Next-Cursor の続きから取得します")
+    with_facets: bool = Query(default=False, title="指定時は items と、絞り込んだ全件の件数 facets を返します")
 
 class RecordingBase(BaseModel):
     model_config = {"slots": True}
@@ -116,12 +228,36 @@ class RecordingBase(BaseModel):
 class RecordingGet(RecordingBase):
     program: ProgramGet
     id: int | str
+    file_folder: str | None = Field(default=None, title="file_path の server の次の要素。DB の生成列から読みます")
+
+    def cursor(self) -> str:
+        """program.start_time DESC, created_at, id の並びでこの行の次から取得するカーソル"""
+        return encode_cursor(self.program.start_time, self.created_at, self.id)
+
+class RecordingFacets(BaseModel):
+    """ページングやカーソルに関係なく、条件に合う録画全体の件数とサイズ"""
+    model_config = {"slots": True}
+    total: int = 0
+    watched: int = 0
+    deleted: int = 0
+    file_size: int = Field(default=0, title="file_size の合計 (不明なものは除く)")
+    file_folders: dict[str, int] = Field(default_factory=dict, title="file_folder ごとの件数")
+
+    @computed_field
+    @property
+    def unwatched(self) -> int:
+        return self.total - self.watched
 
     @computed_field
     @property
-    def file_folder(self) -> str | None:
-        s = self.file_path.split("/")
-        return s[3] if len(s) > 3 else None
+    def kept(self) -> int:
+        return self.total - self.deleted
+
+class RecordingSearchPage(BaseModel):
+    model_config = {"slots": True}
+    items: list[RecordingGet]
+    facets: RecordingFacets
+    next_cursor: str | None = Field(default=None, title="続きがあれば、その続きから取得するカーソル (X-Next-Cursor と同じ)")
 
 class RecordingPost(RecordingBase):
     model_config = {"slots": True}
@@ -152,14 +288,24 @@ class Series(BaseModel):
     created_at: datetime
     modified_at: datetime
 
+    def cursor(self) -> str:
+        """modified_at DESC, id DESC の並びでこの行の次から取得するカーソル"""
+        return encode_cursor(self.modified_at, self.id)
+
+class SeriesSearchResult(Series):
+    snippet: str | None = Field(default=None, title="全文検索時、一致箇所を <mark> で囲んだ名前")
+    rank: float | None = Field(default=None, title="全文検索時の関連度 (小さいほど関連が高い)")
+
 class SeriesWithPrograms(Series):
     programs: list[ProgramGet]
 
 class SeriesQueryParams(BaseModel):
     model_config = {"slots": True}
-    name: str = Query(default="")
+    name: str = Query(default="", title="3文字以上なら全文検索します")
+    sort: Literal["modified_at", "rank"] = Query(default="modified_at", title="rank は全文検索時の関連度順で、cursor は使えません")
     page: int = Query(default=1)
     size: int = Query(default=100)
+    cursor: Cursor | None = Query(default=None, title="指定時は page を無視して X-Next-Cursor の続きから取得します")
 
 class SeriesPost(BaseModel):
     model_config = {"slots": True}
@@ -192,24 +338,93 @@ class Digestion(BaseModel):
     service_id: int
     start_time: datetime
     duration: int
-    viewed_times_json: str | None = Field(exclude=True)
+    viewed_times: list[JSTDatetime] = Field(default_factory=list)
+    watched_bitmap: bytes | None = Field(default=None, exclude=True)
 
     @computed_field
     @property
     def end_time(self) -> datetime:
         return self.start_time + timedelta(seconds=self.duration)
 
+    def bitmap(self) -> bytes:
+        """視聴済みの分スロット。集計されたものがなければ viewed_times から作る (再生速度は1倍とみなす)"""
+        if self.watched_bitmap is not None:
+            return self.watched_bitmap
+        start_time = int(self.start_time.timestamp())
+        return build_watched_bitmap(start_time, self.duration, ((int(t.timestamp()), None) for t in self.viewed_times))
+
+    @computed_field
+    @property
+    def coverage(self) -> float:
+        return watched_coverage(self.bitmap(), self.duration)
+
+    @computed_field
+    @property
+    def first_unwatched_minute(self) -> int | None:
+        return first_unwatched_minute(self.bitmap(), self.duration)
+
+def broadcast_day(d: date) -> int:
+    """放送日 (JST 5:00 区切り) の日付を、programs.broadcast_day と同じ 1970-01-01 からの日数にする"""
+    return (d - date(1970, 1, 1)).days
+
+class StatsQueryParams(BaseModel):
+    model_config = {"slots": True}
+    from_: date | None = Query(default=None, title="放送日 (JST 5:00 区切り) で、この日から")
+    to: date | None = Query(default=None, title="放送日 (JST 5:00 区切り) で、この日まで")
+    period: Literal["day", "month", "year"] = Query(default="month")
+    group_by: Literal["series", "genre", "service"] | None = Query(default=None)
+
+class StatsRollup(BaseModel):
+    model_config = {"slots": True}
+    samples: int = Field(title="日次集計に足した視聴サンプル数")
+
+class WatchStats(BaseModel):
+    model_config = {"slots": True}
+    period: str = Field(title="day なら YYYY-MM-DD、month なら YYYY-MM、year なら YYYY")
+    key: int | str | None = Field(default=None, title="group_by の series_id, genre, service_id。シリーズなしは 0 ('')、ジャンルなしは ''")
+    name: str | None = Field(default=None, title="group_by=series のときのシリーズ名")
+    watched_seconds: float = 0
+    programs_started: int = Field(default=0, title="初めて視聴した番組数")
+    programs_finished: int = Field(default=0, title="視聴済みの分が8割に達した番組数")
+
+    @computed_field
+    @property
+    def watched_hours(self) -> float:
+        return self.watched_seconds / 3600
+
+class AnalyticsQueryParams(BaseModel):
+    model_config = {"slots": True}
+    from_: JSTDatetime | None = Query(default=None)
+    to: JSTDatetime | None = Query(default=None)
+    limit: int = Query(default=100, gt=0)
+    min_programs: int = Query(default=1, gt=0, title="binge_sessions, series_completion で、この番組数以上のものだけ返します")
+
+class AnalyticsResult(BaseModel):
+    model_config = {"slots": True}
+    name: str
+    source: Literal["sqlite", "parquet"] = Field(title="sqlite は DB を直接、parquet は最新のスナップショットを読んだ結果")
+    rows: list[dict]
+    seconds: float = Field(title="クエリにかかった秒数")
+
+class BackupStatus(BaseModel):
+    model_config = {"slots": True}
+    state: Literal["idle", "running", "done", "failed"] = "idle"
+    path: str | None = Field(default=None, title="gzip で圧縮したスナップショット")
+    size: int | None = Field(default=None, title="圧縮後のバイト数")
+    archives: list[str] = Field(default_factory=list, title="同じ時刻に取ったアーカイブのスナップショット")
+    pages_total: int | None = None
+    pages_remaining: int | None = None
+    steps: int = Field(default=0, title="backup のステップ数")
+    restarts: int = Field(default=0, title="コピー中に他の接続の書き込みがあり、最初からやり直した回数")
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+    copy_seconds: float | None = Field(default=None, title="ページのコピーにかかった秒数")
+    compress_seconds: float | None = Field(default=None, title="圧縮にかかった秒数")
+    error: str | None = None
+
     @computed_field
     @property
-    def viewed_times(self) -> list[datetime]:
-        times = json.loads(self.viewed_times_json or '[]') or []
-        result = []
-        for t in times:
-            if isinstance(t, int):
-                dt = datetime.fromtimestamp(t).astimezone(JST)
-            elif isinstance(t, str):
-                dt = datetime.fromisoformat(t).astimezone(JST)
-            else:
-                continue
-            result.append(dt)
-        return result
+    def progress(self) -> float | None:
+        if not self.pages_total:
+            return None
+        return (self.pages_total - (self.pages_remaining or 0)) / self.pages_total
@@ -1,37 +1,185 @@
 from datetime import datetime, timedelta, timezone
+import asyncio
 import re
 import uuid
 from google.cloud import bigquery
-from ...models.api import ProgramBase, ProgramQueryParams, ProgramGetBase, ProgramGet, ViewBase, ViewQueryParams, ViewGet, RecordingBase, RecordingQueryParams, RecordingGet, Series, SeriesQueryParams, SeriesWithPrograms, Digestion, DigestionQueryParams
-from ..interfaces import ProgramRepository, ViewRepository, RecordingRepository, SeriesRepository, DigestionRepository
+from ...models.api import ProgramBase, ProgramQueryParams, ProgramGetBase, ProgramGet, ProgramSearchResult, ProgramFacets, ProgramSearchPage, ViewBase, ViewPost, ViewQueryParams, ViewGet, RecordingBase, RecordingPost, RecordingQueryParams, RecordingGet, RecordingFacets, RecordingSearchPage, Series, SeriesQueryParams, SeriesSearchResult, SeriesWithPrograms, Digestion, DigestionQueryParams, StatsQueryParams, WatchStats
+from ..interfaces import AsyncProgramRepository, AsyncViewRepository, AsyncRecordingRepository, AsyncSeriesRepository, AsyncDigestionRepository, AsyncIngestRepository, AsyncStatsRepository
+from ..cache import QueryResultCache, SeriesIdCache, cached, invalidates
+from ..predicates import Predicates
 from ..exceptions import InvalidDataError, NotFoundError, UnexpectedError
-from ..utils import extract_model_fields
+from ..utils import extract_model_fields, parse_cursor
+from .results import M, fetch_results
+from .stream import BigQueryStreamWriter
 
-class BigQueryBaseRepository:
-    def __init__(self, client: bigquery.Client, dataset_id: str):
-        self.client = client
-        self.project_id = client.project
-        self.dataset_id = dataset_id
+# ストリーミング挿入は at-least-once なので、送り直しで重複した視聴は番組と視聴時刻ごとに最初の1行だけ読む
+DEDUPED_VIEWS = """(
+    SELECT * FROM views
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY program_id, viewed_time ORDER BY created_at) = 1
+) AS views"""
 
-    def _make_query_job_config(self, query_parameters=None) -> bigquery.QueryJobConfig:
-        return bigquery.QueryJobConfig(
-            query_parameters=query_parameters or [],
-            default_dataset=f"{self.project_id}.{self.dataset_id}",
+def program_view_stats_merge_sql(program_ids: str, views_filter: str = "") -> str:
+    """program_ids (番組 id の式か SELECT) の番組の program_view_stats を views から作り直す MERGE
+       スロットは SQLite の view_segment_watched_slots と同じく、1サンプルを viewed_time までの5分を speed 倍で再生したものとみなす
+       送り直しで重複した視聴は番組と視聴時刻でまとめる。views_filter は数える views の条件 (AND でつなぐ)
+    """
+    return f"""
+    MERGE program_view_stats s
+    USING (
+        WITH v AS (
+            SELECT program_id, viewed_time, ANY_VALUE(speed) AS speed
+            FROM views
+            WHERE program_id IN ({program_ids}){f" AND {views_filter}" if views_filter else ""}
+            GROUP BY program_id, viewed_time
+        ), slots AS (
+            SELECT DISTINCT v.program_id, slot
+            FROM v
+            JOIN programs p ON p.id = v.program_id,
+            UNNEST(GENERATE_ARRAY(
+                GREATEST(CAST(FLOOR((TIMESTAMP_DIFF(v.viewed_time, p.start_time, SECOND) - 5 * 60 * COALESCE(v.speed, 1.0) + 30) / 60) AS INT64), 0),
+                LEAST(CAST(FLOOR((TIMESTAMP_DIFF(v.viewed_time, p.start_time, SECOND) + 30) / 60) AS INT64), DIV(p.duration + 59, 60)) - 1
+            )) AS slot
+        ), bytes AS (
+            SELECT p.id AS program_id, i, COALESCE(BIT_OR(1 << MOD(slots.slot, 8)), 0) AS value, COUNT(slots.slot) AS minutes
+            FROM programs p
+            CROSS JOIN UNNEST(GENERATE_ARRAY(0, DIV(DIV(p.duration + 59, 60) + 7, 8) - 1)) AS i
+            LEFT JOIN slots ON slots.program_id = p.id AND DIV(slots.slot, 8) = i
+            WHERE p.id IN (SELECT program_id FROM v)
+            GROUP BY p.id, i
         )
+        SELECT
+            times.program_id,
+            times.viewed_times,
+            COALESCE(bitmap.watched_bitmap, b'') AS watched_bitmap,
+            COALESCE(bitmap.watched_minutes, 0) AS watched_minutes
+        FROM (
+            SELECT program_id, ARRAY_AGG(viewed_time ORDER BY viewed_time) AS viewed_times
+            FROM v GROUP BY program_id
+        ) AS times
+        LEFT JOIN (
+            SELECT program_id, CODE_POINTS_TO_BYTES(ARRAY_AGG(value ORDER BY i)) AS watched_bitmap, SUM(minutes) AS watched_minutes
+            FROM bytes GROUP BY program_id
+        ) AS bitmap USING (program_id)
+    ) n
+    ON s.program_id = n.program_id
+    WHEN MATCHED THEN UPDATE SET
+        viewed_times = n.viewed_times,
+        watched_bitmap = n.watched_bitmap,
+        watched_minutes = n.watched_minutes
+    WHEN NOT MATCHED THEN
+        INSERT (program_id, viewed_times, watched_bitmap, watched_minutes)
+        VALUES (n.program_id, n.viewed_times, n.watched_bitmap, n.watched_minutes);
+"""
 
-class BigQueryProgramRepository(BigQueryBaseRepository, ProgramRepository):
-    def __init__(self, client: bigquery.Client, dataset_id: str):
-        super().__init__(client, dataset_id)
-
-    def search(self, params: ProgramQueryParams) -> list[ProgramGet]:
-        query_params = {
-            "from": params.from_ or None,
-            "to": params.to + timedelta(days=1) if params.to else None,
-            "name": params.name or '',
-            "size": params.size,
-            "offset": (params.page - 1) * params.size,
-        }
-        job = self.client.query("""
+# 番組 p の視聴済みの分が8割に達したか (消化一覧から外れる基準)。views は読まずに program_view_stats から見る
+WATCHED_ENOUGH = "COALESCE((SELECT watched_minutes FROM program_view_stats WHERE program_view_stats.program_id = p.id), 0) >= DIV(p.duration + 59, 60) * 0.8"
+
+# ジョブの完了を確かめる間隔 (秒)。短いクエリはすぐ返るように短く始め、長いクエリほど間隔を空ける
+POLL_INTERVAL = 0.05
+POLL_MAX_INTERVAL = 1.0
+
+# 番組の get_or_create をスクリプト内で行い、ingest_program_id に入れる (existing, ingest_program_id は DECLARE 済みとする)
+# 同じ番組が既にあれば、放送時刻が後のほうの内容で更新する。時間が変わるとスロットの位置も変わるので集計を作り直す
+PROGRAM_GET_OR_CREATE = f"""
+    SET existing = (
+        SELECT AS STRUCT id, start_time, duration, created_at
+        FROM programs
+        WHERE event_id = @event_id
+        AND service_id = @service_id
+        AND start_time >= TIMESTAMP_SUB(@start_time, INTERVAL 12 HOUR)
+        AND start_time <= TIMESTAMP_ADD(@start_time, INTERVAL 12 HOUR)
+        ORDER BY start_time DESC
+        LIMIT 1
+    );
+    IF existing IS NULL THEN
+        SET ingest_program_id = @new_program_id;
+        INSERT INTO programs (
+            id, event_id, service_id, name, start_time,
+            duration, text, ext_text, genre, created_at
+        )
+        VALUES (
+            ingest_program_id, @event_id, @service_id, @name, @start_time,
+            @duration, @text, @ext_text, @genre, @created_at
+        );
+    ELSE
+        SET ingest_program_id = existing.id;
+        -- Prioritize later start time
+        IF @start_time > existing.start_time THEN
+            UPDATE programs
+            SET start_time = @start_time,
+                duration = @duration,
+                name = @name,
+                text = @text,
+                ext_text = @ext_text,
+                genre = @genre
+            WHERE id = ingest_program_id;
+            {program_view_stats_merge_sql("ingest_program_id")}
+        ELSEIF @start_time = existing.start_time
+            AND existing.duration != @duration
+            AND existing.created_at < @viewed_time THEN
+            UPDATE programs
+            SET duration = @duration
+            WHERE id = ingest_program_id;
+            {program_view_stats_merge_sql("ingest_program_id")}
+        END IF;
+    END IF;
+"""
+# シリーズの get_or_create をスクリプト内で行い、ingest_series_id に入れる
+# ingest_series_id に既知の id (@series_id) が入っていれば名前では引かない
+SERIES_GET_OR_CREATE = """
+    SET ingest_series_id = @series_id;
+    IF ingest_series_id IS NULL THEN
+        SET ingest_series_id = (SELECT id FROM series WHERE name = @series_name LIMIT 1);
+    END IF;
+    IF ingest_series_id IS NULL THEN
+        SET ingest_series_id = @new_series_id;
+        INSERT INTO series (id, name, created_at, modified_at)
+        VALUES (ingest_series_id, @series_name, @created_at, @created_at);
+    END IF;
+"""
+# 番組 ingest_program_id をシリーズ ingest_series_id に入れ、入れたときだけシリーズの modified_at を @created_at に進める
+PROGRAM_SERIES_ADD = """
+    IF NOT EXISTS (
+        SELECT 1 FROM program_series WHERE series_id = ingest_series_id AND program_id = ingest_program_id
+    ) THEN
+        INSERT INTO program_series (series_id, program_id)
+        VALUES (ingest_series_id, ingest_program_id);
+        UPDATE series
+        SET modified_at = @created_at
+        WHERE id = ingest_series_id AND modified_at < @created_at;
+    END IF;
+"""
+
+async def stream_view(writer: BigQueryStreamWriter, program_id: str, view: ViewBase) -> None:
+    """視聴を views にストリーミング挿入し、送れるまで待つ
+       番組と視聴時刻で insertId を決めるので、送り直しても BigQuery がベストエフォートで重複を除く (保証は at-least-once)
+    """
+    await asyncio.wrap_future(writer.submit({
+        "program_id": program_id,
+        "viewed_time": view.viewed_time.isoformat(),
+        "speed": view.speed,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }, row_id=f"{program_id}:{view.viewed_time.isoformat()}"))
+
+def with_facets(page: str, facets: str, order_by: str) -> str:
+    """ページのクエリと、同じ条件の全件を集計する1行のクエリを1文にまとめる
+       ページが空でも集計の行は返るので、集計は先頭の行から、ページは id が NULL でない行から読む
+    """
+    return f"""
+        SELECT page.*, facets.*
+        FROM ({facets}) AS facets
+        LEFT JOIN ({page}) AS page ON TRUE
+        ORDER BY {order_by}
+    """
+
+def program_search_sql(where: str, keyset: bool, facets: bool) -> str:
+    """番組検索の文。keyset ならカーソルより後を、facets なら全件の集計も返す"""
+    # カーソルがあるときだけ条件を足して、start_time のパーティションを刈り込ませる
+    keyset_filter = """
+    AND programs.start_time <= @cursor_start_time
+    AND (programs.start_time < @cursor_start_time OR programs.id < @cursor_id)
+""" if keyset else ""
+    sql = f"""
 SELECT
     id,
     event_id,
@@ -42,31 +190,263 @@ SELECT
     text,
     ext_text,
     genre,
-    created_at,
-    (SELECT TO_JSON_STRING(ARRAY_AGG(viewed_time)) FROM views WHERE views.program_id = programs.id) AS viewed_times_json,
-    (SELECT TO_JSON_STRING(ARRAY_AGG(id)) FROM recordings WHERE recordings.program_id = programs.id) AS recordings_json
+    created_at
 FROM programs
-WHERE
-    TRUE
-    AND (@from IS NULL OR @from <= programs.start_time)
-    AND (@to IS NULL OR TIMESTAMP_ADD(programs.start_time, INTERVAL programs.duration SECOND) < @to)
-    AND (@name = '' OR programs.name LIKE CONCAT('%', @name, '%'))
-ORDER BY programs.start_time DESC
+WHERE {where} {keyset_filter}
+ORDER BY programs.start_time DESC, programs.id DESC
 LIMIT @size OFFSET @offset
-            """,
+"""
+    if not facets:
+        return sql
+    # カーソルやページに関係なく、同じ条件に合う全件を数える
+    return with_facets(sql, f"""
+SELECT
+    COUNT(*) AS facet_total,
+    COUNTIF(EXISTS (SELECT 1 FROM views WHERE views.program_id = programs.id)) AS facet_viewed,
+    COUNTIF(EXISTS (SELECT 1 FROM recordings WHERE recordings.program_id = programs.id AND recordings.deleted_at IS NULL)) AS facet_recorded
+FROM programs
+WHERE {where}
+""", "page.start_time DESC, page.id DESC")
+
+def recording_search_sql(where: str, keyset: bool, facets: bool) -> str:
+    """録画検索の文。keyset ならカーソルより後を、facets なら全件の集計も返す"""
+    keyset_filter = """
+        AND p.start_time <= @cursor_start_time
+        AND (
+            p.start_time < @cursor_start_time
+            OR r.created_at > @cursor_created_at
+            OR (r.created_at = @cursor_created_at AND r.id > @cursor_id)
+        )
+    """ if keyset else ""
+    sql = f"""
+        SELECT
+            r.id,
+            r.program_id,
+            r.file_path,
+            r.file_folder,
+            r.file_size,
+            r.watched_at,
+            r.deleted_at,
+            r.created_at,
+            p.event_id,
+            p.service_id,
+            p.name,
+            p.start_time,
+            p.duration,
+            p.text,
+            p.ext_text,
+            p.genre,
+            p.created_at AS program_created_at
+        FROM recordings r
+        JOIN programs p ON p.id = r.program_id
+        WHERE {where} {keyset_filter}
+        ORDER BY p.start_time DESC, r.created_at, r.id
+        LIMIT @size OFFSET @offset
+    """
+    if not facets:
+        return sql
+    # カーソルやページに関係なく、同じ条件に合う全件を数える
+    # ROLLUP の合計行 (grouped = 1) が全体、それ以外が file_folder ごと
+    return with_facets(sql, f"""
+        SELECT
+            MAX(IF(grouped = 1, n, NULL)) AS facet_total,
+            MAX(IF(grouped = 1, watched, NULL)) AS facet_watched,
+            MAX(IF(grouped = 1, deleted, NULL)) AS facet_deleted,
+            MAX(IF(grouped = 1, file_size, NULL)) AS facet_file_size,
+            ARRAY_AGG(IF(grouped = 0, STRUCT(file_folder, n), NULL) IGNORE NULLS) AS facet_file_folders
+        FROM (
+            SELECT
+                r.file_folder,
+                GROUPING(r.file_folder) AS grouped,
+                COUNT(*) AS n,
+                COUNTIF(r.watched_at IS NOT NULL) AS watched,
+                COUNTIF(r.deleted_at IS NOT NULL) AS deleted,
+                SUM(r.file_size) AS file_size
+            FROM recordings r
+            JOIN programs p ON p.id = r.program_id
+            WHERE {where}
+            GROUP BY ROLLUP(r.file_folder)
+        )
+    """, "page.start_time DESC, page.created_at, page.id")
+
+def series_search_sql(where: str) -> str:
+    return f"""
+        SELECT
+            id,
+            name,
+            created_at,
+            modified_at
+        FROM series
+        WHERE {where}
+        ORDER BY modified_at DESC, id DESC
+        LIMIT @size OFFSET @offset
+    """
+
+def digestion_list_sql(where: str) -> str:
+    return f"""
+        SELECT
+            p.id,
+            p.name,
+            p.service_id,
+            p.start_time,
+            p.duration,
+            COALESCE(pvs.viewed_times, ARRAY<TIMESTAMP>[]) AS viewed_times,
+            pvs.watched_bitmap
+        FROM programs p
+        LEFT JOIN program_view_stats pvs ON pvs.program_id = p.id
+        WHERE {where}
+        ORDER BY p.start_time, p.id
+        LIMIT @size OFFSET @offset
+    """
+
+def watch_stats_sql(where: str, key: str) -> str:
+    """key は group_by ごとの daily_watch_stats の列"""
+    return f"""
+        SELECT
+            stats.*,
+            series.name
+        FROM (
+            SELECT
+                FORMAT_DATE(@format, day) AS period,
+                {key} AS key,
+                SUM(watched_seconds) AS watched_seconds,
+                SUM(programs_started) AS programs_started,
+                SUM(programs_finished) AS programs_finished
+            FROM daily_watch_stats
+            WHERE {where}
+            GROUP BY 1, 2
+        ) AS stats
+        LEFT JOIN series ON @group_by = 'series' AND series.id = stats.key
+        ORDER BY stats.period, stats.watched_seconds DESC, stats.key
+    """
+
+class BigQueryBaseRepository:
+    def __init__(self, client: bigquery.Client, dataset_id: str, result_cache: QueryResultCache | None = None):
+        self.client = client
+        self.project_id = client.project
+        self.dataset_id = dataset_id
+        # ジョブを投げずに済むよう、読み取りの結果を覚えておく (@cached / @invalidates)
+        self.result_cache = result_cache
+
+    def _make_query_job_config(self, query_parameters=None) -> bigquery.QueryJobConfig:
+        return bigquery.QueryJobConfig(
+            query_parameters=query_parameters or [],
+            default_dataset=f"{self.project_id}.{self.dataset_id}",
+        )
+
+    def _program_params(self, program: ProgramBase, created_at: datetime, viewed_time: datetime) -> list:
+        return [
+            bigquery.ScalarQueryParameter("new_program_id", "STRING", str(uuid.uuid4())),
+            bigquery.ScalarQueryParameter("event_id", "INT64", program.event_id),
+            bigquery.ScalarQueryParameter("service_id", "INT64", program.service_id),
+            bigquery.ScalarQueryParameter("name", "STRING", program.name),
+            bigquery.ScalarQueryParameter("start_time", "TIMESTAMP", program.start_time),
+            bigquery.ScalarQueryParameter("duration", "INT64", program.duration),
+            bigquery.ScalarQueryParameter("text", "STRING", program.text),
+            bigquery.ScalarQueryParameter("ext_text", "STRING", program.ext_text),
+            bigquery.ScalarQueryParameter("genre", "STRING", program.genre),
+            bigquery.ScalarQueryParameter("created_at", "TIMESTAMP", created_at),
+            bigquery.ScalarQueryParameter("viewed_time", "TIMESTAMP", viewed_time),
+        ]
+
+    async def _query(self, query: str, job_config: bigquery.QueryJobConfig, model: type[M] | None = None) -> list[bigquery.Row] | list[M]:
+        """ジョブを投げ、完了をイベントループを止めずに待って全行を返す
+           スレッドを使うのは HTTP を呼ぶ間だけで、待っている間は asyncio.sleep で手放す
+           model を渡すと、大きい結果は Arrow の列から直接そのモデルにする (fetch_results)
+        """
+        job = await asyncio.to_thread(self.client.query, query, job_config=job_config)
+        interval = POLL_INTERVAL
+        while not await asyncio.to_thread(job.done):
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, POLL_MAX_INTERVAL)
+        return await asyncio.to_thread(fetch_results, job, model)
+
+    async def _query_one(self, query: str, job_config: bigquery.QueryJobConfig) -> bigquery.Row | None:
+        rows = await self._query(query, job_config)
+        return rows[0] if rows else None
+
+    async def _load_children(self, program_ids: list[str], deleted: bool = True) -> dict[str, dict]:
+        """ページ内の番組の viewed_times と recordings を1回のクエリでまとめて引く
+           deleted が False なら削除済みの録画は含めない
+        """
+        ids = list(dict.fromkeys(program_ids))
+        if not ids:
+            return {}
+        rows = await self._query("""
+            WITH v AS (
+                SELECT program_id, ARRAY_AGG(DISTINCT viewed_time ORDER BY viewed_time) AS viewed_times
+                FROM views WHERE program_id IN UNNEST(@ids)
+                GROUP BY program_id
+            ), r AS (
+                SELECT program_id, ARRAY_AGG(id ORDER BY id) AS recordings
+                FROM recordings WHERE program_id IN UNNEST(@ids) AND (@deleted = TRUE OR deleted_at IS NULL)
+                GROUP BY program_id
+            )
+            SELECT id, v.viewed_times, r.recordings
+            FROM UNNEST(@ids) AS id
+            LEFT JOIN v ON v.program_id = id
+            LEFT JOIN r ON r.program_id = id
+            """, job_config=self._make_query_job_config(query_parameters=[
+                bigquery.ArrayQueryParameter("ids", "STRING", ids),
+                bigquery.ScalarQueryParameter("deleted", "BOOL", deleted),
+        ]))
+        return {
+            row["id"]: {"viewed_times": row["viewed_times"] or [], "recordings": row["recordings"] or []}
+            for row in rows
+        }
+
+class BigQueryProgramRepository(BigQueryBaseRepository, AsyncProgramRepository):
+    def __init__(self, client: bigquery.Client, dataset_id: str, result_cache: QueryResultCache | None = None):
+        super().__init__(client, dataset_id, result_cache)
+
+    @cached("programs", "views", "recordings")
+    async def search(self, params: ProgramQueryParams) -> list[ProgramSearchResult]:
+        return (await self._search(params, facets=False))[0]
+
+    @cached("programs", "views", "recordings")
+    async def search_with_facets(self, params: ProgramQueryParams) -> ProgramSearchPage:
+        items, facets = await self._search(params, facets=True)
+        return ProgramSearchPage(items=items, facets=facets)
+
+    async def _search(self, params: ProgramQueryParams, facets: bool) -> tuple[list[ProgramSearchResult], ProgramFacets | None]:
+        # 全文検索は SQLite のみ。name は従来どおり番組名の部分一致で、sort=rank も start_time 順になる
+        cursor = parse_cursor(params.cursor, datetime, None)
+        to = params.to + timedelta(days=1) if params.to else None
+        where = (Predicates()
+            .add_if(params.from_, "@from <= programs.start_time", {
+                "from": bigquery.ScalarQueryParameter("from", "TIMESTAMP", params.from_)})
+            # 終了時刻の条件だけでは start_time のパーティションを刈り込めないので、それより緩い開始時刻の条件も付ける
+            .add_if(to, "programs.start_time < @to AND TIMESTAMP_ADD(programs.start_time, INTERVAL programs.duration SECOND) < @to", {
+                "to": bigquery.ScalarQueryParameter("to", "TIMESTAMP", to)})
+            .add_if(params.name, "programs.name LIKE CONCAT('%', @name, '%')", {
+                "name": bigquery.ScalarQueryParameter("name", "STRING", params.name)}))
+        keyset_params = [
+            bigquery.ScalarQueryParameter("cursor_start_time", "TIMESTAMP", cursor[0]),
+            bigquery.ScalarQueryParameter("cursor_id", "STRING", cursor[1]),
+        ] if cursor else []
+        rows = await self._query(where.statement(program_search_sql, cursor is not None, facets),
             job_config=self._make_query_job_config(query_parameters=[
-                bigquery.ScalarQueryParameter("from", "TIMESTAMP", query_params["from"]),
-                bigquery.ScalarQueryParameter("to", "TIMESTAMP", query_params["to"]),
-                bigquery.ScalarQueryParameter("name", "STRING", query_params["name"]),
-                bigquery.ScalarQueryParameter("size", "INT64", query_params["size"]),
-                bigquery.ScalarQueryParameter("offset", "INT64", query_params["offset"]),
+                *where.params.values(),
+                bigquery.ScalarQueryParameter("size", "INT64", params.size),
+                bigquery.ScalarQueryParameter("offset", "INT64", 0 if cursor else (params.page - 1) * params.size),
+                *keyset_params,
         ]))
-        rows = job.result()
+        facets_row = rows[0] if facets else None
+        rows = [row for row in rows if row["id"] is not None]
+        children = await self._load_children([row["id"] for row in rows])
 
-        return [ProgramGet(**row) for row in rows]
+        items = [ProgramSearchResult(**row, **children.get(row["id"], {})) for row in rows]
+        if facets_row is None:
+            return items, None
+        return items, ProgramFacets(
+            total=facets_row["facet_total"],
+            viewed=facets_row["facet_viewed"],
+            recorded=facets_row["facet_recorded"],
+        )
 
-    def get_by_id(self, id: str) -> ProgramGet | None:
-        job = self.client.query("""
+    @cached("programs", "views", "recordings")
+    async def get_by_id(self, id: str) -> ProgramGet | None:
+        row = await self._query_one("""
             SELECT
             p.id,
             p.event_id,
@@ -78,219 +458,181 @@ LIMIT @size OFFSET @offset
             p.ext_text,
             p.genre,
             p.created_at,
-            (SELECT TO_JSON_STRING(ARRAY_AGG(viewed_time)) FROM views WHERE views.program_id = p.id) AS viewed_times_json,
-            (SELECT TO_JSON_STRING(ARRAY_AGG(id)) FROM recordings WHERE recordings.program_id = p.id AND recordings.deleted_at IS NULL) AS recordings_json
+            ARRAY(SELECT DISTINCT viewed_time FROM views WHERE views.program_id = p.id ORDER BY viewed_time) AS viewed_times,
+            ARRAY(SELECT id FROM recordings WHERE recordings.program_id = p.id AND recordings.deleted_at IS NULL ORDER BY id) AS recordings
             FROM programs p
             WHERE p.id = @id
             """,
             job_config=self._make_query_job_config(query_parameters=[
                 bigquery.ScalarQueryParameter("id", "STRING", id)
         ]))
-        row = next(job.result(), None)
         return ProgramGet(**row) if row is not None else None
 
-    def get_or_create(self, program: ProgramBase, created_at: datetime, viewed_time: datetime) -> int:
-        job = self.client.query("""
-            SELECT id, start_time, duration, created_at
-            FROM programs
-            WHERE event_id = @event_id
-            AND service_id = @service_id
-            AND start_time >= TIMESTAMP_SUB(@start_time, INTERVAL 12 HOUR)
-            AND start_time <= TIMESTAMP_ADD(@start_time, INTERVAL 12 HOUR)
-            ORDER BY start_time DESC
-            LIMIT 1
-            """, job_config=self._make_query_job_config(query_parameters=[
-                bigquery.ScalarQueryParameter("event_id", "INT64", program.event_id),
-                bigquery.ScalarQueryParameter("service_id", "INT64", program.service_id),
-                bigquery.ScalarQueryParameter("start_time", "TIMESTAMP", program.start_time),
-        ]))
-        row = next(job.result(), None)
-
-        if row:
-            id_, start_time, duration, created_at_in_db = row
-            # Prioritize later start time
-            if program.start_time > start_time:
-                self.client.query("""
-                    UPDATE programs
-                    SET start_time = @new_start_time,
-                        duration = @new_duration,
-                        name = @new_name,
-                        text = @new_text,
-                        ext_text = @new_ext_text,
-                        genre = @new_genre
-                    WHERE id = @id
-                    """, job_config=self._make_query_job_config(query_parameters=[
-                        bigquery.ScalarQueryParameter("new_start_time", "TIMESTAMP", program.start_time),
-                        bigquery.ScalarQueryParameter("new_duration", "INT64", program.duration),
-                        bigquery.ScalarQueryParameter("new_name", "STRING", program.name),
-                        bigquery.ScalarQueryParameter("new_text", "STRING", program.text),
-                        bigquery.ScalarQueryParameter("new_ext_text", "STRING", program.ext_text),
-                        bigquery.ScalarQueryParameter("new_genre", "STRING", program.genre),
-                        bigquery.ScalarQueryParameter("id", "STRING", id_)
-                ])).result()
-            elif program.start_time == start_time:
-                if duration != program.duration and created_at_in_db < viewed_time:
-                    self.client.query("""
-                        UPDATE programs
-                        SET duration = @new_duration
-                        WHERE id = @id
-                        """, job_config=self._make_query_job_config(query_parameters=[
-                            bigquery.ScalarQueryParameter("new_duration", "INT64", program.duration),
-                            bigquery.ScalarQueryParameter("id", "STRING", id_)
-                    ])).result()
-            return id_
-
-        new_id = str(uuid.uuid4())
-
-        self.client.query("""
-            INSERT INTO programs (
-                id, event_id, service_id, name, start_time,
-                duration, text, ext_text, genre, created_at
-            )
-            VALUES (
-                @id, @event_id, @service_id, @name, @start_time,
-                @duration, @text, @ext_text, @genre, @created_at
-            )
-            """, job_config=self._make_query_job_config(query_parameters=[
-                bigquery.ScalarQueryParameter("id", "STRING", new_id),
-                bigquery.ScalarQueryParameter("event_id", "INT64", program.event_id),
-                bigquery.ScalarQueryParameter("service_id", "INT64", program.service_id),
-                bigquery.ScalarQueryParameter("name", "STRING", program.name),
-                bigquery.ScalarQueryParameter("start_time", "TIMESTAMP", program.start_time),
-                bigquery.ScalarQueryParameter("duration", "INT64", program.duration),
-                bigquery.ScalarQueryParameter("text", "STRING", program.text),
-                bigquery.ScalarQueryParameter("ext_text", "STRING", program.ext_text),
-                bigquery.ScalarQueryParameter("genre", "STRING", program.genre),
-                bigquery.ScalarQueryParameter("created_at", "TIMESTAMP", created_at),
-        ])).result()
-
-        return new_id
+    @invalidates("programs", "program_view_stats")
+    async def get_or_create(self, program: ProgramBase, created_at: datetime, viewed_time: datetime) -> str:
+        # 引いてから更新・追加するとジョブが2つになるので、判定もスクリプトの中で行う
+        row = await self._query_one(f"""
+            DECLARE existing STRUCT<id STRING, start_time TIMESTAMP, duration INT64, created_at TIMESTAMP>;
+            DECLARE ingest_program_id STRING;
+            {PROGRAM_GET_OR_CREATE}
+            SELECT ingest_program_id AS id;
+            """, job_config=self._make_query_job_config(query_parameters=self._program_params(program, created_at, viewed_time)))
+        return row["id"]
 
-    def update(self, id: str, genre: str | None) -> None:
-        self.client.query("""
+    @invalidates("programs")
+    async def update(self, id: str, genre: str | None) -> None:
+        await self._query("""
             UPDATE programs
             SET genre = @genre
             WHERE id = @id
             """, job_config=self._make_query_job_config(query_parameters=[
                 bigquery.ScalarQueryParameter("genre", "STRING", genre),
                 bigquery.ScalarQueryParameter("id", "STRING", id),
-        ])).result()
+        ]))
 
-class BigQueryViewRepository(BigQueryBaseRepository, ViewRepository):
-    def __init__(self, client: bigquery.Client, dataset_id: str):
-        super().__init__(client, dataset_id)
+class BigQueryViewRepository(BigQueryBaseRepository, AsyncViewRepository):
+    def __init__(self, client: bigquery.Client, dataset_id: str, writer: BigQueryStreamWriter | None = None,
+                 result_cache: QueryResultCache | None = None):
+        super().__init__(client, dataset_id, result_cache)
+        self.writer = writer
 
-    def search(self, params: ViewQueryParams) -> list[ViewGet]:
+    @cached("views")
+    async def search(self, params: ViewQueryParams) -> list[ViewGet]:
         if params.program_id is not None:
-            query = """
+            query = f"""
             SELECT
                 program_id,
                 viewed_time,
                 speed,
                 created_at
-            FROM views
+            FROM {DEDUPED_VIEWS}
             WHERE program_id = @program_id
             ORDER BY created_at DESC
             """
             qparams = [bigquery.ScalarQueryParameter("program_id", "STRING", params.program_id)]
         else:
-            offset = (params.page - 1) * params.size
-            query = """
+            cursor = parse_cursor(params.cursor, datetime, None, datetime)
+            offset = 0 if cursor else (params.page - 1) * params.size
+            keyset = ""
+            qparams = [
+                bigquery.ScalarQueryParameter("size", "INT64", params.size),
+                bigquery.ScalarQueryParameter("offset", "INT64", offset),
+            ]
+            if cursor:
+                keyset = """
+            WHERE created_at <= @cursor_created_at
+            AND (
+                created_at < @cursor_created_at
+                OR program_id < @cursor_program_id
+                OR (program_id = @cursor_program_id AND viewed_time < @cursor_viewed_time)
+            )
+                """
+                qparams += [
+                    bigquery.ScalarQueryParameter("cursor_created_at", "TIMESTAMP", cursor[0]),
+                    bigquery.ScalarQueryParameter("cursor_program_id", "STRING", cursor[1]),
+                    bigquery.ScalarQueryParameter("cursor_viewed_time", "TIMESTAMP", cursor[2]),
+                ]
+            query = f"""
             SELECT
                 program_id,
                 viewed_time,
                 speed,
                 created_at
-            FROM views
-            ORDER BY created_at DESC
+            FROM {DEDUPED_VIEWS}
+            {keyset}
+            ORDER BY created_at DESC, program_id DESC, viewed_time DESC
             LIMIT @size OFFSET @offset
             """
-            qparams = [
-                bigquery.ScalarQueryParameter("size", "INT64", params.size),
-                bigquery.ScalarQueryParameter("offset", "INT64", offset),
-            ]
 
-        rows = self.client.query(query, job_config=self._make_query_job_config(query_parameters=qparams)).result()
-        return [ViewGet(**dict(row)) for row in rows]
+        return await self._query(query, job_config=self._make_query_job_config(query_parameters=qparams), model=ViewGet)
 
-    def create(self, program_id: str, view: ViewBase) -> None:
-        query = """
+    @invalidates("views", "program_view_stats")
+    async def create(self, program_id: str, view: ViewBase) -> None:
+        if self.writer is not None:
+            await stream_view(self.writer, program_id, view)
+            return
+        query = f"""
         INSERT INTO views(program_id, viewed_time, speed, created_at)
-        VALUES(@program_id, @viewed_time, @speed, @created_at)
+        VALUES(@program_id, @viewed_time, @speed, @created_at);
+        {program_view_stats_merge_sql("@program_id")}
         """
-        self.client.query(query, job_config=self._make_query_job_config(query_parameters=[
+        await self._query(query, job_config=self._make_query_job_config(query_parameters=[
             bigquery.ScalarQueryParameter("program_id", "STRING", program_id),
             bigquery.ScalarQueryParameter("viewed_time", "TIMESTAMP", view.viewed_time),
             bigquery.ScalarQueryParameter("speed", "FLOAT64", view.speed),
             bigquery.ScalarQueryParameter("created_at", "TIMESTAMP", datetime.now(timezone.utc)),
-        ])).result()
+        ]))
 
+class BigQueryRecordingRepository(BigQueryBaseRepository, AsyncRecordingRepository):
+    def __init__(self, client: bigquery.Client, dataset_id: str, result_cache: QueryResultCache | None = None):
+        super().__init__(client, dataset_id, result_cache)
 
-class BigQueryRecordingRepository(BigQueryBaseRepository, RecordingRepository):
-    def __init__(self, client: bigquery.Client, dataset_id: str):
-        super().__init__(client, dataset_id)
+    @cached("recordings", "programs", "views")
+    async def search(self, params: RecordingQueryParams) -> list[RecordingGet]:
+        return (await self._search(params, facets=False))[0]
 
-    def search(self, params: RecordingQueryParams) -> list[RecordingGet]:
-        job = self.client.query("""
-            SELECT
-                r.id,
-                r.program_id,
-                r.file_path,
-                r.file_size,
-                r.watched_at,
-                r.deleted_at,
-                r.created_at,
-                p.event_id,
-                p.service_id,
-                p.name,
-                p.start_time,
-                p.duration,
-                p.text,
-                p.ext_text,
-                p.genre,
-                p.created_at AS program_created_at,
-                (SELECT TO_JSON_STRING(ARRAY_AGG(viewed_time)) FROM views WHERE views.program_id = p.id) AS viewed_times_json,
-                (SELECT TO_JSON_STRING(ARRAY_AGG(id)) FROM recordings WHERE recordings.program_id = p.id) AS recordings_json
-            FROM recordings r
-            JOIN programs p ON p.id = r.program_id
-            WHERE
-                (@program_id IS NULL OR p.id = @program_id)
-                AND (@from IS NULL OR p.start_time >= @from)
-                --AND (@to IS NULL OR TIMESTAMP_ADD(p.start_time, INTERVAL p.duration SECOND) < @to)
-                AND (@watched = TRUE OR r.watched_at IS NULL)
-                AND (@deleted = TRUE OR r.deleted_at IS NULL)
-                AND (@file_folder = '' OR REGEXP_CONTAINS(r.file_path, CONCAT('^//[^/]+/', @file_folder, '/.*$')))
-            ORDER BY p.start_time DESC, r.created_at
-            LIMIT @size OFFSET @offset
-            """, job_config=self._make_query_job_config(query_parameters=[
-                bigquery.ScalarQueryParameter("program_id", "STRING", params.program_id),
-                bigquery.ScalarQueryParameter("from", "TIMESTAMP", params.from_ or None),
-                bigquery.ScalarQueryParameter("to", "TIMESTAMP", params.to + timedelta(days=1) if params.to else None),
-                bigquery.ScalarQueryParameter("watched", "BOOL", bool(params.watched)),
-                bigquery.ScalarQueryParameter("deleted", "BOOL", bool(params.deleted)),
-                bigquery.ScalarQueryParameter("file_folder", "STRING", params.file_folder or ''),
+    @cached("recordings", "programs", "views")
+    async def search_with_facets(self, params: RecordingQueryParams) -> RecordingSearchPage:
+        items, facets = await self._search(params, facets=True)
+        return RecordingSearchPage(items=items, facets=facets)
+
+    async def _search(self, params: RecordingQueryParams, facets: bool) -> tuple[list[RecordingGet], RecordingFacets | None]:
+        cursor = parse_cursor(params.cursor, datetime, datetime, None)
+        # to は従来どおり使わない
+        where = (Predicates()
+            .add_if(params.program_id is not None, "p.id = @program_id", {
+                "program_id": bigquery.ScalarQueryParameter("program_id", "STRING", params.program_id)})
+            .add_if(params.from_, "p.start_time >= @from", {
+                "from": bigquery.ScalarQueryParameter("from", "TIMESTAMP", params.from_)})
+            .add_if(not params.watched, "r.watched_at IS NULL")
+            .add_if(not params.deleted, "r.deleted_at IS NULL")
+            .add_if(params.file_folder, "r.file_folder = @file_folder", {
+                "file_folder": bigquery.ScalarQueryParameter("file_folder", "STRING", params.file_folder)}))
+        keyset_params = [
+            bigquery.ScalarQueryParameter("cursor_start_time", "TIMESTAMP", cursor[0]),
+            bigquery.ScalarQueryParameter("cursor_created_at", "TIMESTAMP", cursor[1]),
+            bigquery.ScalarQueryParameter("cursor_id", "STRING", cursor[2]),
+        ] if cursor else []
+        rows = await self._query(where.statement(recording_search_sql, cursor is not None, facets),
+            job_config=self._make_query_job_config(query_parameters=[
+                *where.params.values(),
                 bigquery.ScalarQueryParameter("size", "INT64", params.size),
-                bigquery.ScalarQueryParameter("offset", "INT64", (params.page - 1) * params.size),
+                bigquery.ScalarQueryParameter("offset", "INT64", 0 if cursor else (params.page - 1) * params.size),
+                *keyset_params,
         ]))
-        rows = job.result()
-        return [
+        facets_row = rows[0] if facets else None
+        rows = [row for row in rows if row["id"] is not None]
+        children = await self._load_children([row["program_id"] for row in rows])
+        items = [
             RecordingGet(
                 **extract_model_fields(RecordingGet, row),
                 program=ProgramGet(
                     **extract_model_fields(ProgramGet, row, aliases={
                         "created_at": "program_created_at",
                         "id": "program_id",
-                    })
+                    }),
+                    **children.get(row["program_id"], {}),
                 )
             ) for row in rows
         ]
+        if facets_row is None:
+            return items, None
+        return items, RecordingFacets(
+            total=facets_row["facet_total"] or 0,
+            watched=facets_row["facet_watched"] or 0,
+            deleted=facets_row["facet_deleted"] or 0,
+            file_size=facets_row["facet_file_size"] or 0,
+            file_folders={folder["file_folder"] or "": folder["n"] for folder in facets_row["facet_file_folders"] or []},
+        )
 
-    def get_by_id(self, id: str) -> RecordingGet:
-        row = next(self.client.query("""
+    @cached("recordings", "programs", "views")
+    async def get_by_id(self, id: str) -> RecordingGet:
+        row = await self._query_one("""
             SELECT
                 r.id,
                 r.program_id,
                 r.file_path,
+                r.file_folder,
                 r.file_size,
                 r.watched_at,
                 r.deleted_at,
@@ -304,14 +646,14 @@ class BigQueryRecordingRepository(BigQueryBaseRepository, RecordingRepository):
                 p.ext_text,
                 p.genre,
                 p.created_at AS program_created_at,
-                (SELECT TO_JSON_STRING(ARRAY_AGG(viewed_time)) FROM views WHERE views.program_id = p.id) AS viewed_times_json,
-                (SELECT TO_JSON_STRING(ARRAY_AGG(id)) FROM recordings WHERE recordings.program_id = p.id) AS recordings_json
+                ARRAY(SELECT DISTINCT viewed_time FROM views WHERE views.program_id = p.id ORDER BY viewed_time) AS viewed_times,
+                ARRAY(SELECT id FROM recordings WHERE recordings.program_id = p.id ORDER BY id) AS recordings
             FROM recordings r
             JOIN programs p ON p.id = r.program_id
             WHERE r.id = @id
             """, job_config=self._make_query_job_config(query_parameters=[
                 bigquery.ScalarQueryParameter("id", "STRING", id)
-        ])).result(), None)
+        ]))
         if row is None:
             return None
 
@@ -325,14 +667,15 @@ class BigQueryRecordingRepository(BigQueryBaseRepository, RecordingRepository):
             )
         )
 
-    def create(self, recording: RecordingBase, program_id: str) -> str:
+    @invalidates("recordings")
+    async def create(self, recording: RecordingBase, program_id: str) -> str:
         if not re.fullmatch("//[^/]+/[^/]+/.*", recording.file_path):
             raise InvalidDataError(detail="Invalid file_path; should be '//server/folder/to/file'")
 
         new_id = str(uuid.uuid4())
-        self.client.query("""
-            INSERT INTO recordings(id, program_id, file_path, file_size, watched_at, deleted_at, created_at)
-            VALUES(@id, @program_id, @file_path, @file_size, @watched_at, @deleted_at, @created_at)
+        await self._query("""
+            INSERT INTO recordings(id, program_id, file_path, file_folder, file_size, watched_at, deleted_at, created_at)
+            VALUES(@id, @program_id, @file_path, SPLIT(@file_path, '/')[SAFE_OFFSET(3)], @file_size, @watched_at, @deleted_at, @created_at)
             """, job_config=self._make_query_job_config(query_parameters=[
                 bigquery.ScalarQueryParameter("id", "STRING", new_id),
                 bigquery.ScalarQueryParameter("program_id", "STRING", program_id),
@@ -341,10 +684,11 @@ class BigQueryRecordingRepository(BigQueryBaseRepository, RecordingRepository):
                 bigquery.ScalarQueryParameter("watched_at", "TIMESTAMP", recording.watched_at),
                 bigquery.ScalarQueryParameter("deleted_at", "TIMESTAMP", recording.deleted_at),
                 bigquery.ScalarQueryParameter("created_at", "TIMESTAMP", recording.created_at)
-        ])).result()
+        ]))
         return new_id
 
-    def update_patch(self, id: str, patch: dict) -> bool:
+    @invalidates("recordings")
+    async def update_patch(self, id: str, patch: dict) -> bool:
         diff = patch.model_dump(exclude_unset=True)
 
         # Handle deleted_at
@@ -360,11 +704,11 @@ class BigQueryRecordingRepository(BigQueryBaseRepository, RecordingRepository):
             if "file_path" in diff:
                 raise InvalidDataError(detail="Invalid file_path: should be unset")
 
-            row = next(self.client.query("""
+            row = await self._query_one("""
                 SELECT file_path FROM recordings WHERE id = @id
                 """, job_config=self._make_query_job_config(query_parameters=[
                     bigquery.ScalarQueryParameter("id", "STRING", id)
-            ])).result(), None)
+            ]))
             
             if row is None:
                 raise NotFoundError()
@@ -392,6 +736,8 @@ class BigQueryRecordingRepository(BigQueryBaseRepository, RecordingRepository):
         
         if "file_path" in diff:
             update_parts.append("file_path = @file_path")
+            # 生成列がないので file_folder も同じ式で書き込む
+            update_parts.append("file_folder = SPLIT(@file_path, '/')[SAFE_OFFSET(3)]")
             query_params.append(bigquery.ScalarQueryParameter("file_path", "STRING", patch.file_path))
             
             # If file_path is being set to empty, also set file_size to NULL
@@ -412,41 +758,36 @@ class BigQueryRecordingRepository(BigQueryBaseRepository, RecordingRepository):
                 SET {', '.join(update_parts)}
                 WHERE id = @id
             """
-            self.client.query(query, job_config=self._make_query_job_config(query_parameters=query_params)).result()
+            await self._query(query, job_config=self._make_query_job_config(query_parameters=query_params))
         
         return False
 
-class BigQuerySeriesRepository(BigQueryBaseRepository, SeriesRepository):
-    def __init__(self, client: bigquery.Client, dataset_id: str):
-        super().__init__(client, dataset_id)
+class BigQuerySeriesRepository(BigQueryBaseRepository, AsyncSeriesRepository):
+    def __init__(self, client: bigquery.Client, dataset_id: str, series_cache: SeriesIdCache | None = None,
+                 result_cache: QueryResultCache | None = None):
+        super().__init__(client, dataset_id, result_cache)
+        self.series_cache = series_cache
 
-    def search(self, params: SeriesQueryParams) -> list[Series]:
-        query_params = {
-            "name": params.name or '',
-            "size": params.size,
-            "offset": (params.page - 1) * params.size,
-        }
-        job = self.client.query("""
-            SELECT
-                id,
-                name,
-                created_at,
-                modified_at
-            FROM series
-            WHERE name LIKE CONCAT('%', @name, '%')
-            ORDER BY modified_at DESC
-            LIMIT @size OFFSET @offset
-            """,
+    @cached("series")
+    async def search(self, params: SeriesQueryParams) -> list[SeriesSearchResult]:
+        cursor = parse_cursor(params.cursor, datetime, None)
+        where = (Predicates()
+            .add_if(params.name, "name LIKE CONCAT('%', @name, '%')", {
+                "name": bigquery.ScalarQueryParameter("name", "STRING", params.name)})
+            .add_if(cursor, "modified_at <= @cursor_modified_at AND (modified_at < @cursor_modified_at OR id < @cursor_id)", {
+                "cursor_modified_at": bigquery.ScalarQueryParameter("cursor_modified_at", "TIMESTAMP", cursor[0] if cursor else None),
+                "cursor_id": bigquery.ScalarQueryParameter("cursor_id", "STRING", cursor[1] if cursor else None),
+            }))
+        return await self._query(where.statement(series_search_sql),
             job_config=self._make_query_job_config(query_parameters=[
-                bigquery.ScalarQueryParameter("name", "STRING", query_params["name"]),
-                bigquery.ScalarQueryParameter("size", "INT64", query_params["size"]),
-                bigquery.ScalarQueryParameter("offset", "INT64", query_params["offset"]),
-        ]))
-        rows = job.result()
-        return [Series(**row) for row in rows]
+                *where.params.values(),
+                bigquery.ScalarQueryParameter("size", "INT64", params.size),
+                bigquery.ScalarQueryParameter("offset", "INT64", 0 if cursor else (params.page - 1) * params.size),
+        ]), model=SeriesSearchResult)
 
-    def get_by_id(self, id: str, page: int = 1, size: int = 100) -> SeriesWithPrograms | None:
-        job = self.client.query("""
+    @cached("series", "program_series", "programs", "views", "recordings")
+    async def get_by_id(self, id: str, page: int = 1, size: int = 100) -> SeriesWithPrograms | None:
+        series_row = await self._query_one("""
             SELECT
                 id,
                 name,
@@ -458,13 +799,12 @@ class BigQuerySeriesRepository(BigQueryBaseRepository, SeriesRepository):
             job_config=self._make_query_job_config(query_parameters=[
                 bigquery.ScalarQueryParameter("id", "STRING", id)
         ]))
-        series_row = next(job.result(), None)
         if series_row is None:
             return None
         
         series = Series(**series_row)
 
-        job = self.client.query("""
+        rows = await self._query("""
             SELECT
                 p.id,
                 p.event_id,
@@ -475,9 +815,7 @@ class BigQuerySeriesRepository(BigQueryBaseRepository, SeriesRepository):
                 p.text,
                 p.ext_text,
                 p.genre,
-                p.created_at,
-                (SELECT TO_JSON_STRING(ARRAY_AGG(viewed_time)) FROM views WHERE views.program_id = p.id) AS viewed_times_json,
-                (SELECT TO_JSON_STRING(ARRAY_AGG(id)) FROM recordings WHERE recordings.program_id = p.id) AS recordings_json
+                p.created_at
             FROM programs p
             INNER JOIN program_series ps ON ps.program_id = p.id
             WHERE ps.series_id = @id
@@ -489,75 +827,72 @@ class BigQuerySeriesRepository(BigQueryBaseRepository, SeriesRepository):
                 bigquery.ScalarQueryParameter("size", "INT64", size),
                 bigquery.ScalarQueryParameter("offset", "INT64", (page - 1) * size),
         ]))
-        rows = job.result()
-        programs = [ProgramGet(**row) for row in rows]
+        children = await self._load_children([row["id"] for row in rows])
+        programs = [ProgramGet(**row, **children.get(row["id"], {})) for row in rows]
 
         return SeriesWithPrograms(
             **series.model_dump(),
             programs=programs,
         )
 
-    def get_or_create(self, name: str, created_at: datetime) -> str:
-        job = self.client.query("""
-            SELECT id FROM series WHERE name = @name
-            """, job_config=self._make_query_job_config(query_parameters=[
-                bigquery.ScalarQueryParameter("name", "STRING", name)
-        ]))
-        row = next(job.result(), None)
-        if row:
-            return row["id"]
+    async def get_or_create(self, name: str, created_at: datetime) -> str:
+        if self.series_cache is None:
+            return await self._get_or_create(name, created_at)
+        generation = self.series_cache.generation
+        series_id = self.series_cache.get(name)
+        if series_id is None:
+            series_id = await self._get_or_create(name, created_at)
+            self.series_cache.put(name, series_id, generation)
+        return series_id
 
-        new_id = str(uuid.uuid4())
-        self.client.query("""
-            INSERT INTO series (id, name, created_at, modified_at)
-            VALUES (@id, @name, @created_at, @modified_at)
+    @invalidates("series")
+    async def _get_or_create(self, name: str, created_at: datetime) -> str:
+        row = await self._query_one(f"""
+            DECLARE ingest_series_id STRING;
+            {SERIES_GET_OR_CREATE}
+            SELECT ingest_series_id AS id;
             """, job_config=self._make_query_job_config(query_parameters=[
-                bigquery.ScalarQueryParameter("id", "STRING", new_id),
-                bigquery.ScalarQueryParameter("name", "STRING", name),
+                bigquery.ScalarQueryParameter("series_id", "STRING", None),
+                bigquery.ScalarQueryParameter("series_name", "STRING", name),
+                bigquery.ScalarQueryParameter("new_series_id", "STRING", str(uuid.uuid4())),
                 bigquery.ScalarQueryParameter("created_at", "TIMESTAMP", created_at),
-                bigquery.ScalarQueryParameter("modified_at", "TIMESTAMP", created_at),
-        ])).result()
+        ]))
+        return row["id"]
 
-        return new_id
+    @invalidates("series", "program_series")
+    async def add_program(self, series_id: str, program_id: str, at: datetime) -> None:
+        await self._query(f"""
+            DECLARE ingest_series_id STRING DEFAULT @series_id;
+            DECLARE ingest_program_id STRING DEFAULT @program_id;
 
-    def add_program(self, series_id: str, program_id: str, at: datetime) -> None:
-        # Check if program already in series
-        job = self.client.query("""
-            SELECT 1 FROM program_series WHERE series_id = @series_id AND program_id = @program_id
+            BEGIN
+                BEGIN TRANSACTION;
+                {PROGRAM_SERIES_ADD}
+                COMMIT TRANSACTION;
+            EXCEPTION WHEN ERROR THEN
+                ROLLBACK TRANSACTION;
+                RAISE USING MESSAGE = @@error.message;
+            END;
             """, job_config=self._make_query_job_config(query_parameters=[
                 bigquery.ScalarQueryParameter("series_id", "STRING", series_id),
                 bigquery.ScalarQueryParameter("program_id", "STRING", program_id),
+                bigquery.ScalarQueryParameter("created_at", "TIMESTAMP", at),
         ]))
-        if next(job.result(), None):
-            return
 
-        # Insert link
-        self.client.query("""
-            INSERT INTO program_series (series_id, program_id)
-            VALUES (@series_id, @program_id)
-            """, job_config=self._make_query_job_config(query_parameters=[
-                bigquery.ScalarQueryParameter("series_id", "STRING", series_id),
-                bigquery.ScalarQueryParameter("program_id", "STRING", program_id),
-        ])).result()
-
-        # Update modified_at
-        self.client.query("""
-            UPDATE series
-            SET modified_at = @at
-            WHERE id = @series_id AND modified_at < @at
-            """, job_config=self._make_query_job_config(query_parameters=[
-                bigquery.ScalarQueryParameter("at", "TIMESTAMP", at),
-                bigquery.ScalarQueryParameter("series_id", "STRING", series_id),
-        ])).result()
+    @invalidates("series", "program_series")
+    async def update(self, id: str, name: str) -> None:
+        await self._update(id, name)
+        if self.series_cache is not None:
+            # リネームなら元の名前、統合なら消したシリーズを指している対応が古くなる
+            self.series_cache.invalidate(name=name, series_id=id)
 
-    def update(self, id: str, name: str) -> None:
+    async def _update(self, id: str, name: str) -> None:
         # Check if new name already exists (for merge)
-        job = self.client.query("""
+        row = await self._query_one("""
             SELECT id FROM series WHERE name = @name
             """, job_config=self._make_query_job_config(query_parameters=[
                 bigquery.ScalarQueryParameter("name", "STRING", name)
         ]))
-        row = next(job.result(), None)
 
         if row:
             new_series_id = row["id"]
@@ -566,7 +901,7 @@ class BigQuerySeriesRepository(BigQueryBaseRepository, SeriesRepository):
 
             # Merge
             # 1. Move programs (avoid duplicates)
-            self.client.query("""
+            await self._query("""
                 MERGE INTO program_series ps
                 USING (SELECT @new_series_id as new_series_id, program_id FROM program_series WHERE series_id = @old_series_id) src
                 ON ps.series_id = src.new_series_id AND ps.program_id = src.program_id
@@ -575,23 +910,23 @@ class BigQuerySeriesRepository(BigQueryBaseRepository, SeriesRepository):
                 """, job_config=self._make_query_job_config(query_parameters=[
                     bigquery.ScalarQueryParameter("old_series_id", "STRING", id),
                     bigquery.ScalarQueryParameter("new_series_id", "STRING", new_series_id),
-            ])).result()
+            ]))
 
-            self.client.query("""
+            await self._query("""
                 DELETE FROM program_series WHERE series_id = @old_series_id
                 """, job_config=self._make_query_job_config(query_parameters=[
                     bigquery.ScalarQueryParameter("old_series_id", "STRING", id),
-            ])).result()
+            ]))
 
             # 2. Delete old series
-            self.client.query("""
+            await self._query("""
                 DELETE FROM series WHERE id = @id
                 """, job_config=self._make_query_job_config(query_parameters=[
                     bigquery.ScalarQueryParameter("id", "STRING", id),
-            ])).result()
+            ]))
         else:
             # Rename
-            self.client.query("""
+            await self._query("""
                 UPDATE series
                 SET name = @name, modified_at = @now
                 WHERE id = @id
@@ -599,16 +934,19 @@ class BigQuerySeriesRepository(BigQueryBaseRepository, SeriesRepository):
                     bigquery.ScalarQueryParameter("name", "STRING", name),
                     bigquery.ScalarQueryParameter("now", "TIMESTAMP", datetime.now(timezone.utc)),
                     bigquery.ScalarQueryParameter("id", "STRING", id),
-            ])).result()
+            ]))
 
-    def update_program_series(self, program_id: str, old_series_id: str, new_series_name: str) -> None:
+    @invalidates("series", "program_series")
+    async def update_program_series(self, program_id: str, old_series_id: str, new_series_name: str) -> None:
         # Find or create new series
-        new_series_id = self.get_or_create(new_series_name, datetime.now(timezone.utc))
+        new_series_id = await self.get_or_create(new_series_name, datetime.now(timezone.utc))
+        if self.series_cache is not None:
+            self.series_cache.invalidate(name=new_series_name)
         
         if new_series_id == old_series_id:
             return
 
-        self.client.query("""
+        await self._query("""
             UPDATE program_series
             SET series_id = @new_series_id
             WHERE program_id = @program_id AND series_id = @old_series_id
@@ -616,32 +954,316 @@ class BigQuerySeriesRepository(BigQueryBaseRepository, SeriesRepository):
                 bigquery.ScalarQueryParameter("new_series_id", "STRING", new_series_id),
                 bigquery.ScalarQueryParameter("program_id", "STRING", program_id),
                 bigquery.ScalarQueryParameter("old_series_id", "STRING", old_series_id),
-        ])).result()
+        ]))
 
-class BigQueryDigestionRepository(BigQueryBaseRepository, DigestionRepository):
-    def __init__(self, client: bigquery.Client, dataset_id: str):
-        super().__init__(client, dataset_id)
+class BigQueryDigestionRepository(BigQueryBaseRepository, AsyncDigestionRepository):
+    def __init__(self, client: bigquery.Client, dataset_id: str, result_cache: QueryResultCache | None = None):
+        super().__init__(client, dataset_id, result_cache)
         
-    def list_digestions(self, params: DigestionQueryParams) -> list[Digestion]:
-        rows = self.client.query("""
+    @cached("programs", "recordings", "program_view_stats")
+    async def list_digestions(self, params: DigestionQueryParams) -> list[Digestion]:
+        # 視聴は program_view_stats のビットマップだけで見るので、views は読まない
+        where = (Predicates()
+            .add("EXISTS (SELECT 1 FROM recordings r WHERE r.program_id = p.id AND r.watched_at IS NULL AND r.deleted_at IS NULL)")
+            .add("COALESCE(pvs.watched_minutes, 0) < DIV(p.duration + 59, 60) * 0.8")
+            .add_if(params.name, "p.name LIKE CONCAT('%', @name, '%')", {
+                "name": bigquery.ScalarQueryParameter("name", "STRING", params.name)}))
+        return await self._query(where.statement(digestion_list_sql), job_config=self._make_query_job_config(query_parameters=[
+                *where.params.values(),
+                bigquery.ScalarQueryParameter("size", "INT64", params.size),
+                bigquery.ScalarQueryParameter("offset", "INT64", (params.page - 1) * params.size),
+        ]), model=Digestion)
+
+class BigQueryIngestRepository(BigQueryBaseRepository, AsyncIngestRepository):
+    """取り込みを1つのマルチステートメントクエリ (トランザクション) で行う
+       writer があれば、視聴は番組を決めたあとにストリーミング挿入で送り、日次集計は BigQueryStatsRepository.rollup でまとめて足す
+    """
+    # 視聴を1サンプル足したぶんを日次集計に足し込む (writer がないとき)。SQLite の daily_watch_stats のトリガーと同じ集計
+    # was_viewed, was_finished は INSERT 前の番組の状態
+    DAILY_WATCH_STATS_MERGE = f"""
+        MERGE daily_watch_stats d
+        USING (
             SELECT
-                p.id,
-                p.name,
+                DATE(TIMESTAMP_SUB(@viewed_time, INTERVAL 5 HOUR), 'Asia/Tokyo') AS day,
+                COALESCE((SELECT MIN(series_id) FROM program_series WHERE program_series.program_id = p.id), '') AS series_id,
+                COALESCE(p.genre, '') AS genre,
                 p.service_id,
+                5 * 60 * COALESCE(@speed, 1.0) AS watched_seconds,
+                IF(was_viewed, 0, 1) AS programs_started,
+                IF(NOT was_finished AND {WATCHED_ENOUGH}, 1, 0) AS programs_finished
+            FROM programs p
+            WHERE p.id = ingest_program_id
+        ) s
+        ON d.day = s.day AND d.series_id = s.series_id AND d.genre = s.genre AND d.service_id = s.service_id
+        WHEN MATCHED THEN UPDATE SET
+            watched_seconds = d.watched_seconds + s.watched_seconds,
+            programs_started = d.programs_started + s.programs_started,
+            programs_finished = d.programs_finished + s.programs_finished
+        WHEN NOT MATCHED THEN
+            INSERT (day, series_id, genre, service_id, watched_seconds, programs_started, programs_finished)
+            VALUES (s.day, s.series_id, s.genre, s.service_id, s.watched_seconds, s.programs_started, s.programs_finished);
+    """
+    def __init__(self, client: bigquery.Client, dataset_id: str, series_cache: SeriesIdCache | None = None,
+                 result_cache: QueryResultCache | None = None, writer: BigQueryStreamWriter | None = None):
+        super().__init__(client, dataset_id, result_cache)
+        self.series_cache = series_cache
+        self.writer = writer
+
+    @invalidates("programs", "views", "program_view_stats", "daily_watch_stats")
+    async def ingest_view(self, view: ViewPost) -> str:
+        if self.writer is not None:
+            row = await self._query_one(f"""
+                DECLARE existing STRUCT<id STRING, start_time TIMESTAMP, duration INT64, created_at TIMESTAMP>;
+                DECLARE ingest_program_id STRING;
+
+                BEGIN
+                    BEGIN TRANSACTION;
+                    {PROGRAM_GET_OR_CREATE}
+                    COMMIT TRANSACTION;
+                EXCEPTION WHEN ERROR THEN
+                    ROLLBACK TRANSACTION;
+                    RAISE USING MESSAGE = @@error.message;
+                END;
+
+                SELECT ingest_program_id AS program_id;
+                """, job_config=self._make_query_job_config(query_parameters=[
+                    *self._program_params(view.program, view.viewed_time, view.viewed_time),
+            ]))
+            await stream_view(self.writer, row["program_id"], view)
+            return row["program_id"]
+
+        row = await self._query_one(f"""
+            DECLARE existing STRUCT<id STRING, start_time TIMESTAMP, duration INT64, created_at TIMESTAMP>;
+            DECLARE ingest_program_id STRING;
+            DECLARE was_viewed BOOL;
+            DECLARE was_finished BOOL;
+
+            BEGIN
+                BEGIN TRANSACTION;
+                {PROGRAM_GET_OR_CREATE}
+                SET (was_viewed, was_finished) = (
+                    SELECT AS STRUCT EXISTS(SELECT 1 FROM program_view_stats WHERE program_view_stats.program_id = p.id), {WATCHED_ENOUGH}
+                    FROM programs p WHERE p.id = ingest_program_id
+                );
+                INSERT INTO views(program_id, viewed_time, speed, created_at)
+                VALUES(ingest_program_id, @viewed_time, @speed, @now);
+                {program_view_stats_merge_sql("ingest_program_id")}
+                {self.DAILY_WATCH_STATS_MERGE}
+                COMMIT TRANSACTION;
+            EXCEPTION WHEN ERROR THEN
+                ROLLBACK TRANSACTION;
+                RAISE USING MESSAGE = @@error.message;
+            END;
+
+            SELECT ingest_program_id AS program_id;
+            """, job_config=self._make_query_job_config(query_parameters=[
+                *self._program_params(view.program, view.viewed_time, view.viewed_time),
+                bigquery.ScalarQueryParameter("speed", "FLOAT64", view.speed),
+                bigquery.ScalarQueryParameter("now", "TIMESTAMP", datetime.now(timezone.utc)),
+        ]))
+        return row["program_id"]
+
+    @invalidates("programs", "program_view_stats", "recordings", "series", "program_series")
+    async def ingest_recording(self, recording: RecordingPost, series_name: str) -> RecordingGet:
+        if not re.fullmatch("//[^/]+/[^/]+/.*", recording.file_path):
+            raise InvalidDataError(detail="Invalid file_path; should be '//server/folder/to/file'")
+        if not series_name:
+            raise InvalidDataError(detail="Series name cannot be empty")
+        # 知っているシリーズなら名前で引かずに id を渡す
+        generation = self.series_cache.generation if self.series_cache is not None else None
+        series_id = self.series_cache.get(series_name) if self.series_cache is not None else None
+
+        row = await self._query_one(f"""
+            DECLARE existing STRUCT<id STRING, start_time TIMESTAMP, duration INT64, created_at TIMESTAMP>;
+            DECLARE ingest_program_id STRING;
+            DECLARE ingest_series_id STRING;
+
+            BEGIN
+                BEGIN TRANSACTION;
+                {PROGRAM_GET_OR_CREATE}
+                INSERT INTO recordings(id, program_id, file_path, file_folder, file_size, watched_at, deleted_at, created_at)
+                VALUES(@recording_id, ingest_program_id, @file_path, SPLIT(@file_path, '/')[SAFE_OFFSET(3)], @file_size, @watched_at, @deleted_at, @created_at);
+                {SERIES_GET_OR_CREATE}
+                {PROGRAM_SERIES_ADD}
+                COMMIT TRANSACTION;
+            EXCEPTION WHEN ERROR THEN
+                ROLLBACK TRANSACTION;
+                RAISE USING MESSAGE = @@error.message;
+            END;
+
+            SELECT
+                r.id,
+                r.program_id,
+                r.file_path,
+                r.file_folder,
+                r.file_size,
+                r.watched_at,
+                r.deleted_at,
+                r.created_at,
+                p.event_id,
+                p.service_id,
+                p.name,
                 p.start_time,
                 p.duration,
-                (SELECT TO_JSON_STRING(ARRAY_AGG(viewed_time)) FROM views WHERE views.program_id = p.id) AS viewed_times_json
-            FROM programs p
-            WHERE EXISTS (
-                SELECT 1 FROM recordings r WHERE r.program_id = p.id AND r.watched_at IS NULL AND r.deleted_at IS NULL
-            )
-              AND COALESCE((SELECT COUNT(viewed_time) * 5 * 60 FROM views WHERE views.program_id = p.id), 0) < p.duration * 0.8
-              AND (@name = '' OR p.name LIKE CONCAT('%', @name, '%'))
-            ORDER BY p.start_time DESC
-            LIMIT @size OFFSET @offset
+                p.text,
+                p.ext_text,
+                p.genre,
+                p.created_at AS program_created_at,
+                ARRAY(SELECT DISTINCT viewed_time FROM views WHERE views.program_id = p.id ORDER BY viewed_time) AS viewed_times,
+                ARRAY(SELECT id FROM recordings WHERE recordings.program_id = p.id ORDER BY id) AS recordings,
+                ingest_series_id AS series_id
+            FROM recordings r
+            JOIN programs p ON p.id = r.program_id
+            WHERE r.id = @recording_id;
             """, job_config=self._make_query_job_config(query_parameters=[
-                bigquery.ScalarQueryParameter("name", "STRING", params.name or ''),
-                bigquery.ScalarQueryParameter("size", "INT64", params.size),
-                bigquery.ScalarQueryParameter("offset", "INT64", (params.page - 1) * params.size),
-        ])).result()
-        return [Digestion(**dict(row)) for row in rows]
+                *self._program_params(recording.program, recording.created_at, recording.created_at),
+                bigquery.ScalarQueryParameter("recording_id", "STRING", str(uuid.uuid4())),
+                bigquery.ScalarQueryParameter("file_path", "STRING", recording.file_path),
+                bigquery.ScalarQueryParameter("file_size", "INT64", recording.file_size),
+                bigquery.ScalarQueryParameter("watched_at", "TIMESTAMP", recording.watched_at),
+                bigquery.ScalarQueryParameter("deleted_at", "TIMESTAMP", recording.deleted_at),
+                bigquery.ScalarQueryParameter("series_name", "STRING", series_name),
+                bigquery.ScalarQueryParameter("series_id", "STRING", series_id),
+                bigquery.ScalarQueryParameter("new_series_id", "STRING", str(uuid.uuid4())),
+        ]))
+        if row is None:
+            raise UnexpectedError(detail="Ingested recording not found")
+        if self.series_cache is not None:
+            self.series_cache.put(series_name, row["series_id"], generation)
+
+        return RecordingGet(
+            **extract_model_fields(RecordingGet, row),
+            program=ProgramGet(
+                **extract_model_fields(ProgramGet, row, aliases={
+                    "created_at": "program_created_at",
+                    "id": "program_id",
+                })
+            )
+        )
+
+class BigQueryStatsRepository(BigQueryBaseRepository, AsyncStatsRepository):
+    # 放送日を period の文字列にする FORMAT_DATE の書式
+    PERIOD_FORMATS = {"day": "%Y-%m-%d", "month": "%Y-%m", "year": "%Y"}
+    # group_by ごとの daily_watch_stats の列
+    KEYS = {None: "CAST(NULL AS STRING)", "series": "series_id", "genre": "genre", "service": "CAST(service_id AS STRING)"}
+
+    # 取り込みからこの秒数より前の視聴だけを足す。ストリーミング挿入の送り直しが終わるのを待つ
+    ROLLUP_LAG_SECONDS = 300
+    # ストリーミング挿入した視聴のうち、前回から今回までに取り込んだもの (created_at) を日次集計に足し、足したところを記録する
+    # 視聴が増えた番組の program_view_stats も、今回までの視聴から作り直す
+    # 送り直しで重複した行は同じ created_at を持つので、番組と視聴時刻でまとめてから数える
+    # 同時に2つ動くと daily_watch_stats の更新がぶつかり、片方のトランザクションが失敗する
+    DAILY_WATCH_STATS_ROLLUP = f"""
+        DECLARE rolled_up_to TIMESTAMP DEFAULT (SELECT COALESCE(MAX(rolled_up_to), TIMESTAMP '1970-01-01') FROM daily_watch_stats_rollups);
+        DECLARE rollup_until TIMESTAMP DEFAULT TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @lag_seconds SECOND);
+        DECLARE samples INT64 DEFAULT 0;
+
+        IF rollup_until > rolled_up_to THEN
+            BEGIN
+                BEGIN TRANSACTION;
+                SET samples = (
+                    SELECT COUNT(*) FROM (
+                        SELECT DISTINCT program_id, viewed_time FROM views
+                        WHERE created_at >= rolled_up_to AND created_at < rollup_until
+                    )
+                );
+                -- 足す前の番組の集計を覚えてから、program_view_stats を作り直す
+                CREATE TEMP TABLE rollup_programs AS
+                SELECT p.id AS program_id, pvs.program_id IS NOT NULL AS was_viewed, COALESCE(pvs.watched_minutes, 0) AS minutes_before
+                FROM programs p
+                LEFT JOIN program_view_stats pvs ON pvs.program_id = p.id
+                WHERE p.id IN (SELECT program_id FROM views WHERE created_at >= rolled_up_to AND created_at < rollup_until);
+                {program_view_stats_merge_sql("SELECT program_id FROM rollup_programs", "views.created_at < rollup_until")}
+                MERGE daily_watch_stats d
+                USING (
+                    WITH new_views AS (
+                        SELECT program_id, viewed_time, ANY_VALUE(speed) AS speed
+                        FROM views
+                        WHERE created_at >= rolled_up_to AND created_at < rollup_until
+                        GROUP BY program_id, viewed_time
+                    ), keys AS (
+                        SELECT
+                            p.id AS program_id,
+                            COALESCE((SELECT MIN(series_id) FROM program_series WHERE program_series.program_id = p.id), '') AS series_id,
+                            COALESCE(p.genre, '') AS genre,
+                            p.service_id,
+                            DIV(p.duration + 59, 60) AS slots,
+                            r.was_viewed,
+                            r.minutes_before,
+                            COALESCE(pvs.watched_minutes, 0) AS minutes_after
+                        FROM programs p
+                        JOIN rollup_programs r ON r.program_id = p.id
+                        LEFT JOIN program_view_stats pvs ON pvs.program_id = p.id
+                    )
+                    SELECT day, series_id, genre, service_id, SUM(watched_seconds) AS watched_seconds,
+                        SUM(programs_started) AS programs_started, SUM(programs_finished) AS programs_finished
+                    FROM (
+                        SELECT
+                            DATE(TIMESTAMP_SUB(v.viewed_time, INTERVAL 5 HOUR), 'Asia/Tokyo') AS day, k.series_id, k.genre, k.service_id,
+                            5 * 60 * COALESCE(v.speed, 1.0) AS watched_seconds, 0 AS programs_started, 0 AS programs_finished
+                        FROM new_views v JOIN keys k USING (program_id)
+                        UNION ALL
+                        -- 見始めた番組は、今回の最初の視聴の日に数える
+                        SELECT
+                            DATE(TIMESTAMP_SUB(MIN(v.viewed_time), INTERVAL 5 HOUR), 'Asia/Tokyo'), ANY_VALUE(k.series_id), ANY_VALUE(k.genre), ANY_VALUE(k.service_id),
+                            0, 1, 0
+                        FROM new_views v JOIN keys k USING (program_id)
+                        WHERE NOT k.was_viewed
+                        GROUP BY program_id
+                        UNION ALL
+                        -- 今回で視聴済みの分が8割に達した番組は、今回の最後の視聴の日に数える
+                        SELECT
+                            DATE(TIMESTAMP_SUB(MAX(v.viewed_time), INTERVAL 5 HOUR), 'Asia/Tokyo'), ANY_VALUE(k.series_id), ANY_VALUE(k.genre), ANY_VALUE(k.service_id),
+                            0, 0, 1
+                        FROM new_views v JOIN keys k USING (program_id)
+                        WHERE k.minutes_before < k.slots * 0.8 AND k.minutes_after >= k.slots * 0.8
+                        GROUP BY program_id
+                    )
+                    GROUP BY day, series_id, genre, service_id
+                ) s
+                ON d.day = s.day AND d.series_id = s.series_id AND d.genre = s.genre AND d.service_id = s.service_id
+                WHEN MATCHED THEN UPDATE SET
+                    watched_seconds = d.watched_seconds + s.watched_seconds,
+                    programs_started = d.programs_started + s.programs_started,
+                    programs_finished = d.programs_finished + s.programs_finished
+                WHEN NOT MATCHED THEN
+                    INSERT (day, series_id, genre, service_id, watched_seconds, programs_started, programs_finished)
+                    VALUES (s.day, s.series_id, s.genre, s.service_id, s.watched_seconds, s.programs_started, s.programs_finished);
+                INSERT INTO daily_watch_stats_rollups(rolled_up_to, created_at)
+                VALUES(rollup_until, CURRENT_TIMESTAMP());
+                COMMIT TRANSACTION;
+            EXCEPTION WHEN ERROR THEN
+                ROLLBACK TRANSACTION;
+                RAISE USING MESSAGE = @@error.message;
+            END;
+        END IF;
+
+        SELECT samples;
+    """
+
+    def __init__(self, client: bigquery.Client, dataset_id: str, result_cache: QueryResultCache | None = None,
+                 streaming: bool = False):
+        super().__init__(client, dataset_id, result_cache)
+        self.streaming = streaming
+
+    @invalidates("program_view_stats", "daily_watch_stats")
+    async def rollup(self) -> int:
+        # 取り込みで MERGE しているときに足すと二重に数える
+        if not self.streaming:
+            return 0
+        row = await self._query_one(self.DAILY_WATCH_STATS_ROLLUP, job_config=self._make_query_job_config(query_parameters=[
+            bigquery.ScalarQueryParameter("lag_seconds", "INT64", self.ROLLUP_LAG_SECONDS),
+        ]))
+        return row["samples"]
+
+    @cached("daily_watch_stats", "series")
+    async def watch_stats(self, params: StatsQueryParams) -> list[WatchStats]:
+        # day のパーティションを刈り込めるよう、期間は指定されたほうだけ条件にする
+        where = (Predicates()
+            .add_if(params.from_, "day >= @from", {"from": bigquery.ScalarQueryParameter("from", "DATE", params.from_)})
+            .add_if(params.to, "day <= @to", {"to": bigquery.ScalarQueryParameter("to", "DATE", params.to)}))
+        return await self._query(where.statement(watch_stats_sql, self.KEYS[params.group_by]), job_config=self._make_query_job_config(query_parameters=[
+                *where.params.values(),
+                bigquery.ScalarQueryParameter("format", "STRING", self.PERIOD_FORMATS[params.period]),
+                bigquery.ScalarQueryParameter("group_by", "STRING", params.group_by or ''),
+        ]), model=WatchStats)
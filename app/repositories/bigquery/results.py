@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import functools
+import typing
+from typing import TYPE_CHECKING, Any, TypeVar
+
+from pydantic import BaseModel
+
+from app.models.api import JSTDatetime
+
+if TYPE_CHECKING:
+    # ジョブと RowIterator のメソッドを呼ぶだけなので、実行時には読み込まない (テストでは偽のジョブを渡す)
+    import pyarrow
+    from google.cloud import bigquery
+
+M = TypeVar("M", bound=BaseModel)
+
+# これ以上の行数の結果は REST で1行ずつ Row にせず、Arrow (あれば Storage Read API) で列のまま受け取る
+ARROW_MIN_ROWS = 500
+
+@functools.cache
+def has_arrow() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def fetch_results(job: bigquery.QueryJob, model: type[M] | None = None) -> list[bigquery.Row] | list[M]:
+    """完了したジョブの結果を取り出す。model がなければ Row のまま返す
+       model があれば、job.result() が読んだ最初のページの total_rows で受け取り方を決める
+       ARROW_MIN_ROWS 以上で pyarrow があれば、残りを Arrow で受け取り、列からモデルを作る
+    """
+    rows = job.result()
+    if model is None:
+        return list(rows)
+    if rows.total_rows is not None and rows.total_rows >= ARROW_MIN_ROWS and has_arrow():
+        # google-cloud-bigquery-storage がなければ、REST のまま Arrow で受け取る
+        return models_from_arrow(rows.to_arrow(create_bqstorage_client=True, progress_bar_type=None), model)
+    return [model(**row) for row in rows]
+
+def models_from_arrow(table: pyarrow.Table, model: type[M]) -> list[M]:
+    """列ごとに型をそろえて Python の値のリストにし、それを zip して model_construct でモデルを作る
+       検証を通さないので、TIMESTAMP は列のまま UTC (JSTDatetime の項目は JST) の aware な datetime にしておく
+    """
+    names = table.column_names
+    columns = [_column_values(table.column(i), _is_jst(model, name)) for i, name in enumerate(names)]
+    fields_set = set(names) & model.model_fields.keys()
+    construct = model.model_construct
+    return [construct(fields_set, **dict(zip(names, values))) for values in zip(*columns)]
+
+def _is_jst(model: type[BaseModel], name: str) -> bool:
+    """JSTDatetime か list[JSTDatetime] の項目か"""
+    field = model.model_fields.get(name)
+    if field is None:
+        return False
+    if field.metadata == typing.get_args(JSTDatetime)[1:]:
+        return True
+    return JSTDatetime in typing.get_args(field.annotation)
+
+def _column_values(column: pyarrow.ChunkedArray, jst: bool) -> list[Any]:
+    import pyarrow
+
+    # REST の Row と同じく、マイクロ秒の aware な datetime にそろえる
+    timestamp = pyarrow.timestamp("us", tz="Asia/Tokyo" if jst else "UTC")
+    if pyarrow.types.is_timestamp(column.type):
+        column = column.cast(timestamp)
+    elif pyarrow.types.is_list(column.type) and pyarrow.types.is_timestamp(column.type.value_type):
+        column = column.cast(pyarrow.list_(timestamp))
+    return column.to_pylist()
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+from concurrent.futures import Future
+from queue import Empty, Queue
+from threading import Thread
+from time import monotonic, sleep
+from typing import TYPE_CHECKING, Any
+
+from ..exceptions import UnexpectedError
+
+if TYPE_CHECKING:
+    # insert_rows_json を呼ぶだけなので、実行時には読み込まない (テストでは偽のクライアントを渡す)
+    from google.cloud import bigquery
+
+Row = tuple[dict[str, Any], str]
+
+class BigQueryStreamWriter:
+    """行をストリーミング挿入 (insert_rows_json) で専用のスレッドからまとめて送る
+       行ごとに DML のジョブを作らないので、ジョブの起動待ちや DML の同時実行数の制限に縛られない
+       max_delay 秒待つか max_batch 行たまったら1回のリクエストで送り、それぞれの Future に結果を返す
+       行には row_id (insertId) を付けるので、送り直しても BigQuery 側で重複が除かれる
+       ただし重複除去はベストエフォートなので、送り直した行が2行になることはある (at-least-once)
+       重複は読む側 (DEDUPED_VIEWS など) で番組と視聴時刻ごとに1行にする
+    """
+    def __init__(self, client: bigquery.Client, table: str,
+                 max_batch: int = 500, max_delay: float = 0.2, retries: int = 3, timeout: float = 30):
+        self.table = table
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.retries = retries
+        self.timeout = timeout
+        self._client = client
+        self._queue: Queue[tuple[Row, Future] | None] = Queue()
+        self._thread = Thread(target=self._run, name="bigquery-stream-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, row: dict[str, Any], row_id: str) -> Future:
+        """row の値は JSON にできるもの (TIMESTAMP は ISO 8601 の文字列) にする"""
+        future = Future()
+        self._queue.put(((row, row_id), future))
+        return future
+
+    def close(self) -> None:
+        """投入済みの行を送ってからスレッドを止める"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stopping = False
+            deadline = monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(deadline - monotonic(), 0))
+                except Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._send(batch)
+            if stopping:
+                return
+
+    def _send(self, batch: list[tuple[Row, Future]]) -> None:
+        rows = [row for (row, _), _ in batch]
+        row_ids = [row_id for (_, row_id), _ in batch]
+        for attempt in range(self.retries + 1):
+            try:
+                errors = self._client.insert_rows_json(self.table, rows, row_ids=row_ids, timeout=self.timeout)
+                break
+            except Exception as e:
+                # 同じ row_id で送り直すので、前の試行で届いていた行は重複しない
+                if attempt == self.retries:
+                    for _, future in batch:
+                        future.set_exception(e)
+                    return
+                sleep(0.5 * 2 ** attempt)
+
+        failed = {error["index"]: error["errors"] for error in errors}
+        for i, (_, future) in enumerate(batch):
+            if i in failed:
+                future.set_exception(UnexpectedError(detail=f"Failed to insert row into {self.table}: {failed[i]}"))
+            else:
+                future.set_result(None)
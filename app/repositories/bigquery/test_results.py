@@ -0,0 +1,87 @@
+from datetime import datetime, timezone
+import pytest
+from app.models.api import JST, Digestion, ViewGet
+from app.repositories.bigquery import results
+from app.repositories.bigquery.results import ARROW_MIN_ROWS, fetch_results
+
+AT = datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+class FakeRowIterator:
+    """RowIterator の代わり。total_rows を持ち、行を dict (Row と同じく **row で読める) で返す
+       行を読んだか、to_arrow を呼んだかを job.calls に記録する
+    """
+    def __init__(self, job):
+        self.job = job
+        self.total_rows = len(job.rows)
+
+    def __iter__(self):
+        self.job.calls.append("rows")
+        return iter(self.job.rows)
+
+    def to_arrow(self, create_bqstorage_client, progress_bar_type):
+        self.job.calls.append(("to_arrow", create_bqstorage_client))
+        return self.job.table
+
+class FakeJob:
+    """result の呼び出しを記録する"""
+    def __init__(self, rows, table=None):
+        self.rows = rows
+        self.table = table
+        self.calls = []
+
+    def result(self):
+        self.calls.append("result")
+        return FakeRowIterator(self)
+
+def view_rows(n):
+    return [{"program_id": f"p{i}", "viewed_time": AT, "speed": 1.0, "created_at": AT} for i in range(n)]
+
+def test_fetch_results_小さい結果はRowからモデルを作る():
+    job = FakeJob(view_rows(2))
+    assert fetch_results(job, ViewGet) == [ViewGet(**row) for row in view_rows(2)]
+    # total_rows を確かめるためだけに結果を読み直さない
+    assert job.calls == ["result", "rows"]
+
+def test_fetch_results_modelがなければ行数を確かめずにRowを返す():
+    job = FakeJob(view_rows(2))
+    assert fetch_results(job) == view_rows(2)
+    assert job.calls == ["result", "rows"]
+
+def test_fetch_results_pyarrowがなければ大きい結果もRowで読む(monkeypatch):
+    monkeypatch.setattr(results, "has_arrow", lambda: False)
+    job = FakeJob(view_rows(ARROW_MIN_ROWS))
+    assert len(fetch_results(job, ViewGet)) == ARROW_MIN_ROWS
+    assert job.calls == ["result", "rows"]
+
+def test_fetch_results_大きい結果はArrowの列からモデルを作る():
+    pa = pytest.importorskip("pyarrow")
+    rows = view_rows(ARROW_MIN_ROWS)
+    # BigQuery の TIMESTAMP と同じ型で、ミリ秒の列も UTC のマイクロ秒にそろうことを確かめる
+    table = pa.table({
+        "program_id": pa.array([row["program_id"] for row in rows]),
+        "viewed_time": pa.array([row["viewed_time"] for row in rows], type=pa.timestamp("ms", tz="UTC")),
+        "speed": pa.array([row["speed"] for row in rows]),
+        "created_at": pa.array([row["created_at"] for row in rows], type=pa.timestamp("us", tz="UTC")),
+    })
+    job = FakeJob(rows, table)
+
+    assert fetch_results(job, ViewGet) == [ViewGet(**row) for row in rows]
+    # 最初のページのあとは REST で行を読まない
+    assert job.calls == ["result", ("to_arrow", True)]
+
+def test_fetch_results_ArrowでもJSTDatetimeの項目はJSTにする():
+    pa = pytest.importorskip("pyarrow")
+    rows = [{"id": f"p{i}", "name": "番組", "service_id": 1, "start_time": AT, "duration": 1800, "viewed_times": [AT]}
+            for i in range(ARROW_MIN_ROWS)]
+    table = pa.table({
+        "id": pa.array([row["id"] for row in rows]),
+        "name": pa.array([row["name"] for row in rows]),
+        "service_id": pa.array([row["service_id"] for row in rows]),
+        "start_time": pa.array([row["start_time"] for row in rows], type=pa.timestamp("us", tz="UTC")),
+        "duration": pa.array([row["duration"] for row in rows]),
+        "viewed_times": pa.array([row["viewed_times"] for row in rows], type=pa.list_(pa.timestamp("us", tz="UTC"))),
+    })
+
+    digestions = fetch_results(FakeJob(rows, table), Digestion)
+    assert digestions == [Digestion(**row) for row in rows]
+    assert digestions[0].viewed_times[0].utcoffset() == AT.astimezone(JST).utcoffset()
@@ -0,0 +1,73 @@
+import pytest
+from app.repositories.bigquery import stream
+from app.repositories.bigquery.stream import BigQueryStreamWriter
+from app.repositories.exceptions import UnexpectedError
+
+class FakeClient:
+    """insert_rows_json の呼び出しを記録し、errors に積んだ結果 (例外か行ごとのエラー) を順に返す"""
+    def __init__(self, *errors):
+        self.calls = []
+        self.errors = list(errors)
+
+    def insert_rows_json(self, table, rows, row_ids, timeout):
+        self.calls.append((table, rows, row_ids))
+        result = self.errors.pop(0) if self.errors else []
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(stream, "sleep", lambda seconds: None)
+
+def test_stream_writer_たまった行を1回で送る():
+    client = FakeClient()
+    writer = BigQueryStreamWriter(client, "p.d.views", max_batch=3, max_delay=1)
+    futures = [writer.submit({"i": i}, f"r{i}") for i in range(6)]
+    writer.close()
+
+    assert [f.result(timeout=1) for f in futures] == [None] * 6
+    assert [len(rows) for _, rows, _ in client.calls] == [3, 3]
+    assert [row_ids for _, _, row_ids in client.calls] == [["r0", "r1", "r2"], ["r3", "r4", "r5"]]
+
+def test_stream_writer_失敗したら同じrow_idで送り直す():
+    client = FakeClient(ConnectionError("reset"), ConnectionError("reset"))
+    writer = BigQueryStreamWriter(client, "p.d.views", max_delay=0, retries=2)
+    future = writer.submit({"i": 0}, "r0")
+    writer.close()
+
+    assert future.result(timeout=1) is None
+    assert [row_ids for _, _, row_ids in client.calls] == [["r0"]] * 3
+
+def test_stream_writer_送り直しても失敗したらバッチの全行に例外を返す():
+    client = FakeClient(*[ConnectionError("reset")] * 3)
+    writer = BigQueryStreamWriter(client, "p.d.views", max_delay=1, retries=2)
+    futures = [writer.submit({"i": i}, f"r{i}") for i in range(2)]
+    writer.close()
+
+    for future in futures:
+        with pytest.raises(ConnectionError):
+            future.result(timeout=1)
+    assert len(client.calls) == 3
+
+def test_stream_writer_行ごとのエラーはその行のFutureにだけ返す():
+    client = FakeClient([{"index": 1, "errors": [{"reason": "invalid"}]}])
+    writer = BigQueryStreamWriter(client, "p.d.views", max_delay=1)
+    futures = [writer.submit({"i": i}, f"r{i}") for i in range(3)]
+    writer.close()
+
+    assert futures[0].result(timeout=1) is None
+    with pytest.raises(UnexpectedError):
+        futures[1].result(timeout=1)
+    assert futures[2].result(timeout=1) is None
+
+def test_stream_writer_closeは投入済みの行を送ってから止める():
+    client = FakeClient()
+    writer = BigQueryStreamWriter(client, "p.d.views", max_delay=60)
+    futures = [writer.submit({"i": i}, f"r{i}") for i in range(2)]
+    # max_delay を待たずに送る
+    writer.close()
+
+    assert all(f.done() for f in futures)
+    assert [row_ids for _, _, row_ids in client.calls] == [["r0", "r1"]]
+    assert not writer._thread.is_alive()
@@ -0,0 +1,143 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Awaitable, Callable, Hashable, Iterable, TypeVar
+import functools
+import time
+
+from pydantic import BaseModel
+
+T = TypeVar("T")
+
+class SeriesIdCache:
+    """シリーズ名 → id の LRU
+       対応はリネームと統合でしか変わらないので、リポジトリのその経路で invalidate する
+       DB を引く前に generation を取っておき、put のときに変わっていれば (途中で invalidate されたので) 入れない
+    """
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self._items: OrderedDict[str, int | str] = OrderedDict()
+        self._generation = 0
+        self._lock = Lock()
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, name: str) -> int | str | None:
+        with self._lock:
+            series_id = self._items.get(name)
+            if series_id is not None:
+                self._items.move_to_end(name)
+            return series_id
+
+    def put(self, name: str, series_id: int | str, generation: int) -> None:
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._items[name] = series_id
+            self._items.move_to_end(name)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def warm(self, items: Iterable[tuple[str, int | str]]) -> None:
+        """(name, id) を古い順に入れる。あとのほうが最近使ったものとして残る"""
+        generation = self.generation
+        for name, series_id in items:
+            self.put(name, series_id, generation)
+
+    def invalidate(self, name: str | None = None, series_id: int | str | None = None) -> None:
+        """name の対応と、series_id を指している対応を消す"""
+        with self._lock:
+            self._generation += 1
+            if name is not None:
+                self._items.pop(name, None)
+            if series_id is not None:
+                for key in [k for k, v in self._items.items() if str(v) == str(series_id)]:
+                    del self._items[key]
+
+class QueryResultCache:
+    """読み取りの結果の TTL つき LRU。キーは (メソッド, 正規化した引数)
+       結果を引いたテーブルごとの generation も一緒に覚えておき、書き込みで invalidate されたテーブルがあれば捨てる
+       ほかのインスタンスからの書き込みはわからないので、それは ttl 秒で反映される
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = 300, clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._items: OrderedDict[Hashable, tuple[Any, float, dict[str, int]]] = OrderedDict()
+        self._generations: dict[str, int] = {}
+        self._lock = Lock()
+
+    def generations(self, tables: Iterable[str]) -> dict[str, int]:
+        with self._lock:
+            return {table: self._generations.get(table, 0) for table in tables}
+
+    def get(self, key: Hashable) -> tuple[bool, Any]:
+        """(あったか, 値) を返す。None も結果としてキャッシュするので、あったかどうかは別に返す"""
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return False, None
+            value, expires_at, generations = item
+            if expires_at <= self._clock() or any(self._generations.get(t, 0) != g for t, g in generations.items()):
+                del self._items[key]
+                return False, None
+            self._items.move_to_end(key)
+            return True, value
+
+    def put(self, key: Hashable, value: Any, generations: dict[str, int]) -> None:
+        """generations は引く前に generations() で取っておいたもの。引いている間に invalidate されていれば入れない"""
+        with self._lock:
+            if any(self._generations.get(t, 0) != g for t, g in generations.items()):
+                return
+            self._items[key] = (value, self._clock() + self.ttl, generations)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def invalidate(self, *tables: str) -> None:
+        """tables を引いた結果を無効にする。エントリはあとで get したときに捨てる"""
+        with self._lock:
+            for table in tables:
+                self._generations[table] = self._generations.get(table, 0) + 1
+
+    async def get_or_load(self, key: Hashable, tables: Iterable[str], load: Callable[[], Awaitable[T]]) -> T:
+        found, value = self.get(key)
+        if found:
+            return value
+        generations = self.generations(tables)
+        value = await load()
+        self.put(key, value, generations)
+        return value
+
+def _normalize(value: Any) -> Hashable:
+    return value.model_dump_json() if isinstance(value, BaseModel) else value
+
+def cached(*tables: str):
+    """リポジトリの読み取りメソッドの結果を self.result_cache に入れる。tables は結果を引くテーブル
+       キーはクラス名・メソッド名と引数 (クエリパラメータのモデルは JSON にする)
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            if self.result_cache is None:
+                return await method(self, *args, **kwargs)
+            key = (type(self).__name__, method.__name__,
+                   *map(_normalize, args), *sorted((k, _normalize(v)) for k, v in kwargs.items()))
+            return await self.result_cache.get_or_load(key, tables, lambda: method(self, *args, **kwargs))
+        return wrapper
+    return decorator
+
+def invalidates(*tables: str):
+    """リポジトリの書き込みメソッドのあとで、tables を引いた self.result_cache の結果を無効にする"""
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            try:
+                return await method(self, *args, **kwargs)
+            finally:
+                # 失敗しても途中まで書けているかもしれないので、常に無効にする
+                if self.result_cache is not None:
+                    self.result_cache.invalidate(*tables)
+        return wrapper
+    return decorator
@@ -1,10 +1,13 @@
 from abc import ABC, abstractmethod
 from datetime import datetime
-from ..models.api import ProgramBase, ProgramQueryParams, ProgramGet, ViewBase, ViewQueryParams, ViewGet, RecordingBase, RecordingQueryParams, RecordingGet, Series, SeriesWithPrograms, SeriesQueryParams, Digestion, DigestionQueryParams
+from ..models.api import ProgramBase, ProgramQueryParams, ProgramGet, ProgramSearchResult, ProgramSearchPage, ViewBase, ViewPost, ViewQueryParams, ViewGet, RecordingBase, RecordingPost, RecordingQueryParams, RecordingGet, RecordingSearchPage, Series, SeriesSearchResult, SeriesWithPrograms, SeriesQueryParams, Digestion, DigestionQueryParams, StatsQueryParams, WatchStats
 
 class ProgramRepository(ABC):
     @abstractmethod
-    def search(self, params: ProgramQueryParams) -> list[ProgramGet]: ...
+    def search(self, params: ProgramQueryParams) -> list[ProgramSearchResult]: ...
+
+    @abstractmethod
+    def search_with_facets(self, params: ProgramQueryParams) -> ProgramSearchPage: ...
 
     @abstractmethod
     def get_by_id(self, id: int | str) -> ProgramGet: ...
@@ -26,6 +29,9 @@ class RecordingRepository(ABC):
     @abstractmethod
     def search(self, params: RecordingQueryParams) -> list[RecordingGet]: ...
 
+    @abstractmethod
+    def search_with_facets(self, params: RecordingQueryParams) -> RecordingSearchPage: ...
+
     @abstractmethod
     def get_by_id(self, id: int | str) -> RecordingGet: ...
 
@@ -37,7 +43,7 @@ class RecordingRepository(ABC):
 
 class SeriesRepository(ABC):
     @abstractmethod
-    def search(self, params: SeriesQueryParams) -> list[Series]: ...
+    def search(self, params: SeriesQueryParams) -> list[SeriesSearchResult]: ...
 
     @abstractmethod
     def get_by_id(self, id: int | str, page: int = 1, size: int = 100) -> SeriesWithPrograms | None: ...
@@ -57,3 +63,95 @@ class SeriesRepository(ABC):
 class DigestionRepository(ABC):
     @abstractmethod
     def list_digestions(self, params: DigestionQueryParams) -> list[Digestion]: ...
+
+class IngestRepository(ABC):
+    """取り込み (番組の get_or_create と視聴・録画の登録) を1トランザクションで行う"""
+    @abstractmethod
+    def ingest_view(self, view: ViewPost) -> int | str: ...
+
+    @abstractmethod
+    def ingest_recording(self, recording: RecordingPost, series_name: str) -> RecordingGet: ...
+
+class StatsRepository(ABC):
+    @abstractmethod
+    def watch_stats(self, params: StatsQueryParams) -> list[WatchStats]: ...
+
+# 上のリポジトリの async 版。ルーターはこちらを await する
+# SQLite は同期のリポジトリを専用のスレッドで呼び、BigQuery はジョブの完了をイベントループ上で待つ
+
+class AsyncProgramRepository(ABC):
+    @abstractmethod
+    async def search(self, params: ProgramQueryParams) -> list[ProgramSearchResult]: ...
+
+    @abstractmethod
+    async def search_with_facets(self, params: ProgramQueryParams) -> ProgramSearchPage: ...
+
+    @abstractmethod
+    async def get_by_id(self, id: int | str) -> ProgramGet: ...
+
+    @abstractmethod
+    async def get_or_create(self, program: ProgramBase, created_at: datetime, viewed_time: datetime) -> int | str: ...
+
+    @abstractmethod
+    async def update(self, id: int | str, genre: str | None) -> None: ...
+
+class AsyncViewRepository(ABC):
+    @abstractmethod
+    async def search(self, params: ViewQueryParams) -> list[ViewGet]: ...
+
+    @abstractmethod
+    async def create(self, program_id: int | str, view: ViewBase) -> None: ...
+
+class AsyncRecordingRepository(ABC):
+    @abstractmethod
+    async def search(self, params: RecordingQueryParams) -> list[RecordingGet]: ...
+
+    @abstractmethod
+    async def search_with_facets(self, params: RecordingQueryParams) -> RecordingSearchPage: ...
+
+    @abstractmethod
+    async def get_by_id(self, id: int | str) -> RecordingGet: ...
+
+    @abstractmethod
+    async def create(self, recording: RecordingBase, program_id: int | str) -> int | str: ...
+
+    @abstractmethod
+    async def update_patch(self, id: int | str, patch: dict) -> bool: ...
+
+class AsyncSeriesRepository(ABC):
+    @abstractmethod
+    async def search(self, params: SeriesQueryParams) -> list[SeriesSearchResult]: ...
+
+    @abstractmethod
+    async def get_by_id(self, id: int | str, page: int = 1, size: int = 100) -> SeriesWithPrograms | None: ...
+
+    @abstractmethod
+    async def get_or_create(self, title: str, created_at: datetime) -> int | str: ...
+
+    @abstractmethod
+    async def add_program(self, series_id: int | str, program_id: int | str, at: datetime) -> None: ...
+
+    @abstractmethod
+    async def update(self, id: int | str, name: str) -> None: ...
+
+    @abstractmethod
+    async def update_program_series(self, program_id: int | str, old_series_id: int | str, new_series_name: str) -> None: ...
+
+class AsyncDigestionRepository(ABC):
+    @abstractmethod
+    async def list_digestions(self, params: DigestionQueryParams) -> list[Digestion]: ...
+
+class AsyncIngestRepository(ABC):
+    @abstractmethod
+    async def ingest_view(self, view: ViewPost) -> int | str: ...
+
+    @abstractmethod
+    async def ingest_recording(self, recording: RecordingPost, series_name: str) -> RecordingGet: ...
+
+class AsyncStatsRepository(ABC):
+    @abstractmethod
+    async def watch_stats(self, params: StatsQueryParams) -> list[WatchStats]: ...
+
+    async def rollup(self) -> int:
+        """取り込んだ視聴を日次集計にまとめて足し、足したサンプル数を返す。取り込みで足し込む実装では何もしない"""
+        return 0
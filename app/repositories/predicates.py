@@ -0,0 +1,45 @@
+from functools import lru_cache
+from typing import Any, Callable
+
+class Predicates:
+    """検索条件のうち、使うものだけを AND でつないだ WHERE 句とそのパラメータ
+       `(:from IS NULL OR :from <= start_time)` のように値がなくても残る書き方だと、SQLite はインデックスを、
+       BigQuery はパーティションの刈り込みを使えないので、値のない条件は文に入れない
+       params の値は SQLite なら値そのもの、BigQuery なら ScalarQueryParameter を入れる
+    """
+    def __init__(self):
+        self._clauses: list[str] = []
+        self.params: dict[str, Any] = {}
+
+    def add(self, clause: str, params: dict[str, Any] | None = None) -> "Predicates":
+        self._clauses.append(clause)
+        self.params.update(params or {})
+        return self
+
+    def add_if(self, condition: Any, clause: str, params: dict[str, Any] | None = None) -> "Predicates":
+        """condition が真のときだけ条件を足す"""
+        if condition:
+            self.add(clause, params)
+        return self
+
+    @property
+    def key(self) -> tuple[str, ...]:
+        """条件の組み合わせ。値はパラメータに入るので、文はこれだけで決まる"""
+        return tuple(self._clauses)
+
+    @property
+    def sql(self) -> str:
+        return where_sql(self.key)
+
+    def statement(self, build: Callable[..., str], *args) -> str:
+        """build(where, *args) で組み立てた文を、条件の組み合わせと args ごとにキャッシュして返す
+           build はモジュールのトップレベルの関数にし、args はハッシュできる値 (フラグなど) だけにする
+        """
+        return _statement(build, self.key, args)
+
+def where_sql(clauses: tuple[str, ...]) -> str:
+    return " AND ".join(f"({clause})" for clause in clauses) if clauses else "TRUE"
+
+@lru_cache(maxsize=512)
+def _statement(build: Callable[..., str], clauses: tuple[str, ...], args: tuple) -> str:
+    return build(where_sql(clauses), *args)
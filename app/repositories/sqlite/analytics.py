@@ -0,0 +1,204 @@
+from datetime import datetime
+from pathlib import Path
+from threading import Lock
+import shutil
+import time
+
+from ...models.api import JST, AnalyticsQueryParams, AnalyticsResult
+from .archive import ARCHIVE_COLUMNS, archive_path, archive_years_of_path
+
+# 分析で読むテーブル。Parquet のスナップショットもこの単位で書き出す
+ANALYTICS_TABLES = ["programs", "view_segments", "program_view_stats", "series", "program_series"]
+
+# 視聴区間をサンプルごとの視聴時刻 t と視聴秒数に展開する (SQLite の views と同じく、両端以外は等間隔で補間する)
+SAMPLES = """
+    SELECT
+        program_id
+      , start_time + (end_time - start_time) * k // greatest(samples - 1, 1) AS t
+      , 5 * 60 * coalesce(speed, 1.0) AS seconds
+    FROM (SELECT *, unnest(range(samples)) AS k FROM tv.view_segments)
+"""
+
+# /api/analytics/{name} のクエリ。パラメータは $from_time, $to_time (epoch 秒), $limit, $min_programs
+# 列名が _at で終わるものは epoch 秒で返し、JST の datetime にする
+ANALYTICS_QUERIES = {
+    # 時間帯 (JST) ごとの視聴時間
+    "hour_of_day": f"""
+        SELECT
+            (t + 9 * 3600) % 86400 // 3600 AS hour
+          , sum(seconds) / 3600 AS watched_hours
+          , count(DISTINCT program_id) AS programs
+        FROM ({SAMPLES})
+        WHERE t >= $from_time AND t < $to_time
+        GROUP BY 1
+        ORDER BY 1
+        LIMIT $limit
+    """,
+    # 30分以上空かずに続けて見た区間をひと続きの視聴とし、$min_programs 番組以上見たものを長い順に
+    "binge_sessions": """
+        WITH segments AS (
+            SELECT program_id, start_time - 5 * 60 AS start_time, end_time, samples * 5 * 60 * coalesce(speed, 1.0) AS seconds
+            FROM tv.view_segments
+            WHERE end_time >= $from_time AND start_time < $to_time
+        ), marked AS (
+            SELECT
+                *
+              , CASE WHEN start_time - max(end_time) OVER (
+                    ORDER BY start_time, end_time ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                ) <= 30 * 60 THEN 0 ELSE 1 END AS is_new
+            FROM segments
+        ), sessions AS (
+            SELECT *, sum(is_new) OVER (ORDER BY start_time, end_time) AS session FROM marked
+        )
+        SELECT
+            min(start_time) AS started_at
+          , max(end_time) AS ended_at
+          , count(DISTINCT program_id) AS programs
+          , sum(seconds) / 3600 AS watched_hours
+        FROM sessions
+        GROUP BY session
+        HAVING count(DISTINCT program_id) >= $min_programs
+        ORDER BY watched_hours DESC, started_at DESC
+        LIMIT $limit
+    """,
+    # シリーズごとに、期間内に放送した番組のうち見始めた数と、視聴済みの分が8割に達した数
+    "series_completion": """
+        SELECT
+            series.id AS series_id
+          , series.name
+          , count(*) AS programs
+          , count(program_view_stats.program_id) AS started
+          , count_if(program_view_stats.watched_minutes >= (programs.duration + 59) // 60 * 0.8) AS finished
+          , finished / count(*) AS completion_rate
+        FROM tv.series
+        INNER JOIN tv.program_series ON program_series.series_id = series.id
+        INNER JOIN tv.programs ON programs.id = program_series.program_id
+        LEFT JOIN tv.program_view_stats ON program_view_stats.program_id = programs.id
+        WHERE programs.start_time >= $from_time AND programs.start_time < $to_time
+        GROUP BY series.id, series.name
+        HAVING count(*) >= $min_programs
+        ORDER BY completion_rate DESC, programs DESC, series.id
+        LIMIT $limit
+    """,
+}
+
+class DuckDBAnalytics:
+    """DuckDB で集計用のクエリを列指向・ベクトル化して実行する
+       source="sqlite" なら DB を読み取り専用で ATTACH し、"parquet" なら snapshot で書き出した最新の Parquet を読む
+       アーカイブ (db/archive/*.db) も読み取り専用で ATTACH し、tv スキーマのビューで本体と UNION ALL する
+       どちらもリクエストの SQLite 接続とは別の接続なので、重い集計が取り込みの書き込みを止めない
+       DuckDB の接続はスレッドセーフでないので、クエリは1つずつ実行する
+    """
+    def __init__(self, db_path: str, snapshot_dir: str, source: str = "sqlite", keep: int = 3):
+        if source not in ("sqlite", "parquet"):
+            raise ValueError(f"Unsupported analytics source: {source}")
+        self.source = source
+        self.keep = keep
+        self._db_path = Path(db_path)
+        self._snapshot_dir = Path(snapshot_dir)
+        self._con = None
+        self._snapshot: Path | None = None
+        self._lock = Lock()
+
+    def query(self, name: str, params: AnalyticsQueryParams) -> AnalyticsResult:
+        if name not in ANALYTICS_QUERIES:
+            raise KeyError(name)
+        sql = ANALYTICS_QUERIES[name]
+        values = {
+            "from_time": int(params.from_.timestamp()) if params.from_ else 0,
+            "to_time": int(params.to.timestamp()) if params.to else 2 ** 62,
+            "limit": params.limit,
+            "min_programs": params.min_programs,
+        }
+        started = time.perf_counter()
+        with self._lock:
+            # DuckDB は使っていない名前付きパラメータを渡すとエラーになる
+            cur = self._connection().execute(sql, {k: v for k, v in values.items() if f"${k}" in sql})
+            columns = [d[0] for d in cur.description]
+            rows = cur.fetchall()
+        return AnalyticsResult(
+            name=name,
+            source=self.source,
+            rows=[
+                {
+                    column: datetime.fromtimestamp(value, JST) if column.endswith("_at") and value is not None else value
+                    for column, value in zip(columns, row)
+                }
+                for row in rows
+            ],
+            seconds=time.perf_counter() - started,
+        )
+
+    def snapshot(self) -> Path:
+        """ANALYTICS_TABLES を Parquet に書き出し、snapshot_dir/YYYYmmdd-HHMMSS/ を返す。古いものは keep 個まで残す"""
+        path = self._snapshot_dir / datetime.now(JST).strftime("%Y%m%d-%H%M%S")
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.mkdir(parents=True)
+        with self._lock:
+            con = self._attach_sqlite(self._duckdb().connect())
+            try:
+                for table in ANALYTICS_TABLES:
+                    con.execute(f"COPY (SELECT * FROM tv.{table}) TO '{tmp / table}.parquet' (FORMAT PARQUET)")
+            finally:
+                con.close()
+            tmp.rename(path)
+            # parquet を読んでいるなら、次のクエリから新しいスナップショットを読む
+            if self.source == "parquet":
+                self._reset()
+        for old in self.list_snapshots()[:-self.keep]:
+            shutil.rmtree(old)
+        return path
+
+    def list_snapshots(self) -> list[Path]:
+        if not self._snapshot_dir.exists():
+            return []
+        return sorted(p for p in self._snapshot_dir.iterdir() if p.is_dir() and not p.name.endswith(".tmp"))
+
+    def close(self) -> None:
+        with self._lock:
+            self._reset()
+
+    def _reset(self) -> None:
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+
+    def _duckdb(self):
+        import duckdb
+        return duckdb
+
+    def _connection(self):
+        if self._con is None:
+            con = self._duckdb().connect()
+            if self.source == "sqlite":
+                self._con = self._attach_sqlite(con)
+            else:
+                self._con = self._attach_parquet(con)
+        return self._con
+
+    def _attach_sqlite(self, con):
+        con.execute("INSTALL sqlite")
+        con.execute("LOAD sqlite")
+        con.execute(f"ATTACH '{self._db_path}' AS tv_main (TYPE sqlite, READ_ONLY)")
+        schemas = []
+        for year in archive_years_of_path(self._db_path):
+            con.execute(f"ATTACH '{archive_path(self._db_path, year)}' AS tv_archive_{year} (TYPE sqlite, READ_ONLY)")
+            schemas.append(f"tv_archive_{year}")
+        con.execute("CREATE SCHEMA tv")
+        for table in ANALYTICS_TABLES:
+            if table in ARCHIVE_COLUMNS:
+                columns = ARCHIVE_COLUMNS[table]
+                selects = [f"SELECT {columns} FROM tv_main.{table}"] + [f"SELECT {columns} FROM {schema}.{table}" for schema in schemas]
+                con.execute(f"CREATE VIEW tv.{table} AS {' UNION ALL '.join(selects)}")
+            else:
+                con.execute(f"CREATE VIEW tv.{table} AS SELECT * FROM tv_main.{table}")
+        return con
+
+    def _attach_parquet(self, con):
+        snapshots = self.list_snapshots()
+        if not snapshots:
+            raise FileNotFoundError(f"No analytics snapshot in {self._snapshot_dir}")
+        con.execute("CREATE SCHEMA tv")
+        for table in ANALYTICS_TABLES:
+            con.execute(f"CREATE VIEW tv.{table} AS SELECT * FROM read_parquet('{snapshots[-1] / table}.parquet')")
+        return con
@@ -1,50 +1,234 @@
+import json
 import time
+from contextlib import contextmanager
+from functools import wraps
 from pydantic import BaseModel
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from sqlite3 import Connection
 import re
-from ...models.api import ProgramBase, ProgramQueryParams, ProgramGetBase, ProgramGet, ViewBase, ViewQueryParams, ViewGet, RecordingBase, RecordingQueryParams, RecordingGet, Series, SeriesQueryParams, SeriesWithPrograms, Digestion, DigestionQueryParams
-from ..interfaces import ProgramRepository, ViewRepository, RecordingRepository, SeriesRepository, DigestionRepository
+from ...models.api import JST, encode_cursor, expand_view_segment, ProgramBase, ProgramQueryParams, ProgramGetBase, ProgramGet, ProgramSearchResult, ProgramFacets, ProgramSearchPage, ViewBase, ViewPost, ViewQueryParams, ViewGet, RecordingBase, RecordingPost, RecordingQueryParams, RecordingGet, RecordingFacets, RecordingSearchPage, Series, SeriesQueryParams, SeriesSearchResult, SeriesWithPrograms, Digestion, DigestionQueryParams, StatsQueryParams, WatchStats, broadcast_day
+from ..interfaces import ProgramRepository, ViewRepository, RecordingRepository, SeriesRepository, DigestionRepository, IngestRepository, StatsRepository
 from ..exceptions import NotFoundError, InvalidDataError, UnexpectedError
-from ..utils import extract_model_fields
+from ..cache import SeriesIdCache
+from ..predicates import Predicates
+from ..utils import extract_model_fields, parse_cursor
+from .archive import archive_years_between, archive_years_of_program, attach_archives, list_archive_years, union_archives
+from .write_queue import BatchConnection, SQLiteWriteQueue
+
+def queued_write(method):
+    """write_queue があれば、書き込み用スレッドで他の書き込みとまとめて1トランザクションでコミットする
+       キュー側では write_queue なしで作り直したリポジトリで method を実行する
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.write_queue is None:
+            return method(self, *args, **kwargs)
+        return self.write_queue.run(lambda con: method(type(self)(con), *args, **kwargs))
+    return wrapper
+
+def expand_views(row) -> list[ViewGet]:
+    """view_segments の1行をサンプルごとの ViewGet に戻す"""
+    viewed_times = expand_view_segment(row["start_time"], row["end_time"], row["samples"])
+    created_ats = expand_view_segment(row["created_at"], row["updated_at"], row["samples"])
+    return [
+        ViewGet(
+            program_id=row["program_id"],
+            viewed_time=datetime.fromtimestamp(viewed_time).astimezone(JST),
+            speed=row["speed"],
+            created_at=datetime.fromtimestamp(created_at).astimezone(JST),
+        )
+        for viewed_time, created_at in zip(viewed_times, created_ats)
+    ]
+
+def insert_view_sample(con: Connection, program_id: int, viewed_time: datetime, speed: float | None, created_at: datetime) -> None:
+    """視聴サンプルを1件足す。前のサンプルから 0 秒超 7分30秒以内なら続きの区間を延ばし、なければ区間を作る"""
+    cur = con.execute("""
+        UPDATE view_segments SET end_time = :viewed_time, samples = samples + 1, updated_at = :created_at
+        WHERE id = (
+            SELECT id FROM view_segments
+            WHERE program_id = :program_id AND speed IS :speed
+            AND end_time BETWEEN :viewed_time - 450 AND :viewed_time - 1
+            ORDER BY end_time DESC
+            LIMIT 1
+        )
+    """, {"program_id": program_id, "viewed_time": viewed_time, "speed": speed, "created_at": created_at})
+    if cur.rowcount == 0:
+        con.execute("""
+            INSERT INTO view_segments(program_id, start_time, end_time, speed, samples, created_at, updated_at)
+            VALUES(?, ?, ?, ?, 1, ?, ?)
+        """, (program_id, viewed_time, viewed_time, speed, created_at, created_at))
+
+def sort_views(views) -> list[ViewGet]:
+    """created_at DESC, program_id DESC, viewed_time DESC"""
+    return sorted(views, key=lambda v: (v.created_at, v.program_id, v.viewed_time), reverse=True)
+
+def segment_viewed_times(viewed_times_json: str | None) -> list[int]:
+    """program_view_stats の [start_time, end_time, samples] の配列を視聴時刻に展開する"""
+    return [t for segment in json.loads(viewed_times_json or "[]") for t in expand_view_segment(*segment)]
+
+def load_recording_ids(con: Connection, program_ids: list[int], deleted: bool, archives: str = "") -> dict[int, list[int]]:
+    """番組ごとの録画 id を1回のクエリでまとめて引く。deleted が False なら削除済みを除く
+       archives は union_archives の WITH 句で、アーカイブの録画も含めるときに渡す
+    """
+    program_ids = list(dict.fromkeys(program_ids))
+    result = {id_: [] for id_ in program_ids}
+    if not program_ids:
+        return result
+    cur = con.execute(f"""
+        {archives}
+        SELECT program_id, id FROM recordings
+        WHERE program_id IN ({", ".join("?" * len(program_ids))})
+        {"" if deleted else "AND deleted_at IS NULL"}
+        ORDER BY program_id, id
+    """, program_ids)
+    for program_id, id_ in cur.fetchall():
+        result[program_id].append(id_)
+    return result
+
+def with_facets(page: str, facets: str, order_by: str) -> str:
+    """ページのクエリと、同じ条件の全件を集計する1行のクエリを1文にまとめる
+       ページが空でも集計の行は返るので、集計は先頭の行から、ページは id が NULL でない行から読む
+    """
+    return f"""
+        SELECT page.*, facets.*
+        FROM ({facets}) AS facets
+        LEFT JOIN ({page}) AS page ON TRUE
+        ORDER BY {order_by}
+    """
+
+def recording_get(row, recordings: list[int]) -> RecordingGet:
+    """録画と番組を JOIN した1行から RecordingGet を作る"""
+    return RecordingGet(
+        **extract_model_fields(RecordingGet, row),
+        program=ProgramGet(
+            **extract_model_fields(ProgramGet, row, aliases={
+                "created_at": "program_created_at",
+                "id": "program_id",
+            }),
+            viewed_times=segment_viewed_times(row["viewed_times_json"]),
+            recordings=recordings,
+        )
+    )
+
+def fts_phrase(text: str) -> str | None:
+    """trigram の FTS5 で部分一致させるフレーズ。3文字未満は trigram で引けないので None"""
+    if len(text) < 3:
+        return None
+    return '"' + text.replace('"', '""') + '"'
+
+def program_search_sql(where: str, match: bool, by_rank: bool, keyset: bool, facets: bool) -> str:
+    """番組検索の文。match なら全文検索で絞り、keyset ならカーソルより後を、facets なら全件の集計も返す"""
+    if match:
+        fts_columns = """
+            , snippet(programs_fts, -1, '<mark>', '</mark>', '…', 16) AS snippet
+            , bm25(programs_fts, 10.0, 1.0, 1.0) AS rank
+        """
+        fts_join = "INNER JOIN programs_fts ON programs_fts.rowid = programs.id AND programs_fts MATCH :match"
+    else:
+        fts_columns = fts_join = ""
+    # カーソルがあるときだけ条件を足して、start_time のインデックスを範囲で読ませる
+    keyset_filter = "AND (programs.start_time, programs.id) < (:cursor_start_time, :cursor_id)" if keyset else ""
+    order_by = "rank, programs.start_time DESC, programs.id DESC" if by_rank else "programs.start_time DESC, programs.id DESC"
+    sql = f"""
+        SELECT
+            programs.id
+        , programs.event_id
+        , programs.service_id
+        , programs.name
+        , programs.start_time AS "start_time [timestamp]"
+        , programs.duration
+        , programs.text
+        , programs.ext_text
+        , programs.genre
+        , programs.created_at AS "created_at [timestamp]"
+        , COALESCE(program_view_stats.viewed_times_json, '[]') AS viewed_times_json
+        , program_view_stats.watched_bitmap
+        {fts_columns}
+        FROM programs
+        {fts_join}
+        LEFT JOIN program_view_stats ON program_view_stats.program_id = programs.id
+        WHERE {where} {keyset_filter}
+        ORDER BY {order_by}
+        LIMIT :size OFFSET :offset
+    """
+    if not facets:
+        return sql
+    # カーソルやページに関係なく、同じ条件に合う全件を数える
+    return with_facets(sql, f"""
+        SELECT
+            COUNT(*) AS facet_total
+        , COUNT(program_view_stats.program_id) AS facet_viewed
+        , SUM(EXISTS (SELECT 1 FROM recordings WHERE recordings.program_id = programs.id AND recordings.deleted_at IS NULL)) AS facet_recorded
+        FROM programs
+        {fts_join}
+        LEFT JOIN program_view_stats ON program_view_stats.program_id = programs.id
+        WHERE {where}
+    """, ("page.rank, " if by_rank else "") + 'page."start_time [timestamp]" DESC, page.id DESC')
+
+# 同じ番組をもう一度受け取ったときの programs の更新。{new} は受け取った値の接頭辞 ("excluded." か ":")
+# 既存より遅い start_time なら番組情報を差し替え、同じ start_time なら既存が viewed_time より前に作られたときだけ duration を更新する
+PROGRAM_MERGE_SET = """
+    start_time = MAX(programs.start_time, {new}start_time)
+  , name = CASE WHEN {new}start_time > programs.start_time THEN {new}name ELSE programs.name END
+  , text = CASE WHEN {new}start_time > programs.start_time THEN {new}text ELSE programs.text END
+  , ext_text = CASE WHEN {new}start_time > programs.start_time THEN {new}ext_text ELSE programs.ext_text END
+  , genre = CASE WHEN {new}start_time > programs.start_time THEN {new}genre ELSE programs.genre END
+  , duration = CASE
+        WHEN {new}start_time > programs.start_time THEN {new}duration
+        WHEN {new}start_time = programs.start_time AND programs.created_at < :viewed_time THEN {new}duration
+        ELSE programs.duration
+    END
+"""
 
 class SQLiteProgramRepository(ProgramRepository):
-    def __init__(self, con: Connection):
+    def __init__(self, con: Connection, write_queue: SQLiteWriteQueue | None = None):
         self.con = con
+        self.write_queue = write_queue
+
+    def search(self, params: ProgramQueryParams) -> list[ProgramSearchResult]:
+        return self._search(params, facets=False)[0]
+
+    def search_with_facets(self, params: ProgramQueryParams) -> ProgramSearchPage:
+        items, facets = self._search(params, facets=True)
+        return ProgramSearchPage(items=items, facets=facets)
+
+    def _search(self, params: ProgramQueryParams, facets: bool) -> tuple[list[ProgramSearchResult], ProgramFacets | None]:
+        match = fts_phrase(params.name)
+        by_rank = match is not None and params.sort == "rank"
+        cursor = None if by_rank else parse_cursor(params.cursor, datetime, None)
+        to = params.to + timedelta(days=1) if params.to else None
+        where = (Predicates()
+            .add_if(params.from_, ":from <= programs.start_time", {"from": params.from_})
+            # 終了時刻の条件だけでは start_time のインデックスを使えないので、それより緩い開始時刻の条件も付ける
+            .add_if(to, "programs.start_time < :to AND programs.start_time + programs.duration < :to", {"to": to})
+            .add_if(not match and params.name, "programs.name LIKE '%' || :name || '%'", {"name": params.name}))
+        sql = where.statement(program_search_sql, match is not None, by_rank, cursor is not None, facets)
+        # recordings には削除済みの録画も入るので、過去にさかのぼるときはアーカイブも読む
+        with attach_archives(self.con, archive_years_between(self.con, params.from_, params.to)) as schemas:
+            cur = self.con.execute(f"{union_archives('recordings', schemas)} {sql}", {
+                **where.params,
+                "match": match,
+                "cursor_start_time": cursor[0] if cursor else None,
+                "cursor_id": cursor[1] if cursor else None,
+                "size": params.size,
+                "offset": 0 if cursor else (params.page - 1) * params.size,
+            })
+            rows = cur.fetchall()
+            facets_row = rows[0] if facets else None
+            rows = [row for row in rows if row["id"] is not None]
+            recordings = load_recording_ids(self.con, [row["id"] for row in rows], deleted=True, archives=union_archives("recordings", schemas))
 
-    def search(self, params: ProgramQueryParams) -> list[ProgramGet]:
-        cur = self.con.execute("""
-            SELECT
-                id
-            , event_id
-            , service_id
-            , name
-            , start_time AS "start_time [timestamp]"
-            , duration
-            , text
-            , ext_text
-            , genre
-            , created_at AS "created_at [timestamp]"
-            , (SELECT json_group_array(viewed_time) FROM views WHERE views.program_id = programs.id) AS viewed_times_json
-            , (SELECT json_group_array(id) FROM recordings WHERE recordings.program_id = programs.id) AS recordings_json
-            FROM programs
-            WHERE
-                TRUE
-            AND (:from IS NULL OR :from <= programs.start_time)
-            AND (:to IS NULL OR programs.start_time + programs.duration < :to)
-            AND (:name = '' OR programs.name LIKE '%' || :name || '%')
-            ORDER BY start_time DESC
-            LIMIT :size OFFSET :offset
-        """, {
-            "from": params.from_ if params.from_ else None,
-            "to": params.to + timedelta(days=1) if params.to else None,
-            "name": params.name,
-            "size": params.size,
-            "offset": (params.page - 1) * params.size,
-        })
-        rows = cur.fetchall()
-
-        return [ProgramGet(**row) for row in rows]
+        items = [
+            ProgramSearchResult(**row, viewed_times=segment_viewed_times(row["viewed_times_json"]), recordings=recordings[row["id"]])
+            for row in rows
+        ]
+        if facets_row is None:
+            return items, None
+        return items, ProgramFacets(
+            total=facets_row["facet_total"],
+            viewed=facets_row["facet_viewed"],
+            recorded=facets_row["facet_recorded"] or 0,
+        )
 
     def get_by_id(self, id: int) -> ProgramGet | None:
         cur = self.con.cursor()
@@ -60,213 +244,301 @@ class SQLiteProgramRepository(ProgramRepository):
             , ext_text
             , genre
             , created_at AS "created_at [timestamp]"
-            , (SELECT json_group_array(viewed_time) FROM views WHERE views.program_id = programs.id) AS viewed_times_json
-            , (SELECT json_group_array(id) FROM recordings WHERE recordings.program_id = programs.id AND recordings.deleted_at IS NULL) AS recordings_json
+            , COALESCE(program_view_stats.viewed_times_json, '[]') AS viewed_times_json
+            , program_view_stats.watched_bitmap
             FROM programs
+            LEFT JOIN program_view_stats ON program_view_stats.program_id = programs.id
             WHERE id = ?
         """, (id,))
         row = cur.fetchone()
-        return ProgramGet(**row) if row is not None else None
+        if row is None:
+            return None
+        recordings = load_recording_ids(self.con, [row["id"]], deleted=False)
+        return ProgramGet(**row, viewed_times=segment_viewed_times(row["viewed_times_json"]), recordings=recordings[row["id"]])
 
+    @queued_write
     def get_or_create(self, program: ProgramBase, created_at: datetime, viewed_time: datetime) -> int:
-        cur = self.con.cursor()
-        cur.execute("""
-            SELECT id, start_time AS "start_time [timestamp]", duration, created_at AS "created_at [timestamp]"
-            FROM programs
-            WHERE event_id = ? AND service_id = ?
-            AND start_time >= ? AND start_time <= ?
+        # (service_id, event_id, broadcast_day) の一意キーの UPSERT で引く
+        params = {
+            "event_id": program.event_id,
+            "service_id": program.service_id,
+            "name": program.name,
+            "start_time": program.start_time,
+            "duration": program.duration,
+            "text": program.text,
+            "ext_text": program.ext_text,
+            "genre": program.genre,
+            "created_at": created_at,
+            "viewed_time": viewed_time,
+            "broadcast_day": (int(program.start_time.timestamp()) + 4 * 3600) // 86400,
+        }
+        # 5:00 をまたいで繰り下がると放送日が変わるので、前後の放送日の ±12 時間以内の同じ番組を先に引く
+        # その放送日にもう同じ番組があれば、前後の番組を動かすと一意キーがぶつかるので、下の UPSERT でそちらにまとめる
+        row = self.con.execute("""
+            SELECT id FROM programs
+            WHERE service_id = :service_id AND event_id = :event_id
+            AND broadcast_day BETWEEN :broadcast_day - 1 AND :broadcast_day + 1
+            AND broadcast_day != :broadcast_day
+            AND start_time BETWEEN :start_time - 12 * 3600 AND :start_time + 12 * 3600
+            AND NOT EXISTS (
+                SELECT 1 FROM programs
+                WHERE service_id = :service_id AND event_id = :event_id AND broadcast_day = :broadcast_day
+            )
             ORDER BY start_time DESC
             LIMIT 1
-        """, (
-            program.event_id,
-            program.service_id,
-            program.start_time - timedelta(hours=12),
-            program.start_time + timedelta(hours=12),
-        ))
-        row = cur.fetchone()
-
-        if row:
-            id, start_time, duration, c = row
-            # Prioritize later start time
-            if program.start_time > start_time:
-                cur.execute("""
-                    UPDATE programs
-                    SET start_time = ?, duration = ?, name = ?, text = ?, ext_text = ?, genre = ?
-                    WHERE id = ?
-                """, (
-                    program.start_time,
-                    program.duration,
-                    program.name,
-                    program.text,
-                    program.ext_text,
-                    program.genre,
-                    id
-                ))
-            elif program.start_time == start_time:
-                if duration != program.duration and c < viewed_time:
-                    cur.execute("UPDATE programs SET duration = ? WHERE id = ?", (program.duration, id))
-            return id
+        """, params).fetchone()
+        if row is not None:
+            self.con.execute(f"UPDATE programs SET {PROGRAM_MERGE_SET.format(new=':')} WHERE id = :id", {**params, "id": row["id"]})
+            self.con.commit()
+            return row["id"]
 
-        cur.execute("""
+        cur = self.con.execute(f"""
             INSERT INTO programs(event_id, service_id, name, start_time, duration, text, ext_text, genre, created_at)
-            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            program.event_id,
-            program.service_id,
-            program.name,
-            program.start_time,
-            program.duration,
-            program.text,
-            program.ext_text,
-            program.genre,
-            created_at
-        ))
+            VALUES(:event_id, :service_id, :name, :start_time, :duration, :text, :ext_text, :genre, :created_at)
+            ON CONFLICT(service_id, event_id, broadcast_day) DO UPDATE SET {PROGRAM_MERGE_SET.format(new='excluded.')}
+            RETURNING id
+        """, params)
+        id, = cur.fetchone()
         self.con.commit()
-        return cur.lastrowid
+        return id
 
+    @queued_write
     def update(self, id: int, genre: str | None) -> None:
         self.con.execute("UPDATE programs SET genre = ? WHERE id = ?", (genre, id))
         self.con.commit()
 
 class SQLiteViewRepository(ViewRepository):
-    def __init__(self, con: Connection):
+    def __init__(self, con: Connection, write_queue: SQLiteWriteQueue | None = None):
         self.con = con
+        self.write_queue = write_queue
 
     def search(self, params: ViewQueryParams) -> list[ViewGet]:
+        columns = "program_id, start_time, end_time, speed, samples, created_at, updated_at"
         if params.program_id is not None:
-            cur = self.con.execute("""
-                SELECT
-                    program_id
-                , viewed_time AS "viewed_time [timestamp]"
-                , speed
-                , created_at AS "created_at [timestamp]"
-                FROM views
-                WHERE program_id = ?
-                ORDER BY created_at DESC
-            """, (params.program_id,))
-            rows = cur.fetchall()
-        else:
-            offset = (params.page - 1) * params.size
-            cur = self.con.execute("""
-                SELECT
-                    program_id
-                , viewed_time AS "viewed_time [timestamp]"
-                , speed
-                , created_at AS "created_at [timestamp]"
-                FROM views
-                ORDER BY created_at DESC
-                LIMIT ? OFFSET ?
-            """, (params.size, offset))
-            rows = cur.fetchall()
-
-        return [ViewGet(**row) for row in rows]
-
+            # 古い番組の区間は放送年のアーカイブにある
+            with attach_archives(self.con, archive_years_of_program(self.con, params.program_id)) as schemas:
+                cur = self.con.execute(f"""
+                    {union_archives("view_segments", schemas)}
+                    SELECT {columns}
+                    FROM view_segments
+                    WHERE program_id = ?
+                """, (params.program_id,))
+                rows = cur.fetchall()
+            return sort_views(v for row in rows for v in expand_views(row))
+
+        # 区間を (updated_at, id) の新しい順に読み、区間の中はサンプルの新しい順に並べる
+        # カーソルは (updated_at, id, k) で、その区間の k 番目より前のサンプルから続ける
+        cursor = parse_cursor(params.cursor, None, None, None)
+        if cursor and not all(isinstance(v, int) for v in cursor):
+            raise InvalidDataError(detail="Invalid cursor")
+        views: list[ViewGet] = []
+        if cursor:
+            # カーソルの区間がその後延びていても、前のサンプルの位置は変わらない
+            row = self.con.execute(f"SELECT id, {columns} FROM view_segments WHERE id = ?", (cursor[1],)).fetchone()
+            if row is not None:
+                views += self._segment_views(row, min(cursor[2], row["samples"]), params.size)
+        # ページ指定では、飛ばす区間をサンプル数だけで数えて展開しない
+        skip = 0 if cursor else (params.page - 1) * params.size
+        after = cursor[:2] if cursor else None
+        while len(views) < params.size:
+            rows = self.con.execute(f"""
+                SELECT id, {columns}
+                FROM view_segments
+                {"WHERE updated_at <= :updated_at AND (updated_at < :updated_at OR id < :id)" if after else ""}
+                ORDER BY updated_at DESC, id DESC
+                LIMIT :limit
+            """, {
+                "updated_at": after[0] if after else None,
+                "id": after[1] if after else None,
+                "limit": params.size,
+            }).fetchall()
+            for row in rows:
+                if skip >= row["samples"]:
+                    skip -= row["samples"]
+                    continue
+                views += self._segment_views(row, row["samples"] - skip, params.size - len(views))
+                skip = 0
+                if len(views) >= params.size:
+                    break
+            if len(rows) < params.size:
+                break
+            after = (rows[-1]["updated_at"], rows[-1]["id"])
+        return views
+
+    @staticmethod
+    def _segment_views(row, end: int, limit: int) -> list[ViewGet]:
+        """区間の end 番目より前のサンプルを新しい順に limit 件まで、区間のキーのカーソル付きで返す"""
+        views = expand_views(row)[max(end - limit, 0):end]
+        for k, view in zip(range(end - 1, -1, -1), reversed(views)):
+            view._cursor = encode_cursor(row["updated_at"], row["id"], k)
+        return views[::-1]
+
+    @queued_write
     def create(self, program_id: int, view: ViewBase) -> None:
-        cursor = self.con.cursor()
-        cursor.execute("""
-            INSERT INTO views(program_id, viewed_time, speed, created_at)
-            VALUES(?, ?, ?, ?)
-        """, (program_id, view.viewed_time, view.speed, datetime.now(timezone.utc)))
+        insert_view_sample(self.con, program_id, view.viewed_time, view.speed, datetime.now(timezone.utc))
         self.con.commit()
 
+def recording_search_sql(where: str, by_file_folder: bool, keyset: bool, facets: bool) -> str:
+    """録画検索の文。by_file_folder なら録画側から、そうでなければ番組の start_time 順に読む"""
+    if by_file_folder:
+        # (file_folder, deleted_at, watched_at) のインデックスを等価で引くので、録画側から読む
+        join = "recordings INNER JOIN programs ON programs.id = recordings.program_id"
+    else:
+        # CROSS JOIN で programs を外側に固定し、start_time のインデックス順に LIMIT まで読む
+        join = "programs CROSS JOIN recordings ON recordings.program_id = programs.id"
+    keyset_filter = """
+        AND programs.start_time <= :cursor_start_time
+        AND (
+            programs.start_time < :cursor_start_time
+            OR (recordings.created_at, recordings.id) > (:cursor_created_at, :cursor_id)
+        )
+    """ if keyset else ""
+    sql = f"""
+        SELECT
+            recordings.id
+        , recordings.program_id
+        , recordings.file_path
+        , recordings.file_folder
+        , recordings.file_size
+        , recordings.watched_at AS "watched_at [timestamp]"
+        , recordings.deleted_at AS "deleted_at [timestamp]"
+        , recordings.created_at AS "created_at [timestamp]"
+        , programs.event_id
+        , programs.service_id
+        , programs.name
+        , programs.start_time AS "start_time [timestamp]"
+        , programs.duration
+        , programs.text
+        , programs.ext_text
+        , programs.genre
+        , programs.created_at AS "program_created_at [timestamp]"
+        , COALESCE(program_view_stats.viewed_times_json, '[]') AS viewed_times_json
+        , program_view_stats.watched_bitmap
+        FROM {join}
+        LEFT JOIN program_view_stats ON program_view_stats.program_id = programs.id
+        WHERE {where} {keyset_filter}
+        ORDER BY programs.start_time DESC, recordings.created_at, recordings.id
+        LIMIT :size OFFSET :offset
+    """
+    if not facets:
+        return sql
+    # カーソルやページに関係なく、同じ条件に合う全件を数える
+    # GROUPING SETS がないので、file_folder ごとの集計をさらに合計する
+    return with_facets(sql, f"""
+        SELECT
+            COALESCE(SUM(n), 0) AS facet_total
+        , COALESCE(SUM(watched), 0) AS facet_watched
+        , COALESCE(SUM(deleted), 0) AS facet_deleted
+        , COALESCE(SUM(file_size), 0) AS facet_file_size
+        , json_group_object(COALESCE(file_folder, ''), n) AS facet_file_folders_json
+        FROM (
+            SELECT
+                recordings.file_folder
+            , COUNT(*) AS n
+            , SUM(recordings.watched_at IS NOT NULL) AS watched
+            , SUM(recordings.deleted_at IS NOT NULL) AS deleted
+            , SUM(recordings.file_size) AS file_size
+            FROM {join}
+            WHERE {where}
+            GROUP BY recordings.file_folder
+        )
+    """, 'page."start_time [timestamp]" DESC, page."created_at [timestamp]", page.id')
+
 class SQLiteRecordingRepository(RecordingRepository):
-    def __init__(self, con: Connection):
+    def __init__(self, con: Connection, write_queue: SQLiteWriteQueue | None = None):
         self.con = con
+        self.write_queue = write_queue
 
     def search(self, params: RecordingQueryParams) -> list[RecordingGet]:
-        cur = self.con.execute("""
-            SELECT
-                recordings.id
-            , recordings.program_id
-            , recordings.file_path
-            , recordings.file_size
-            , recordings.watched_at AS "watched_at [timestamp]"
-            , recordings.deleted_at AS "deleted_at [timestamp]"
-            , recordings.created_at AS "created_at [timestamp]"
-            , programs.event_id
-            , programs.service_id
-            , programs.name
-            , programs.start_time AS "start_time [timestamp]"
-            , programs.duration
-            , programs.text
-            , programs.ext_text
-            , programs.genre
-            , programs.created_at AS "program_created_at [timestamp]"
-            , (SELECT json_group_array(viewed_time) FROM views WHERE views.program_id = programs.id) AS viewed_times_json
-            , (SELECT json_group_array(id) FROM recordings AS r2 WHERE r2.program_id = programs.id AND r2.deleted_at IS NULL) AS recordings_json
-            FROM recordings INNER JOIN programs ON programs.id = recordings.program_id
-            WHERE
-                TRUE
-            AND (:program_id IS NULL OR programs.id = :program_id)
-            AND (:from IS NULL OR :from <= programs.start_time)
-            AND (:to IS NULL OR programs.start_time + programs.duration < :to)
-            AND (:watched = TRUE OR recordings.watched_at IS NULL)
-            AND (:deleted = TRUE OR recordings.deleted_at IS NULL)
-            AND (:file_folder = '' OR recordings.file_path REGEXP '^//[^/]+/' || :file_folder || '/.*$')
-            ORDER BY programs.start_time DESC, recordings.created_at
-            LIMIT :size OFFSET :offset
-        """, {
-            "program_id": params.program_id,
-            "from": params.from_ if params.from_ else None,
-            "to": params.to + timedelta(days=1) if params.to else None,
-            "watched": bool(params.watched),
-            "deleted": bool(params.deleted),
-            "file_folder": params.file_folder,
-            "size": params.size,
-            "offset": (params.page - 1) * params.size,
-            })
-        rows = cur.fetchall()
-        return [
-            RecordingGet(
-                **extract_model_fields(RecordingGet, row),
-                program = ProgramGet(
-                    **extract_model_fields(ProgramGet, row, aliases={
-                        "created_at": "program_created_at",
-                        "id": "program_id",
-                    })
-                )
-            )
-            for row in rows
-            ]
+        return self._search(params, facets=False)[0]
+
+    def search_with_facets(self, params: RecordingQueryParams) -> RecordingSearchPage:
+        items, facets = self._search(params, facets=True)
+        return RecordingSearchPage(items=items, facets=facets)
+
+    def _search(self, params: RecordingQueryParams, facets: bool) -> tuple[list[RecordingGet], RecordingFacets | None]:
+        cursor = parse_cursor(params.cursor, datetime, datetime, None)
+        to = params.to + timedelta(days=1) if params.to else None
+        where = (Predicates()
+            .add_if(params.program_id is not None, "programs.id = :program_id", {"program_id": params.program_id})
+            .add_if(params.from_, ":from <= programs.start_time", {"from": params.from_})
+            .add_if(to, "programs.start_time < :to AND programs.start_time + programs.duration < :to", {"to": to})
+            .add_if(not params.watched, "recordings.watched_at IS NULL")
+            .add_if(not params.deleted, "recordings.deleted_at IS NULL")
+            .add_if(params.file_folder, "recordings.file_folder = :file_folder", {"file_folder": params.file_folder}))
+        sql = where.statement(recording_search_sql, bool(params.file_folder), cursor is not None, facets)
+        # アーカイブには削除済みの録画しかないので、削除済みも含めて過去にさかのぼるときだけ読む
+        if not params.deleted:
+            years = []
+        elif params.program_id is not None:
+            years = archive_years_of_program(self.con, params.program_id)
+        else:
+            years = archive_years_between(self.con, params.from_, params.to)
+        with attach_archives(self.con, years) as schemas:
+            cur = self.con.execute(f"{union_archives('recordings', schemas)} {sql}", {
+                **where.params,
+                "cursor_start_time": cursor[0] if cursor else None,
+                "cursor_created_at": cursor[1] if cursor else None,
+                "cursor_id": cursor[2] if cursor else None,
+                "size": params.size,
+                "offset": 0 if cursor else (params.page - 1) * params.size,
+                })
+            rows = cur.fetchall()
+            facets_row = rows[0] if facets else None
+            rows = [row for row in rows if row["id"] is not None]
+            recordings = load_recording_ids(self.con, [row["program_id"] for row in rows], deleted=False)
+
+        items = [recording_get(row, recordings[row["program_id"]]) for row in rows]
+        if facets_row is None:
+            return items, None
+        return items, RecordingFacets(
+            total=facets_row["facet_total"],
+            watched=facets_row["facet_watched"],
+            deleted=facets_row["facet_deleted"],
+            file_size=facets_row["facet_file_size"],
+            file_folders=json.loads(facets_row["facet_file_folders_json"]),
+        )
 
     def get_by_id(self, id: int) -> RecordingGet:
-        cur = self.con.execute("""
-            SELECT
-                recordings.id
-            , recordings.program_id
-            , recordings.file_path
-            , recordings.file_size
-            , recordings.watched_at AS "watched_at [timestamp]"
-            , recordings.deleted_at AS "deleted_at [timestamp]"
-            , recordings.created_at AS "created_at [timestamp]"
-            , programs.event_id
-            , programs.service_id
-            , programs.name
-            , programs.start_time AS "start_time [timestamp]"
-            , programs.duration
-            , programs.text
-            , programs.ext_text
-            , programs.genre
-            , programs.created_at AS "program_created_at [timestamp]"
-            , (SELECT json_group_array(viewed_time) FROM views WHERE views.program_id = programs.id) AS viewed_times_json
-            , (SELECT json_group_array(id) FROM recordings AS r2 WHERE r2.program_id = programs.id AND r2.deleted_at IS NULL) AS recordings_json
-            FROM recordings INNER JOIN programs ON programs.id = recordings.program_id
-            WHERE recordings.id = ?
-        """, (id,))
-        row = cur.fetchone()
+        # 本体になければアーカイブに移した録画を探す
+        row = self._fetch_by_id(id, [])
+        if row is None and (years := list_archive_years(self.con)):
+            row = self._fetch_by_id(id, years)
         if row is None:
             return None
+        return recording_get(row, load_recording_ids(self.con, [row["program_id"]], deleted=False)[row["program_id"]])
 
-        return RecordingGet(
-            **extract_model_fields(RecordingGet, row),
-            program = ProgramGet(
-                **extract_model_fields(ProgramGet, row, aliases={
-                    "created_at": "program_created_at",
-                    "id": "program_id",
-                    })
-                )
-            )
-
+    def _fetch_by_id(self, id: int, years: list[int]):
+        with attach_archives(self.con, years) as schemas:
+            cur = self.con.execute(f"""
+                {union_archives("recordings", schemas)}
+                SELECT
+                    recordings.id
+                , recordings.program_id
+                , recordings.file_path
+                , recordings.file_folder
+                , recordings.file_size
+                , recordings.watched_at AS "watched_at [timestamp]"
+                , recordings.deleted_at AS "deleted_at [timestamp]"
+                , recordings.created_at AS "created_at [timestamp]"
+                , programs.event_id
+                , programs.service_id
+                , programs.name
+                , programs.start_time AS "start_time [timestamp]"
+                , programs.duration
+                , programs.text
+                , programs.ext_text
+                , programs.genre
+                , programs.created_at AS "program_created_at [timestamp]"
+                , COALESCE(program_view_stats.viewed_times_json, '[]') AS viewed_times_json
+                , program_view_stats.watched_bitmap
+                FROM recordings INNER JOIN programs ON programs.id = recordings.program_id
+                LEFT JOIN program_view_stats ON program_view_stats.program_id = programs.id
+                WHERE recordings.id = ?
+            """, (id,))
+            return cur.fetchone()
+
+    @queued_write
     def create(self, recording: RecordingBase, program_id: int) -> int:
         if not re.fullmatch("//[^/]+/[^/]+/.*", recording.file_path):
             raise InvalidDataError(detail="Invalid file_path; should be '//server/folder/to/file'")
@@ -285,6 +557,7 @@ class SQLiteRecordingRepository(RecordingRepository):
         self.con.commit()
         return cur.lastrowid
 
+    @queued_write
     def update_patch(self, id: int, patch: dict) -> bool:
         diff = patch.model_dump(exclude_unset=True)
 
@@ -347,26 +620,67 @@ class SQLiteRecordingRepository(RecordingRepository):
         self.con.commit()
         return rows_affected > 0
 
+def series_search_sql(where: str, match: bool, by_rank: bool) -> str:
+    if match:
+        fts_columns = """
+          , highlight(series_fts, 0, '<mark>', '</mark>') AS snippet
+          , series_fts.rank AS rank
+        """
+        fts_join = "INNER JOIN series_fts ON series_fts.rowid = series.id AND series_fts MATCH :match"
+    else:
+        fts_columns = fts_join = ""
+    order_by = "rank, series.modified_at DESC, series.id DESC" if by_rank else "series.modified_at DESC, series.id DESC"
+    return f"""
+        SELECT
+            series.id
+          , series.name
+          , series.created_at AS "created_at [timestamp]"
+          , series.modified_at AS "modified_at [timestamp]"
+          {fts_columns}
+        FROM series
+        {fts_join}
+        WHERE {where}
+        ORDER BY {order_by}
+        LIMIT :size OFFSET :offset
+    """
+
 class SQLiteSeriesRepository(SeriesRepository):
-    def __init__(self, con: Connection):
+    def __init__(self, con: Connection, write_queue: SQLiteWriteQueue | None = None, series_cache: SeriesIdCache | None = None):
         self.con = con
-
-    def search(self, params: SeriesQueryParams) -> list[Series]:
-        cur = self.con.execute("""
-            SELECT
-                id
-              , name
-              , created_at AS "created_at [timestamp]"
-              , modified_at AS "modified_at [timestamp]"
-            FROM series
-            WHERE name LIKE '%' || ? || '%'
-            ORDER BY modified_at DESC
-            LIMIT ? OFFSET ?
-        """, (params.name, params.size, (params.page - 1) * params.size))
+        self.write_queue = write_queue
+        self.series_cache = series_cache
+
+    def search(self, params: SeriesQueryParams) -> list[SeriesSearchResult]:
+        match = fts_phrase(params.name)
+        by_rank = match is not None and params.sort == "rank"
+        cursor = None if by_rank else parse_cursor(params.cursor, datetime, None)
+        where = (Predicates()
+            .add_if(not match and params.name, "series.name LIKE '%' || :name || '%'", {"name": params.name})
+            .add_if(cursor, "(series.modified_at, series.id) < (:cursor_modified_at, :cursor_id)", {
+                "cursor_modified_at": cursor[0] if cursor else None,
+                "cursor_id": cursor[1] if cursor else None,
+            }))
+        cur = self.con.execute(where.statement(series_search_sql, match is not None, by_rank), {
+            **where.params,
+            "match": match,
+            "size": params.size,
+            "offset": 0 if cursor else (params.page - 1) * params.size,
+        })
         rows = cur.fetchall()
-        return [Series(**row) for row in rows]
+        return [SeriesSearchResult(**row) for row in rows]
     
     def get_or_create(self, name: str, created_at: datetime) -> int | str:
+        if self.series_cache is None:
+            return self._get_or_create(name, created_at)
+        generation = self.series_cache.generation
+        series_id = self.series_cache.get(name)
+        if series_id is None:
+            series_id = self._get_or_create(name, created_at)
+            self.series_cache.put(name, series_id, generation)
+        return series_id
+
+    @queued_write
+    def _get_or_create(self, name: str, created_at: datetime) -> int | str:
         if not name:
             raise InvalidDataError(detail="Series name cannot be empty")
         cur = self.con.execute("""
@@ -410,21 +724,27 @@ class SQLiteSeriesRepository(SeriesRepository):
             , p.ext_text
             , p.genre
             , p.created_at AS "created_at [timestamp]"
-            , (SELECT json_group_array(viewed_time) FROM views WHERE views.program_id = p.id) AS viewed_times_json
-            , (SELECT json_group_array(id) FROM recordings WHERE recordings.program_id = p.id) AS recordings_json
+            , COALESCE(pvs.viewed_times_json, '[]') AS viewed_times_json
+            , pvs.watched_bitmap
             FROM programs p
             INNER JOIN program_series ps ON ps.program_id = p.id
+            LEFT JOIN program_view_stats pvs ON pvs.program_id = p.id
             WHERE ps.series_id = ?
             ORDER BY p.start_time DESC
             LIMIT ? OFFSET ?
         """, (id, size, (page - 1) * size))
         rows = cur.fetchall()
-        programs = [ProgramGet(**r) for r in rows]
+        recordings = load_recording_ids(self.con, [r["id"] for r in rows], deleted=True)
+        programs = [
+            ProgramGet(**r, viewed_times=segment_viewed_times(r["viewed_times_json"]), recordings=recordings[r["id"]])
+            for r in rows
+        ]
         return SeriesWithPrograms(
             **series.model_dump(),
             programs=programs,
         )
     
+    @queued_write
     def add_program(self, series_id: int | str, program_id: int | str, at: datetime) -> None:
         series_not_found = self.con.execute("SELECT 1 FROM series WHERE id = ?", (series_id,)).fetchone() is None        
         program_not_found = self.con.execute("SELECT 1 FROM programs WHERE id = ?", (program_id,)).fetchone() is None
@@ -442,6 +762,13 @@ class SQLiteSeriesRepository(SeriesRepository):
         self.con.commit()
 
     def update(self, series_id: int | str, name: str) -> None:
+        self._update(series_id, name)
+        if self.series_cache is not None:
+            # リネームなら元の名前、統合なら消したシリーズを指している対応が古くなる
+            self.series_cache.invalidate(name=name, series_id=series_id)
+
+    @queued_write
+    def _update(self, series_id: int | str, name: str) -> None:
         # Check if new name already exists
         cur = self.con.execute("SELECT id FROM series WHERE name = ?", (name,))
         row = cur.fetchone()
@@ -470,6 +797,12 @@ class SQLiteSeriesRepository(SeriesRepository):
         self.con.commit()
 
     def update_program_series(self, program_id: int | str, old_series_id: int | str, new_series_name: str) -> None:
+        self._update_program_series(program_id, old_series_id, new_series_name)
+        if self.series_cache is not None:
+            self.series_cache.invalidate(name=new_series_name)
+
+    @queued_write
+    def _update_program_series(self, program_id: int | str, old_series_id: int | str, new_series_name: str) -> None:
         cur = self.con.execute("SELECT id FROM series WHERE name = ?", (new_series_name,))
         row = cur.fetchone()
         new_series_id = row[0] if row is not None else None
@@ -487,34 +820,123 @@ class SQLiteSeriesRepository(SeriesRepository):
             """, (new_series_id, program_id, old_series_id))
         self.con.commit()
 
+def digestion_list_sql(where: str) -> str:
+    return f"""
+        SELECT
+            programs.id
+        , programs.name
+        , programs.service_id
+        , programs.start_time
+        , programs.duration
+        , COALESCE(program_view_stats.viewed_times_json, '[]') AS viewed_times_json
+        , program_view_stats.watched_bitmap
+        FROM programs
+        LEFT JOIN program_view_stats ON program_view_stats.program_id = programs.id
+        WHERE {where}
+        ORDER BY programs.start_time, programs.id
+        LIMIT :size OFFSET :offset
+    """
+
 class SQLiteDigestionRepository(DigestionRepository):
     def __init__(self, con: Connection):
         self.con = con
 
     def list_digestions(self, params: DigestionQueryParams) -> list[Digestion]:
-        cur = self.con.execute("""
-            SELECT
-                programs.id
-            , programs.name
-            , programs.service_id
-            , programs.start_time
-            , programs.duration
-            , (SELECT json_group_array(viewed_time) FROM views WHERE views.program_id = programs.id) AS viewed_times_json
-            FROM programs
-            WHERE
+        match = fts_phrase(params.name)
+        where = (Predicates()
+            .add("""
                 EXISTS(
                     SELECT 1
                     FROM recordings
                     WHERE program_id = programs.id AND watched_at IS NULL AND deleted_at IS NULL
                     )
-              AND COALESCE((SELECT COUNT(viewed_time) * 5 * 60 FROM views WHERE views.program_id = programs.id), 0) < programs.duration * 0.8
-              AND (:name = '' OR programs.name LIKE '%' || :name || '%')
-            ORDER BY programs.start_time
-            LIMIT :size OFFSET :offset
-        """, {
-            "name": params.name,
+            """)
+            .add("COALESCE(program_view_stats.watched_minutes, 0) < (programs.duration + 59) / 60 * 0.8")
+            # 全文検索は名前だけに絞る
+            .add_if(match, "programs.id IN (SELECT rowid FROM programs_fts WHERE programs_fts MATCH 'name : ' || :match)", {"match": match})
+            .add_if(not match and params.name, "programs.name LIKE '%' || :name || '%'", {"name": params.name}))
+        cur = self.con.execute(where.statement(digestion_list_sql), {
+            **where.params,
             "size": params.size,
             "offset": (params.page - 1) * params.size,
         })
         rows = cur.fetchall()
-        return [Digestion(**row) for row in rows]
+        return [Digestion(**row, viewed_times=segment_viewed_times(row["viewed_times_json"])) for row in rows]
+
+# 放送日の日数を period の文字列にする strftime の書式
+STATS_PERIOD_FORMATS = {"day": "%Y-%m-%d", "month": "%Y-%m", "year": "%Y"}
+# group_by ごとの daily_watch_stats の列
+STATS_KEYS = {None: "NULL", "series": "daily_watch_stats.series_id", "genre": "daily_watch_stats.genre", "service": "daily_watch_stats.service_id"}
+
+class SQLiteStatsRepository(StatsRepository):
+    def __init__(self, con: Connection):
+        self.con = con
+
+    def watch_stats(self, params: StatsQueryParams) -> list[WatchStats]:
+        # daily_watch_stats の主キーの先頭が day なので、期間は範囲で読める
+        cur = self.con.execute(f"""
+            SELECT
+                strftime(:format, daily_watch_stats.day * 86400, 'unixepoch') AS period
+            , {STATS_KEYS[params.group_by]} AS key
+            , MAX(series.name) AS name
+            , SUM(daily_watch_stats.watched_seconds) AS watched_seconds
+            , SUM(daily_watch_stats.programs_started) AS programs_started
+            , SUM(daily_watch_stats.programs_finished) AS programs_finished
+            FROM daily_watch_stats
+            LEFT JOIN series ON :group_by = 'series' AND series.id = daily_watch_stats.series_id
+            WHERE daily_watch_stats.day >= :from AND daily_watch_stats.day <= :to
+            GROUP BY 1, 2
+            ORDER BY 1, watched_seconds DESC, 2
+        """, {
+            "format": STATS_PERIOD_FORMATS[params.period],
+            "group_by": params.group_by,
+            "from": broadcast_day(params.from_) if params.from_ else 0,
+            "to": broadcast_day(params.to) if params.to else 2 ** 31,
+        })
+        return [WatchStats(**row) for row in cur.fetchall()]
+
+class SQLiteIngestRepository(IngestRepository):
+    def __init__(self, con: Connection, write_queue: SQLiteWriteQueue | None = None, series_cache: SeriesIdCache | None = None):
+        self.con = con
+        self.write_queue = write_queue
+        self.series_cache = series_cache
+
+    @contextmanager
+    def _transaction(self):
+        """各リポジトリの commit() を止め、SAVEPOINT でまとめて確定するか取り消す"""
+        self.con.execute("SAVEPOINT ingest")
+        try:
+            yield BatchConnection(self.con)
+        except Exception:
+            self.con.execute("ROLLBACK TO ingest")
+            self.con.execute("RELEASE ingest")
+            raise
+        self.con.execute("RELEASE ingest")
+        self.con.commit()
+
+    @queued_write
+    def ingest_view(self, view: ViewPost) -> int:
+        with self._transaction() as con:
+            program_id = SQLiteProgramRepository(con).get_or_create(view.program, view.viewed_time, view.viewed_time)
+            SQLiteViewRepository(con).create(program_id, view)
+        return program_id
+
+    def ingest_recording(self, recording: RecordingPost, series_name: str) -> RecordingGet:
+        if self.series_cache is None:
+            return self._ingest_recording(recording, series_name, None)[0]
+        # 知っているシリーズなら名前で引かずに id を渡す。コミットされてからキャッシュに入れる
+        generation = self.series_cache.generation
+        result, series_id = self._ingest_recording(recording, series_name, self.series_cache.get(series_name))
+        self.series_cache.put(series_name, series_id, generation)
+        return result
+
+    @queued_write
+    def _ingest_recording(self, recording: RecordingPost, series_name: str, series_id: int | None) -> tuple[RecordingGet, int]:
+        with self._transaction() as con:
+            program_id = SQLiteProgramRepository(con).get_or_create(recording.program, recording.created_at, recording.created_at)
+            id_ = SQLiteRecordingRepository(con).create(recording, program_id)
+            series_repo = SQLiteSeriesRepository(con)
+            if series_id is None:
+                series_id = series_repo.get_or_create(series_name, recording.created_at)
+            series_repo.add_program(series_id, program_id, recording.created_at)
+        return SQLiteRecordingRepository(self.con).get_by_id(id_), series_id
@@ -0,0 +1,158 @@
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from sqlite3 import Connection
+from typing import Iterator
+import re
+
+from ...models.api import JST
+
+ARCHIVE_SCHEMA_PATH = "db/sqlite/archive_schemas.sql"
+
+# アーカイブに移すテーブルと列 (本体と同じ列をそのまま UNION ALL できる順)
+ARCHIVE_COLUMNS = {
+    "view_segments": "id, program_id, start_time, end_time, speed, samples, created_at, updated_at",
+    "recordings": "id, program_id, file_path, file_size, watched_at, deleted_at, created_at, server, file_folder",
+}
+
+# 番組の放送年 (JST)
+PROGRAM_YEAR = "CAST(strftime('%Y', programs.start_time, 'unixepoch', '+9 hours') AS INTEGER)"
+
+# 視聴区間を消すと集計を作り直すトリガー。アーカイブに移すときは外して消し、集計を本体に残す
+ARCHIVE_SUSPENDED_TRIGGERS = ("view_segments_delete_program_view_stats",)
+
+# 古い番組のうち、まだ消していない録画がないもの
+COLD_PROGRAMS = """
+    programs.start_time < :before
+    AND NOT EXISTS (SELECT 1 FROM main.recordings WHERE recordings.program_id = programs.id AND recordings.deleted_at IS NULL)
+"""
+
+def main_db_path(con: Connection) -> Path | None:
+    """接続している本体の DB ファイル。:memory: なら None"""
+    for row in con.execute("PRAGMA database_list"):
+        if row[1] == "main":
+            return Path(row[2]) if row[2] else None
+    return None
+
+def archive_path(main_path: Path, year: int) -> Path:
+    """db/tv.db に対して db/archive/tv-2024.db"""
+    return main_path.parent / "archive" / f"{main_path.stem}-{year}.db"
+
+def list_archive_years(con: Connection) -> list[int]:
+    main_path = main_db_path(con)
+    if main_path is None:
+        return []
+    return archive_years_of_path(main_path)
+
+def archive_years_of_path(main_path: Path) -> list[int]:
+    """db/tv.db に対して db/archive/ にあるアーカイブの年"""
+    years = []
+    for path in (main_path.parent / "archive").glob(f"{main_path.stem}-*.db"):
+        m = re.fullmatch(re.escape(main_path.stem) + r"-(\d{4})\.db", path.name)
+        if m is not None:
+            years.append(int(m.group(1)))
+    return sorted(years)
+
+def archive_years_between(con: Connection, from_: datetime | None, to: datetime | None = None) -> list[int]:
+    """from_ から to までに掛かるアーカイブの年。from_ がなければ to 以前のすべて、どちらもなければ本体だけを読むので空"""
+    if not from_ and not to:
+        return []
+    return [
+        year for year in list_archive_years(con)
+        if (not from_ or from_.astimezone(JST).year <= year) and (not to or year <= to.astimezone(JST).year)
+    ]
+
+def archive_years_of_program(con: Connection, program_id: int | str) -> list[int]:
+    row = con.execute(f"SELECT {PROGRAM_YEAR} FROM programs WHERE id = ?", (program_id,)).fetchone()
+    if row is None:
+        return []
+    return [year for year in list_archive_years(con) if year == row[0]]
+
+@contextmanager
+def attach_archives(con: Connection, years: list[int]) -> Iterator[list[str]]:
+    """アーカイブを ATTACH し、スキーマ名を返す。抜けるときに DETACH する"""
+    main_path = main_db_path(con)
+    attached = {row[1] for row in con.execute("PRAGMA database_list")}
+    schemas, added = [], []
+    try:
+        for year in years:
+            schema = f"archive_{int(year)}"
+            if schema not in attached:
+                con.execute(f"ATTACH DATABASE ? AS {schema}", (str(archive_path(main_path, year)),))
+                added.append(schema)
+            schemas.append(schema)
+        yield schemas
+    finally:
+        for schema in added:
+            con.execute(f"DETACH DATABASE {schema}")
+
+def union_archives(table: str, schemas: list[str]) -> str:
+    """本体とアーカイブの table を同じ名前の CTE にまとめる WITH 句。アーカイブがなければ空文字
+       クエリの先頭に付ければ、table を参照している箇所がすべてアーカイブも含めて読むようになる
+    """
+    if not schemas:
+        return ""
+    columns = ARCHIVE_COLUMNS[table]
+    selects = [f"SELECT {columns} FROM main.{table}"] + [f"SELECT {columns} FROM {schema}.{table}" for schema in schemas]
+    return f"WITH {table} AS ({' UNION ALL '.join(selects)})"
+
+def archive_before(con: Connection, before: datetime, schema_path: str = ARCHIVE_SCHEMA_PATH) -> dict[int, int]:
+    """before より前に始まり、消していない録画がない番組の視聴区間と録画を、放送年ごとのアーカイブに移す
+       番組と視聴集計 (program_view_stats) は本体に残すので、一覧や番組ページはアーカイブを読まずに済む
+       移した番組数を年ごとに返す
+    """
+    main_path = main_db_path(con)
+    if main_path is None:
+        return {}
+    params = {"before": before}
+    counts = dict(con.execute(f"""
+        SELECT {PROGRAM_YEAR}, COUNT(*) FROM programs
+        WHERE {COLD_PROGRAMS}
+        AND (
+            EXISTS (SELECT 1 FROM main.view_segments WHERE view_segments.program_id = programs.id)
+            OR EXISTS (SELECT 1 FROM main.recordings WHERE recordings.program_id = programs.id)
+        )
+        GROUP BY 1
+    """, params).fetchall())
+    if not counts:
+        return {}
+
+    with open(schema_path) as f:
+        schema_sql = f.read()
+    (main_path.parent / "archive").mkdir(exist_ok=True)
+    with attach_archives(con, list(counts)) as schemas:
+        for schema in schemas:
+            con.executescript(schema_sql.replace("{SCHEMA}", schema))
+
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            con.execute(f"""
+                CREATE TEMP TABLE archive_programs AS
+                SELECT id, {PROGRAM_YEAR} AS year FROM programs WHERE {COLD_PROGRAMS}
+            """, params)
+            for year, schema in zip(counts, schemas):
+                for table, columns in ARCHIVE_COLUMNS.items():
+                    con.execute(f"""
+                        INSERT OR REPLACE INTO {schema}.{table}({columns})
+                        SELECT {columns} FROM main.{table}
+                        WHERE program_id IN (SELECT id FROM temp.archive_programs WHERE year = ?)
+                    """, (year,))
+
+            # 視聴区間を消すと集計が作り直されて空になるので、集計のトリガーを外して消す
+            triggers = con.execute(f"""
+                SELECT name, sql FROM sqlite_master
+                WHERE type = 'trigger' AND name IN ({", ".join("?" * len(ARCHIVE_SUSPENDED_TRIGGERS))})
+            """, ARCHIVE_SUSPENDED_TRIGGERS).fetchall()
+            for name, _ in triggers:
+                con.execute(f'DROP TRIGGER "{name}"')
+            for table in ARCHIVE_COLUMNS:
+                con.execute(f"DELETE FROM main.{table} WHERE program_id IN (SELECT id FROM temp.archive_programs)")
+            for _, sql in triggers:
+                con.execute(sql)
+
+            con.execute("DROP TABLE temp.archive_programs")
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+    return counts
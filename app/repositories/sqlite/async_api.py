@@ -0,0 +1,146 @@
+from datetime import datetime
+from sqlite3 import Connection
+import asyncio
+from ...models.api import ProgramBase, ProgramQueryParams, ProgramGet, ProgramSearchResult, ProgramSearchPage, ViewBase, ViewPost, ViewQueryParams, ViewGet, RecordingBase, RecordingPost, RecordingQueryParams, RecordingGet, RecordingSearchPage, SeriesQueryParams, SeriesSearchResult, SeriesWithPrograms, Digestion, DigestionQueryParams, StatsQueryParams, WatchStats
+from ..interfaces import AsyncProgramRepository, AsyncViewRepository, AsyncRecordingRepository, AsyncSeriesRepository, AsyncDigestionRepository, AsyncIngestRepository, AsyncStatsRepository
+from .api import SQLiteProgramRepository, SQLiteViewRepository, SQLiteRecordingRepository, SQLiteSeriesRepository, SQLiteDigestionRepository, SQLiteIngestRepository, SQLiteStatsRepository
+from ..cache import SeriesIdCache
+from .executor import SQLiteExecutor
+from .write_queue import SQLiteWriteQueue
+
+class SQLiteAsyncRepository:
+    """同期のリポジトリ (repository) を、SQLiteExecutor のスレッドが借りた接続で作って呼ぶ
+       args は接続のあとに渡す引数 (write_queue, series_cache など)。書き込むリポジトリは先頭を write_queue にする
+    """
+    repository: type
+
+    def __init__(self, executor: SQLiteExecutor, *args):
+        self.executor = executor
+        self.args = args
+
+    @property
+    def write_queue(self) -> SQLiteWriteQueue | None:
+        return self.args[0] if self.args else None
+
+    @property
+    def series_cache(self) -> SeriesIdCache | None:
+        return self.args[1] if len(self.args) > 1 else None
+
+    async def _call(self, method: str, *args, **kwargs):
+        return await self.executor.run(lambda con: getattr(self._repository(con), method)(*args, **kwargs))
+
+    async def _write(self, method: str, *args, **kwargs):
+        """書き込みは読み取り用のスレッドと接続を使わず、write_queue のスレッドに直接投入してコミットを待つ
+           キュー側では write_queue なしで作ったリポジトリで method を実行する。write_queue がなければ _call と同じ
+        """
+        if self.write_queue is None:
+            return await self._call(method, *args, **kwargs)
+        return await asyncio.wrap_future(self.write_queue.submit(
+            lambda con: getattr(self.repository(con, None, *self.args[1:]), method)(*args, **kwargs)))
+
+    def _repository(self, con: Connection):
+        return self.repository(con, *self.args)
+
+class SQLiteAsyncProgramRepository(SQLiteAsyncRepository, AsyncProgramRepository):
+    repository = SQLiteProgramRepository
+
+    async def search(self, params: ProgramQueryParams) -> list[ProgramSearchResult]:
+        return await self._call("search", params)
+
+    async def search_with_facets(self, params: ProgramQueryParams) -> ProgramSearchPage:
+        return await self._call("search_with_facets", params)
+
+    async def get_by_id(self, id: int) -> ProgramGet | None:
+        return await self._call("get_by_id", id)
+
+    async def get_or_create(self, program: ProgramBase, created_at: datetime, viewed_time: datetime) -> int:
+        return await self._write("get_or_create", program, created_at, viewed_time)
+
+    async def update(self, id: int, genre: str | None) -> None:
+        return await self._write("update", id, genre)
+
+class SQLiteAsyncViewRepository(SQLiteAsyncRepository, AsyncViewRepository):
+    repository = SQLiteViewRepository
+
+    async def search(self, params: ViewQueryParams) -> list[ViewGet]:
+        return await self._call("search", params)
+
+    async def create(self, program_id: int, view: ViewBase) -> None:
+        return await self._write("create", program_id, view)
+
+class SQLiteAsyncRecordingRepository(SQLiteAsyncRepository, AsyncRecordingRepository):
+    repository = SQLiteRecordingRepository
+
+    async def search(self, params: RecordingQueryParams) -> list[RecordingGet]:
+        return await self._call("search", params)
+
+    async def search_with_facets(self, params: RecordingQueryParams) -> RecordingSearchPage:
+        return await self._call("search_with_facets", params)
+
+    async def get_by_id(self, id: int) -> RecordingGet:
+        return await self._call("get_by_id", id)
+
+    async def create(self, recording: RecordingBase, program_id: int) -> int:
+        return await self._write("create", recording, program_id)
+
+    async def update_patch(self, id: int, patch: dict) -> bool:
+        return await self._write("update_patch", id, patch)
+
+class SQLiteAsyncSeriesRepository(SQLiteAsyncRepository, AsyncSeriesRepository):
+    repository = SQLiteSeriesRepository
+
+    async def search(self, params: SeriesQueryParams) -> list[SeriesSearchResult]:
+        return await self._call("search", params)
+
+    async def get_by_id(self, id: int | str, page: int = 1, size: int = 100) -> SeriesWithPrograms:
+        return await self._call("get_by_id", id, page=page, size=size)
+
+    async def get_or_create(self, name: str, created_at: datetime) -> int | str:
+        if self.series_cache is None:
+            return await self._write("_get_or_create", name, created_at)
+        generation = self.series_cache.generation
+        series_id = self.series_cache.get(name)
+        if series_id is None:
+            series_id = await self._write("_get_or_create", name, created_at)
+            self.series_cache.put(name, series_id, generation)
+        return series_id
+
+    async def add_program(self, series_id: int | str, program_id: int | str, at: datetime) -> None:
+        return await self._write("add_program", series_id, program_id, at)
+
+    async def update(self, series_id: int | str, name: str) -> None:
+        await self._write("_update", series_id, name)
+        if self.series_cache is not None:
+            self.series_cache.invalidate(name=name, series_id=series_id)
+
+    async def update_program_series(self, program_id: int | str, old_series_id: int | str, new_series_name: str) -> None:
+        await self._write("_update_program_series", program_id, old_series_id, new_series_name)
+        if self.series_cache is not None:
+            self.series_cache.invalidate(name=new_series_name)
+
+class SQLiteAsyncDigestionRepository(SQLiteAsyncRepository, AsyncDigestionRepository):
+    repository = SQLiteDigestionRepository
+
+    async def list_digestions(self, params: DigestionQueryParams) -> list[Digestion]:
+        return await self._call("list_digestions", params)
+
+class SQLiteAsyncIngestRepository(SQLiteAsyncRepository, AsyncIngestRepository):
+    repository = SQLiteIngestRepository
+
+    async def ingest_view(self, view: ViewPost) -> int:
+        return await self._write("ingest_view", view)
+
+    async def ingest_recording(self, recording: RecordingPost, series_name: str) -> RecordingGet:
+        if self.series_cache is None:
+            return (await self._write("_ingest_recording", recording, series_name, None))[0]
+        # コミットされてからキャッシュに入れる
+        generation = self.series_cache.generation
+        result, series_id = await self._write("_ingest_recording", recording, series_name, self.series_cache.get(series_name))
+        self.series_cache.put(series_name, series_id, generation)
+        return result
+
+class SQLiteAsyncStatsRepository(SQLiteAsyncRepository, AsyncStatsRepository):
+    repository = SQLiteStatsRepository
+
+    async def watch_stats(self, params: StatsQueryParams) -> list[WatchStats]:
+        return await self._call("watch_stats", params)
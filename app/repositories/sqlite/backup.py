@@ -0,0 +1,139 @@
+from datetime import datetime
+from pathlib import Path
+from sqlite3 import Connection
+from threading import Event, Lock, Thread
+from typing import Callable
+import gzip
+import shutil
+import sqlite3
+import time
+
+from ...models.api import JST, BackupStatus
+from .archive import archive_path, list_archive_years
+
+class SQLiteBackup:
+    """sqlite3 の online backup で DB を pages ページずつコピーし、gzip で圧縮したスナップショットを保存する
+       ステップの間に sleep 秒待つので、コピー中もリクエストの読み書きを止めない
+       コピー中に他の接続が書き込むと SQLite が最初からやり直すので、その回数も status に残す
+       放送年ごとのアーカイブ (db/archive/*.db) も同じ時刻のスナップショットとして backup_dir/archive/ に取る
+    """
+    def __init__(self, connect: Callable[[], Connection], backup_dir: str,
+                 pages: int = 256, sleep: float = 0.01, keep: int = 7):
+        self.pages = pages
+        self.sleep = sleep
+        self.keep = keep
+        self._connect = connect
+        self._backup_dir = Path(backup_dir)
+        self._status = BackupStatus()
+        self._running = Lock()
+        self._stopping = Event()
+        self._threads: list[Thread] = []
+
+    @property
+    def status(self) -> BackupStatus:
+        return self._status.model_copy()
+
+    def run(self) -> BackupStatus:
+        """スナップショットを1つ作って、その結果を返す。実行中なら待たずに今の status を返す"""
+        if not self._running.acquire(blocking=False):
+            return self.status
+        try:
+            self._status = BackupStatus(state="running", started_at=datetime.now(JST))
+            try:
+                self._backup()
+                self._status.state = "done"
+            except Exception as e:
+                self._status.state = "failed"
+                self._status.error = str(e)
+            self._status.finished_at = datetime.now(JST)
+            return self.status
+        finally:
+            self._running.release()
+
+    def start(self) -> BackupStatus:
+        """別スレッドで run する"""
+        if not self._running.locked():
+            self._spawn(self.run)
+        return self.status
+
+    def schedule(self, interval: float) -> None:
+        """interval 秒ごとに run する"""
+        def loop():
+            while not self._stopping.wait(interval):
+                self.run()
+        self._spawn(loop)
+
+    def close(self) -> None:
+        """スケジュールを止め、実行中のバックアップが終わるのを待つ"""
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _spawn(self, target: Callable[[], object]) -> None:
+        self._threads = [t for t in self._threads if t.is_alive()]
+        thread = Thread(target=target, name="sqlite-backup", daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def _backup(self) -> None:
+        self._backup_dir.mkdir(parents=True, exist_ok=True)
+        source = self._connect()
+        try:
+            main_path = Path(source.execute("PRAGMA database_list").fetchone()[2] or "memory.db")
+            years = list_archive_years(source)
+            path = self._snapshot(source, self._backup_dir / f"{main_path.stem}-{self._status.started_at:%Y%m%d-%H%M%S}.db.gz")
+        finally:
+            source.close()
+        self._status.path = str(path)
+        self._status.size = path.stat().st_size
+        self._prune(self._backup_dir, main_path.stem)
+
+        archive_dir = self._backup_dir / "archive"
+        for year in years:
+            archive_dir.mkdir(exist_ok=True)
+            stem = archive_path(main_path, year).stem
+            source = sqlite3.connect(archive_path(main_path, year))
+            try:
+                path = self._snapshot(source, archive_dir / f"{stem}-{self._status.started_at:%Y%m%d-%H%M%S}.db.gz")
+            finally:
+                source.close()
+            self._status.archives.append(str(path))
+            self._prune(archive_dir, stem)
+
+    def _snapshot(self, source: Connection, path: Path) -> Path:
+        """source を少しずつコピーしてから gzip で path に圧縮する。所要時間は status に足していく"""
+        copy_path = path.with_suffix(".tmp")
+        self._status.pages_remaining = None
+        started = time.monotonic()
+        target = sqlite3.connect(copy_path)
+        try:
+            source.backup(target, pages=self.pages, progress=self._progress)
+        finally:
+            target.close()
+        self._status.copy_seconds = (self._status.copy_seconds or 0) + time.monotonic() - started
+
+        started = time.monotonic()
+        try:
+            with open(copy_path, "rb") as src, gzip.open(path, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+        finally:
+            copy_path.unlink(missing_ok=True)
+        self._status.compress_seconds = (self._status.compress_seconds or 0) + time.monotonic() - started
+        return path
+
+    def _progress(self, status: int, remaining: int, total: int) -> None:
+        if self._status.pages_remaining is not None and remaining > self._status.pages_remaining:
+            self._status.restarts += 1
+        self._status.steps += 1
+        self._status.pages_total = total
+        self._status.pages_remaining = remaining
+        # ステップの合間に他の接続へロックを譲る
+        if remaining:
+            time.sleep(self.sleep)
+
+    def _prune(self, directory: Path, stem: str) -> None:
+        """新しいほうから keep 個だけ残す"""
+        snapshots = sorted(directory.glob(f"{stem}-????????-??????.db.gz"))
+        for path in snapshots[:-self.keep] if self.keep > 0 else []:
+            path.unlink()
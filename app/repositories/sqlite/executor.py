@@ -0,0 +1,27 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AbstractContextManager
+from sqlite3 import Connection
+from typing import Callable, TypeVar
+import asyncio
+
+T = TypeVar("T")
+
+class SQLiteExecutor:
+    """接続を使う処理を専用のスレッドで実行し、await できるようにする
+       スレッド数は読み取り用の接続の数にするので、接続を待ってスレッドが詰まることはない
+       AnyIO のスレッドプールは使わないので、同時に受けられるリクエストの数はその上限に縛られない
+    """
+    def __init__(self, reader: Callable[[], AbstractContextManager[Connection]], workers: int = 4):
+        self._reader = reader
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sqlite-reader")
+
+    async def run(self, operation: Callable[[Connection], T]) -> T:
+        """読み取り用の接続を借りて operation(con) を実行し、その結果を返す"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._call, operation)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+
+    def _call(self, operation: Callable[[Connection], T]) -> T:
+        with self._reader() as con:
+            return operation(con)
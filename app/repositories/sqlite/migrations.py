@@ -0,0 +1,45 @@
+from pathlib import Path
+from sqlite3 import Connection
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_PATH = "db/sqlite/schemas.sql"
+MIGRATIONS_DIR = "db/sqlite/migrations"
+
+def list_migrations(migrations_dir: str = MIGRATIONS_DIR) -> list[tuple[int, Path]]:
+    """NNNN_name.sql をバージョン順に返す"""
+    migrations = []
+    for path in Path(migrations_dir).glob("*.sql"):
+        m = re.match(r"(\d+)_", path.name)
+        if m is None:
+            continue
+        migrations.append((int(m.group(1)), path))
+    migrations.sort()
+
+    versions = [v for v, _ in migrations]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError(f"Duplicate migration version in {migrations_dir}")
+    return migrations
+
+def migrate(con: Connection, schema_path: str = SCHEMA_PATH, migrations_dir: str = MIGRATIONS_DIR) -> int:
+    """schemas.sql を流したあと、未適用のマイグレーションを PRAGMA user_version 順に適用する
+       各マイグレーションは user_version の更新と同じトランザクションで実行する
+    """
+    with open(schema_path) as f:
+        con.executescript(f.read())
+
+    version, = con.execute("PRAGMA user_version").fetchone()
+    for v, path in list_migrations(migrations_dir):
+        if v <= version:
+            continue
+        logger.info("Applying migration %s", path.name)
+        try:
+            con.executescript(f"BEGIN;\n{path.read_text()}\nPRAGMA user_version = {v};\nCOMMIT;")
+        except Exception:
+            if con.in_transaction:
+                con.rollback()
+            raise
+        version = v
+    return version
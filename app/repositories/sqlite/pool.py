@@ -0,0 +1,57 @@
+from contextlib import contextmanager
+from queue import Empty, Queue
+from sqlite3 import Connection
+from threading import Lock
+from typing import Callable, Iterator
+
+class SQLiteConnectionPool:
+    """読み取り用の接続を複数と、書き込み用の接続を1本だけ持つ
+       WAL なので読み取りは書き込みを待たない。書き込みはこのプロセス内で直列にする
+    """
+    def __init__(self, connect: Callable[[], Connection], readers: int = 4, timeout: float = 30):
+        self.timeout = timeout
+        self._writer = connect()
+        self._writer.execute("PRAGMA journal_mode = WAL")
+        self._writer_lock = Lock()
+        self._readers: Queue[Connection] = Queue()
+        for _ in range(readers):
+            con = connect()
+            con.execute("PRAGMA query_only = ON")
+            self._readers.put(con)
+        self._size = readers
+
+    @property
+    def size(self) -> int:
+        """読み取り用の接続の数"""
+        return self._size
+
+    @contextmanager
+    def reader(self) -> Iterator[Connection]:
+        try:
+            con = self._readers.get(timeout=self.timeout)
+        except Empty:
+            raise TimeoutError("No SQLite reader connection available")
+        try:
+            yield con
+        finally:
+            if con.in_transaction:
+                con.rollback()
+            self._readers.put(con)
+
+    @contextmanager
+    def writer(self) -> Iterator[Connection]:
+        if not self._writer_lock.acquire(timeout=self.timeout):
+            raise TimeoutError("SQLite writer connection is busy")
+        try:
+            yield self._writer
+        finally:
+            # コミットされなかった書き込みは次の利用者に持ち越さない
+            if self._writer.in_transaction:
+                self._writer.rollback()
+            self._writer_lock.release()
+
+    def close(self) -> None:
+        for _ in range(self._size):
+            self._readers.get(timeout=self.timeout).close()
+        with self._writer_lock:
+            self._writer.close()
@@ -0,0 +1,86 @@
+import pytest
+from datetime import datetime
+from app.dependencies import make_db_connection
+from app.models.api import JST, AnalyticsQueryParams
+from app.repositories.sqlite.analytics import ANALYTICS_QUERIES, DuckDBAnalytics
+from app.repositories.sqlite.archive import archive_before
+from app.repositories.sqlite.migrations import migrate
+
+duckdb = pytest.importorskip("duckdb")
+
+@pytest.fixture
+def db_path(tmp_path):
+    # sqlite 拡張はなければ取得するので、オフラインで入っていない環境では試せない
+    try:
+        duckdb.connect().execute("INSTALL sqlite").execute("LOAD sqlite")
+    except duckdb.Error:
+        pytest.skip("DuckDB の sqlite 拡張を読めない")
+    path = tmp_path / "tv.db"
+    con = make_db_connection(str(path))
+    migrate(con)
+    con.executescript("""
+        INSERT INTO programs(id, event_id, service_id, name, start_time, duration, created_at) VALUES
+            (1, 11, 101, 'p1', unixepoch('2025-05-12T21:00:00+09:00'), 600, 0)
+          , (2, 12, 101, 'p2', unixepoch('2025-05-12T21:10:00+09:00'), 1800, 0)
+          , (3, 13, 101, 'p3', unixepoch('2025-05-13T08:00:00+09:00'), 600, 0)
+        ;
+        INSERT INTO series(id, name, created_at, modified_at) VALUES (1, 'series1', 0, 0);
+        INSERT INTO program_series(program_id, series_id) VALUES (1, 1), (2, 1), (3, 1);
+        INSERT INTO views(program_id, viewed_time, speed, created_at) VALUES
+            (1, unixepoch('2025-05-12T21:05:00+09:00'), NULL, 0)
+          , (1, unixepoch('2025-05-12T21:10:00+09:00'), NULL, 0)
+          , (2, unixepoch('2025-05-12T21:15:00+09:00'), NULL, 0)
+          , (3, unixepoch('2025-05-13T08:05:00+09:00'), NULL, 0)
+        ;
+    """)
+    con.commit()
+    con.close()
+    return path
+
+@pytest.mark.parametrize("source", ["sqlite", "parquet"])
+def test_query_DBとスナップショットで同じ結果を返す(db_path, tmp_path, source):
+    analytics = DuckDBAnalytics(str(db_path), str(tmp_path / "analytics"), source)
+    if source == "parquet":
+        analytics.snapshot()
+    try:
+        params = AnalyticsQueryParams()
+        assert analytics.query("hour_of_day", params).rows == [
+            {"hour": 8, "watched_hours": 5 / 60, "programs": 1},
+            {"hour": 21, "watched_hours": 15 / 60, "programs": 2},
+        ]
+        sessions = analytics.query("binge_sessions", AnalyticsQueryParams(min_programs=2)).rows
+        assert sessions == [{
+            "started_at": datetime(2025, 5, 12, 21, 0, tzinfo=JST),
+            "ended_at": datetime(2025, 5, 12, 21, 15, tzinfo=JST),
+            "programs": 2,
+            "watched_hours": 15 / 60,
+        }]
+        completion = analytics.query("series_completion", AnalyticsQueryParams()).rows
+        assert [(r["series_id"], r["programs"], r["started"], r["finished"]) for r in completion] == [(1, 3, 3, 1)]
+    finally:
+        analytics.close()
+
+@pytest.mark.parametrize("source", ["sqlite", "parquet"])
+def test_query_アーカイブに移した視聴も集計する(db_path, tmp_path, source):
+    con = make_db_connection(str(db_path))
+    assert archive_before(con, datetime(2025, 5, 13, tzinfo=JST)) == {2025: 2}
+    con.close()
+    analytics = DuckDBAnalytics(str(db_path), str(tmp_path / "analytics"), source)
+    if source == "parquet":
+        analytics.snapshot()
+    try:
+        assert analytics.query("hour_of_day", AnalyticsQueryParams()).rows == [
+            {"hour": 8, "watched_hours": 5 / 60, "programs": 1},
+            {"hour": 21, "watched_hours": 15 / 60, "programs": 2},
+        ]
+    finally:
+        analytics.close()
+
+def test_snapshot_古いスナップショットを消す(db_path, tmp_path):
+    analytics = DuckDBAnalytics(str(db_path), str(tmp_path / "analytics"), keep=1)
+    first = analytics.snapshot()
+    (tmp_path / "analytics" / "00000000-000000").mkdir()
+    second = analytics.snapshot()
+    assert analytics.list_snapshots() == [second]
+    assert sorted(p.name for p in second.iterdir()) == sorted(f"{t}.parquet" for t in ["programs", "view_segments", "program_view_stats", "series", "program_series"])
+    assert set(ANALYTICS_QUERIES) == {"hour_of_day", "binge_sessions", "series_completion"}
@@ -0,0 +1,70 @@
+import pytest
+from datetime import datetime
+from app.dependencies import make_db_connection
+from app.models.api import JST, RecordingQueryParams, ViewQueryParams
+from app.repositories.sqlite.api import SQLiteRecordingRepository, SQLiteViewRepository
+from app.repositories.sqlite.archive import archive_before, archive_path, archive_years_between, list_archive_years
+from app.repositories.sqlite.migrations import migrate
+
+@pytest.fixture
+def con(tmp_path):
+    con = make_db_connection(str(tmp_path / "tv.db"))
+    migrate(con)
+    con.executescript("""
+        INSERT INTO programs(id, event_id, service_id, name, start_time, duration, created_at) VALUES
+            (1, 11, 101, 'old', unixepoch('2023-05-12T12:00:00+09:00'), 1800, unixepoch('2023-05-12T12:00:00+09:00'))
+          , (2, 12, 101, 'old but kept', unixepoch('2023-05-13T12:00:00+09:00'), 1800, unixepoch('2023-05-13T12:00:00+09:00'))
+          , (3, 13, 101, 'new', unixepoch('2025-05-12T12:00:00+09:00'), 1800, unixepoch('2025-05-12T12:00:00+09:00'))
+        ;
+        INSERT INTO recordings(id, program_id, file_path, watched_at, deleted_at, created_at) VALUES
+            (1, 1, '//server/recorded/old', unixepoch('2023-05-13T00:00:00+09:00'), unixepoch('2023-05-14T00:00:00+09:00'), unixepoch('2023-05-12T12:30:00+09:00'))
+          , (2, 2, '//server/recorded/kept', NULL, NULL, unixepoch('2023-05-13T12:30:00+09:00'))
+          , (3, 3, '//server/recorded/new', NULL, NULL, unixepoch('2025-05-12T12:30:00+09:00'))
+        ;
+        INSERT INTO views(program_id, viewed_time, speed, created_at) VALUES
+            (1, unixepoch('2023-05-12T12:05:00+09:00'), NULL, unixepoch('2023-05-12T12:05:00+09:00'))
+          , (1, unixepoch('2023-05-12T12:10:00+09:00'), NULL, unixepoch('2023-05-12T12:10:00+09:00'))
+          , (3, unixepoch('2025-05-12T12:05:00+09:00'), NULL, unixepoch('2025-05-12T12:05:00+09:00'))
+        ;
+    """)
+    yield con
+    con.close()
+
+def test_archive_before_消していない録画がない古い番組だけ移す(con, tmp_path):
+    assert archive_before(con, datetime(2024, 1, 1, tzinfo=JST)) == {2023: 1}
+
+    assert archive_path(tmp_path / "tv.db", 2023).exists()
+    assert list_archive_years(con) == [2023]
+    assert [row[0] for row in con.execute("SELECT id FROM recordings ORDER BY id")] == [2, 3]
+    assert [row[0] for row in con.execute("SELECT DISTINCT program_id FROM view_segments")] == [3]
+    # 集計は本体に残る
+    assert con.execute("SELECT view_count FROM program_view_stats WHERE program_id = 1").fetchone()[0] == 2
+    # 2回目は何も移さない
+    assert archive_before(con, datetime(2024, 1, 1, tzinfo=JST)) == {}
+    assert [row[1] for row in con.execute("PRAGMA database_list") if row[1].startswith("archive_")] == []
+
+def test_archive_before_過去にさかのぼるときだけアーカイブを読む(con):
+    archive_before(con, datetime(2024, 1, 1, tzinfo=JST))
+    views = SQLiteViewRepository(con)
+    recordings = SQLiteRecordingRepository(con)
+
+    assert [v.program_id for v in views.search(ViewQueryParams(program_id=1))] == [1, 1]
+    assert [v.program_id for v in views.search(ViewQueryParams())] == [3]
+
+    assert [r.id for r in recordings.search(RecordingQueryParams(deleted=True, watched=True))] == [3, 2]
+    from_2023 = RecordingQueryParams(**{"deleted": True, "watched": True, "from": datetime(2023, 1, 1, tzinfo=JST)})
+    assert [r.id for r in recordings.search(from_2023)] == [3, 2, 1]
+    assert recordings.get_by_id(1).program.name == "old"
+    assert [row[1] for row in con.execute("PRAGMA database_list") if row[1].startswith("archive_")] == []
+
+def test_archive_years_between_fromがなければto以前のすべて(con):
+    archive_before(con, datetime(2024, 1, 1, tzinfo=JST))
+    assert archive_years_between(con, None) == []
+    assert archive_years_between(con, None, datetime(2023, 12, 31, tzinfo=JST)) == [2023]
+    assert archive_years_between(con, None, datetime(2022, 12, 31, tzinfo=JST)) == []
+    assert archive_years_between(con, datetime(2024, 1, 1, tzinfo=JST)) == []
+
+def test_archive_before_移した番組の時間が変わっても集計を残す(con):
+    archive_before(con, datetime(2024, 1, 1, tzinfo=JST))
+    con.execute("UPDATE programs SET duration = 3600 WHERE id = 1")
+    assert con.execute("SELECT view_count FROM program_view_stats WHERE program_id = 1").fetchone()[0] == 2
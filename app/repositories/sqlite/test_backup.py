@@ -0,0 +1,76 @@
+import gzip
+import sqlite3
+from app.dependencies import make_db_connection
+from app.repositories.sqlite.backup import SQLiteBackup
+from app.repositories.sqlite.migrations import migrate
+
+def make_db(tmp_path):
+    db_path = str(tmp_path / "tv.db")
+    con = make_db_connection(db_path)
+    migrate(con)
+    con.executemany(
+        "INSERT INTO programs(event_id, service_id, name, start_time, duration, created_at) VALUES (?, 101, ?, ?, 1800, 0)",
+        [(i, "x" * 1000, i * 86400) for i in range(200)])
+    con.commit()
+    con.close()
+    return db_path
+
+def test_backup_少しずつコピーして圧縮したスナップショットを作る(tmp_path):
+    db_path = make_db(tmp_path)
+    backup = SQLiteBackup(lambda: make_db_connection(db_path), str(tmp_path / "backup"), pages=8, sleep=0)
+
+    status = backup.run()
+
+    assert status.state == "done", status.error
+    assert status.steps > 1
+    assert status.pages_remaining == 0
+    assert status.progress == 1.0
+    assert status.copy_seconds is not None and status.compress_seconds is not None
+    restored = tmp_path / "restored.db"
+    with gzip.open(status.path) as src:
+        restored.write_bytes(src.read())
+    con = sqlite3.connect(restored)
+    assert con.execute("SELECT COUNT(*) FROM programs").fetchone()[0] == 200
+    con.close()
+    assert list((tmp_path / "backup").glob("*.tmp")) == []
+
+def test_backup_古いスナップショットはkeep個だけ残す(tmp_path):
+    db_path = make_db(tmp_path)
+    for name in ["tv-20250101-000000.db.gz", "tv-20250102-000000.db.gz"]:
+        (tmp_path / "backup").mkdir(exist_ok=True)
+        (tmp_path / "backup" / name).write_bytes(b"")
+    backup = SQLiteBackup(lambda: make_db_connection(db_path), str(tmp_path / "backup"), keep=2)
+
+    status = backup.run()
+
+    assert sorted(p.name for p in (tmp_path / "backup").iterdir()) == ["tv-20250102-000000.db.gz", status.path.split("/")[-1]]
+
+def test_backup_startは別スレッドで実行する(tmp_path):
+    db_path = make_db(tmp_path)
+    backup = SQLiteBackup(lambda: make_db_connection(db_path, check_same_thread=False), str(tmp_path / "backup"))
+
+    backup.start()
+    backup.close()
+
+    assert backup.status.state == "done"
+
+def test_backup_アーカイブも同じ時刻のスナップショットを取る(tmp_path):
+    db_path = make_db(tmp_path)
+    (tmp_path / "archive").mkdir()
+    archive = sqlite3.connect(tmp_path / "archive" / "tv-2023.db")
+    archive.execute("CREATE TABLE view_segments(id INTEGER PRIMARY KEY)")
+    archive.execute("INSERT INTO view_segments VALUES (1)")
+    archive.commit()
+    archive.close()
+    backup = SQLiteBackup(lambda: make_db_connection(db_path), str(tmp_path / "backup"), pages=8, sleep=0)
+
+    status = backup.run()
+
+    assert status.state == "done", status.error
+    assert [p.split("/")[-1] for p in status.archives] == [f"tv-2023-{status.started_at:%Y%m%d-%H%M%S}.db.gz"]
+    restored = tmp_path / "restored.db"
+    with gzip.open(status.archives[0]) as src:
+        restored.write_bytes(src.read())
+    con = sqlite3.connect(restored)
+    assert con.execute("SELECT COUNT(*) FROM view_segments").fetchone()[0] == 1
+    con.close()
@@ -0,0 +1,91 @@
+import asyncio
+import pytest
+import threading
+from datetime import datetime
+from app.dependencies import make_db_connection
+from app.models.api import JST, ProgramBase, ProgramQueryParams, ViewPost
+from app.repositories.sqlite.async_api import SQLiteAsyncIngestRepository, SQLiteAsyncProgramRepository
+from app.repositories.sqlite.executor import SQLiteExecutor
+from app.repositories.sqlite.migrations import migrate
+from app.repositories.sqlite.pool import SQLiteConnectionPool
+from app.repositories.sqlite.write_queue import SQLiteWriteQueue
+
+@pytest.fixture
+def pool(tmp_path):
+    db_path = str(tmp_path / "tv.db")
+    con = make_db_connection(db_path)
+    migrate(con)
+    con.close()
+    pool = SQLiteConnectionPool(lambda: make_db_connection(db_path, check_same_thread=False), readers=2)
+    yield pool
+    pool.close()
+
+def test_executor_待っている間もイベントループを止めない(pool):
+    executor = SQLiteExecutor(pool.reader, workers=pool.size)
+    release = threading.Event()
+    threads = set()
+
+    def blocking(con):
+        threads.add(threading.current_thread().name)
+        release.wait(timeout=5)
+        return con.execute("SELECT 1").fetchone()[0]
+
+    async def main():
+        tasks = [asyncio.create_task(executor.run(blocking)) for _ in range(2)]
+        # 2つとも接続を持って止まっていても、ループ上の処理は進む
+        await asyncio.sleep(0.05)
+        assert not any(task.done() for task in tasks)
+        release.set()
+        return await asyncio.gather(*tasks)
+
+    try:
+        assert asyncio.run(main()) == [1, 1]
+        assert len(threads) == 2 and all(name.startswith("sqlite-reader") for name in threads)
+    finally:
+        executor.close()
+
+def test_async_repository_書き込みキューを通して取り込み読める(pool):
+    executor = SQLiteExecutor(pool.reader, workers=pool.size)
+    write_queue = SQLiteWriteQueue(pool.writer)
+    program = ProgramBase(
+        event_id=11, service_id=101, name="p", start_time=datetime(2025, 5, 12, 21, 0, tzinfo=JST), duration=1800)
+
+    async def main():
+        ingest = SQLiteAsyncIngestRepository(executor, write_queue)
+        await asyncio.gather(*[
+            ingest.ingest_view(ViewPost(program=program, viewed_time=datetime(2025, 5, 12, 21, m, tzinfo=JST)))
+            for m in (5, 10, 15)
+        ])
+        return await SQLiteAsyncProgramRepository(executor).search(ProgramQueryParams())
+
+    try:
+        programs = asyncio.run(main())
+        assert [(p.name, len(p.viewed_times)) for p in programs] == [("p", 3)]
+    finally:
+        write_queue.close()
+        executor.close()
+
+def test_async_repository_書き込みは読み取りのスレッドを使わない(pool):
+    executor = SQLiteExecutor(pool.reader, workers=pool.size)
+    write_queue = SQLiteWriteQueue(pool.writer)
+    release = threading.Event()
+    program = ProgramBase(
+        event_id=11, service_id=101, name="p", start_time=datetime(2025, 5, 12, 21, 0, tzinfo=JST), duration=1800)
+
+    async def main():
+        # 読み取りのスレッドをすべて止めていても、取り込みは書き込み用のスレッドでコミットされる
+        readers = [asyncio.create_task(executor.run(lambda con: release.wait(timeout=5))) for _ in range(pool.size)]
+        await asyncio.sleep(0.05)
+        ingest = SQLiteAsyncIngestRepository(executor, write_queue)
+        program_id = await asyncio.wait_for(
+            ingest.ingest_view(ViewPost(program=program, viewed_time=datetime(2025, 5, 12, 21, 5, tzinfo=JST))), timeout=2)
+        release.set()
+        await asyncio.gather(*readers)
+        return program_id
+
+    try:
+        assert asyncio.run(main()) == 1
+    finally:
+        release.set()
+        write_queue.close()
+        executor.close()
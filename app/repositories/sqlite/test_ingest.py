@@ -0,0 +1,66 @@
+from contextlib import contextmanager
+import pytest
+from datetime import datetime
+from app.models.api import JST, ProgramBase, RecordingPost, ViewPost
+from app.repositories.exceptions import InvalidDataError
+from app.repositories.cache import SeriesIdCache
+from app.repositories.sqlite.api import SQLiteIngestRepository, SQLiteSeriesRepository
+from app.repositories.sqlite.write_queue import SQLiteWriteQueue
+
+AT = datetime(2025, 5, 12, 12, 30, tzinfo=JST)
+PROGRAM = ProgramBase(event_id=11, service_id=101, name="Test Program", start_time=datetime(2025, 5, 12, 12, 0, tzinfo=JST), duration=1800)
+
+def count(con, table):
+    return con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+def test_ingest_recording_番組と録画とシリーズをまとめて登録する(con):
+    recording = SQLiteIngestRepository(con).ingest_recording(
+        RecordingPost(program=PROGRAM, file_path="//server/recorded/test1", created_at=AT), "series1")
+
+    assert recording.program.name == "Test Program"
+    assert recording.file_folder == "recorded"
+    assert not con.in_transaction
+    assert con.execute("""
+        SELECT series.name FROM program_series INNER JOIN series ON series.id = program_series.series_id
+        WHERE program_series.program_id = ?
+    """, (recording.program.id,)).fetchone()[0] == "series1"
+
+def test_ingest_recording_途中で失敗したらすべて取り消す(con):
+    with pytest.raises(InvalidDataError):
+        SQLiteIngestRepository(con).ingest_recording(
+            RecordingPost(program=PROGRAM, file_path="//server/recorded/test1", created_at=AT), "")
+
+    assert not con.in_transaction
+    assert count(con, "programs") == 0
+    assert count(con, "recordings") == 0
+
+def test_ingest_view_書き込みキュー経由で登録する(con):
+    @contextmanager
+    def writer():
+        yield con
+    queue = SQLiteWriteQueue(writer)
+    program_id = SQLiteIngestRepository(con, queue).ingest_view(ViewPost(program=PROGRAM, viewed_time=AT))
+    queue.close()
+
+    assert count(con, "programs") == 1
+    assert con.execute("SELECT view_count FROM program_view_stats WHERE program_id = ?", (program_id,)).fetchone()[0] == 1
+
+def test_ingest_recording_知っているシリーズは名前で引かない(con):
+    cache = SeriesIdCache()
+    repo = SQLiteIngestRepository(con, series_cache=cache)
+    repo.ingest_recording(RecordingPost(program=PROGRAM, file_path="//server/recorded/test1", created_at=AT), "series1")
+    series_id = cache.get("series1")
+    assert series_id is not None
+
+    statements = []
+    con.set_trace_callback(statements.append)
+    repo.ingest_recording(RecordingPost(program=PROGRAM, file_path="//server/recorded/test2", created_at=AT), "series1")
+    con.set_trace_callback(None)
+    assert not [s for s in statements if "FROM series WHERE name" in s]
+
+    # リネームしたら古い名前の対応は使わない
+    SQLiteSeriesRepository(con, series_cache=cache).update(series_id, "series2")
+    assert cache.get("series1") is None
+    repo.ingest_recording(RecordingPost(program=PROGRAM, file_path="//server/recorded/test3", created_at=AT), "series1")
+    assert cache.get("series1") not in (None, series_id)
+    assert count(con, "series") == 2
@@ -0,0 +1,145 @@
+import pytest
+import sqlite3
+from app.dependencies import make_db_connection
+from app.repositories.sqlite.migrations import list_migrations, migrate
+
+def test_migrate_最新バージョンまで適用して再実行では何もしない(tmp_path):
+    (tmp_path / "0001_a.sql").write_text("CREATE TABLE a(x INTEGER);")
+    (tmp_path / "0002_b.sql").write_text("INSERT INTO a VALUES(1);")
+    con = make_db_connection(":memory:")
+
+    assert migrate(con, migrations_dir=str(tmp_path)) == 2
+    assert migrate(con, migrations_dir=str(tmp_path)) == 2
+    assert con.execute("SELECT COUNT(*) FROM a").fetchone()[0] == 1
+
+def test_migrate_失敗したマイグレーションはバージョンを進めない(tmp_path):
+    (tmp_path / "0001_a.sql").write_text("CREATE TABLE a(x INTEGER);")
+    (tmp_path / "0002_b.sql").write_text("INSERT INTO a VALUES(1); INSERT INTO missing VALUES(1);")
+    con = make_db_connection(":memory:")
+
+    with pytest.raises(sqlite3.OperationalError):
+        migrate(con, migrations_dir=str(tmp_path))
+    assert con.execute("PRAGMA user_version").fetchone()[0] == 1
+    assert con.execute("SELECT COUNT(*) FROM a").fetchone()[0] == 0
+
+def test_migrate_同梱のマイグレーション(con):
+    latest, _ = list_migrations()[-1]
+    assert con.execute("PRAGMA user_version").fetchone()[0] == latest
+
+def test_migrate_既存の録画にfile_folderを生成する(tmp_path):
+    for v, path in list_migrations():
+        if v < 3:
+            (tmp_path / path.name).write_text(path.read_text())
+    con = make_db_connection(":memory:")
+    migrate(con, migrations_dir=str(tmp_path))
+    con.executescript("""
+        INSERT INTO recordings(id, program_id, file_path, created_at) VALUES
+            (1, 1, '//server/recorded/test1', 0)
+          , (2, 1, '', 0)
+        ;
+    """)
+
+    migrate(con)
+    rows = con.execute("SELECT id, server, file_folder FROM recordings ORDER BY id").fetchall()
+    assert [tuple(row) for row in rows] == [(1, "server", "recorded"), (2, None, None)]
+
+def test_migrate_同じ放送の重複番組を1件にまとめる(tmp_path):
+    for v, path in list_migrations():
+        if v < 4:
+            (tmp_path / path.name).write_text(path.read_text())
+    con = make_db_connection(":memory:")
+    migrate(con, migrations_dir=str(tmp_path))
+    con.executescript("""
+        INSERT INTO programs(id, event_id, service_id, name, start_time, duration, created_at) VALUES
+            (1, 11, 101, 'Program', unixepoch('2025-05-12T12:00:00+09:00'), 1800, 0)
+          , (2, 11, 101, 'Program (delayed)', unixepoch('2025-05-12T12:10:00+09:00'), 1800, 0)
+          , (3, 11, 101, 'Program next week', unixepoch('2025-05-19T12:00:00+09:00'), 1800, 0)
+        ;
+        INSERT INTO views(program_id, viewed_time, created_at) VALUES (1, 1, 1), (2, 2, 2);
+        INSERT INTO recordings(id, program_id, file_path, created_at) VALUES (1, 1, '//server/recorded/test1', 0);
+        INSERT INTO series(id, name, created_at, modified_at) VALUES (1, 'series1', 0, 0);
+        INSERT INTO program_series(program_id, series_id) VALUES (1, 1), (2, 1);
+    """)
+
+    migrate(con)
+    assert [row["name"] for row in con.execute("SELECT name FROM programs ORDER BY id")] == ["Program (delayed)", "Program next week"]
+    assert con.execute("SELECT view_count FROM program_view_stats WHERE program_id = 2").fetchone()[0] == 2
+    assert con.execute("SELECT program_id FROM recordings").fetchone()[0] == 2
+    assert [tuple(row) for row in con.execute("SELECT program_id, series_id FROM program_series")] == [(2, 1)]
+    with pytest.raises(sqlite3.IntegrityError):
+        con.execute("INSERT INTO programs(event_id, service_id, name, start_time, duration, created_at) VALUES (11, 101, 'dup', unixepoch('2025-05-12T18:00:00+09:00'), 60, 0)")
+
+def test_migrate_既存の視聴を区間にまとめる(tmp_path):
+    for v, path in list_migrations():
+        if v < 5:
+            (tmp_path / path.name).write_text(path.read_text())
+    con = make_db_connection(":memory:")
+    migrate(con, migrations_dir=str(tmp_path))
+    con.executescript("""
+        INSERT INTO views(program_id, viewed_time, speed, created_at) VALUES
+            (1, 0, NULL, 10), (1, 300, NULL, 310), (1, 600, NULL, 610)
+          , (1, 1800, NULL, 1810)
+          , (1, 2100, 1.5, 2110)
+          , (2, 300, NULL, 310)
+        ;
+    """)
+
+    migrate(con)
+    rows = con.execute("SELECT program_id, start_time, end_time, speed, samples FROM view_segments ORDER BY program_id, start_time").fetchall()
+    assert [tuple(row) for row in rows] == [
+        (1, 0, 600, None, 3),
+        (1, 1800, 1800, None, 1),
+        (1, 2100, 2100, 1.5, 1),
+        (2, 300, 300, None, 1),
+    ]
+    assert con.execute("SELECT view_count FROM program_view_stats WHERE program_id = 1").fetchone()[0] == 5
+    assert [tuple(row) for row in con.execute("SELECT viewed_time, created_at FROM views WHERE program_id = 2")] == [(300, 310)]
+
+def test_migrate_既存の視聴から視聴済みの分を作る(tmp_path):
+    for v, path in list_migrations():
+        if v < 6:
+            (tmp_path / path.name).write_text(path.read_text())
+    con = make_db_connection(":memory:")
+    migrate(con, migrations_dir=str(tmp_path))
+    con.executescript("""
+        INSERT INTO programs(id, event_id, service_id, name, start_time, duration, created_at) VALUES
+            (1, 11, 101, 'p1', 0, 1800, 0)
+        ;
+        INSERT INTO views(program_id, viewed_time, speed, created_at) VALUES
+            (1, 300, NULL, 310), (1, 600, NULL, 610)
+        ;
+    """)
+
+    migrate(con)
+    bitmap, minutes = con.execute("SELECT watched_bitmap, watched_minutes FROM program_view_stats WHERE program_id = 1").fetchone()
+    assert minutes == 10
+    assert bitmap == b"\xff\x03\x00\x00"
+
+def test_migrate_既存の視聴から日次集計を作る(tmp_path):
+    for v, path in list_migrations():
+        if v < 7:
+            (tmp_path / path.name).write_text(path.read_text())
+    con = make_db_connection(":memory:")
+    migrate(con, migrations_dir=str(tmp_path))
+    con.executescript("""
+        INSERT INTO programs(id, event_id, service_id, name, start_time, duration, genre, created_at) VALUES
+            (1, 11, 101, 'p1', 0, 600, 'news', 0)
+          , (2, 12, 102, 'p2', 86400, 1800, NULL, 0)
+        ;
+        INSERT INTO series(id, name, created_at, modified_at) VALUES (1, 'series1', 0, 0);
+        INSERT INTO program_series(program_id, series_id) VALUES (1, 1);
+        INSERT INTO views(program_id, viewed_time, speed, created_at) VALUES
+            (1, 300, NULL, 310), (1, 600, NULL, 610)
+          , (2, 86400 + 300, 2.0, 86400 + 310)
+        ;
+    """)
+
+    migrate(con)
+    rows = con.execute("SELECT * FROM daily_watch_stats ORDER BY day").fetchall()
+    assert [tuple(row) for row in rows] == [
+        (0, 1, "news", 101, 600.0, 1, 1),
+        (1, 0, "", 102, 600.0, 1, 0),
+    ]
+    # 以降はトリガーで足し込む
+    con.execute("INSERT INTO views(program_id, viewed_time, speed, created_at) VALUES (2, 86400 + 600, 2.0, 86400 + 610)")
+    assert con.execute("SELECT watched_seconds, programs_started FROM daily_watch_stats WHERE day = 1").fetchone()[:] == (1200.0, 1)
@@ -0,0 +1,54 @@
+import pytest
+import sqlite3
+import threading
+from app.dependencies import make_db_connection
+from app.repositories.sqlite.pool import SQLiteConnectionPool
+
+@pytest.fixture
+def pool(tmp_path):
+    db_path = str(tmp_path / "tv.db")
+    pool = SQLiteConnectionPool(lambda: make_db_connection(db_path, check_same_thread=False), readers=2, timeout=0.5)
+    with pool.writer() as con:
+        con.execute("CREATE TABLE t(x INTEGER)")
+        con.commit()
+    yield pool
+    pool.close()
+
+def test_pool_WALで読み取りは書き込み中も読める(pool):
+    with pool.writer() as w:
+        assert w.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        w.execute("INSERT INTO t VALUES(1)")
+        with pool.reader() as r:
+            assert r.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 0
+        w.commit()
+    with pool.reader() as r:
+        assert r.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 1
+
+def test_pool_読み取り用の接続には書き込めない(pool):
+    with pool.reader() as r:
+        with pytest.raises(sqlite3.OperationalError):
+            r.execute("INSERT INTO t VALUES(1)")
+
+def test_pool_書き込み用の接続は1本だけ(pool):
+    acquired = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with pool.writer():
+            acquired.set()
+            release.wait()
+
+    t = threading.Thread(target=hold)
+    t.start()
+    acquired.wait()
+    with pytest.raises(TimeoutError):
+        with pool.writer():
+            pass
+    release.set()
+    t.join()
+
+def test_pool_コミットされなかった書き込みは戻す(pool):
+    with pool.writer() as w:
+        w.execute("INSERT INTO t VALUES(1)")
+    with pool.reader() as r:
+        assert r.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 0
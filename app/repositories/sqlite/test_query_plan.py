@@ -0,0 +1,155 @@
+import re
+import pytest
+from datetime import datetime
+from app.models.api import encode_cursor, ProgramBase, ProgramQueryParams, ViewBase, ViewPost, ViewQueryParams, RecordingBase, RecordingPost, RecordingPatch, RecordingQueryParams, SeriesQueryParams, DigestionQueryParams, StatsQueryParams, JST
+from app.repositories.sqlite.api import (
+    SQLiteProgramRepository, SQLiteRecordingRepository, SQLiteViewRepository, SQLiteDigestionRepository,
+    SQLiteSeriesRepository, SQLiteIngestRepository, SQLiteStatsRepository
+)
+
+# インデックスを使わない全件走査 (SCAN programs / SCAN recordings AS r2 など)
+FULL_SCAN = re.compile(r"^SCAN (\w+)(?: AS \w+)?$")
+
+class RecordingConnection:
+    """リポジトリが発行した SQL とパラメータを記録する"""
+    def __init__(self, con):
+        self._con = con
+        self.statements = []
+
+    def execute(self, sql, parameters=()):
+        self.statements.append((sql, parameters))
+        return self._con.execute(sql, parameters)
+
+    def cursor(self):
+        return RecordingCursor(self)
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+class RecordingCursor:
+    def __init__(self, recorder: RecordingConnection):
+        self._recorder = recorder
+        self._cur = recorder._con.cursor()
+
+    def execute(self, sql, parameters=()):
+        self._recorder.statements.append((sql, parameters))
+        return self._cur.execute(sql, parameters)
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+def full_scans(con, sql, parameters) -> list[str]:
+    plan = con.execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+    return [row["detail"] for row in plan if FULL_SCAN.match(row["detail"])]
+
+@pytest.fixture
+def recorder(con):
+    con.executescript("""
+        INSERT INTO programs(id, event_id, service_id, name, start_time, duration, created_at) VALUES
+            (1, 11, 101, 'Test Program', unixepoch('2025-05-12T12:00:00+09:00'), 1800, unixepoch('2025-05-12T12:01:00+09:00'))
+        ;
+        INSERT INTO recordings(id, program_id, file_path, watched_at, deleted_at, created_at) VALUES
+            (1, 1, '//server/recorded/test1', NULL, NULL, unixepoch('2025-05-12T12:30:00+09:00'))
+        ;
+        INSERT INTO views(program_id, viewed_time, created_at) VALUES
+            (1, unixepoch('2025-05-12T12:05:00+09:00'), unixepoch('2025-05-12T12:05:00+09:00'))
+        ;
+        INSERT INTO series(id, name, created_at, modified_at) VALUES
+            (1, 'series1', unixepoch('2025-09-02T00:00:00+09:00'), unixepoch('2025-09-02T00:00:00+09:00'))
+          , (2, 'series2', unixepoch('2025-09-02T00:00:00+09:00'), unixepoch('2025-09-02T00:00:00+09:00'))
+        ;
+        INSERT INTO program_series(program_id, series_id) VALUES
+            (1, 1)
+        ;
+    """)
+    return RecordingConnection(con)
+
+AT = datetime(2025, 5, 12, 12, 30, tzinfo=JST)
+PROGRAM = ProgramBase(event_id=11, service_id=101, name="Test Program", start_time=datetime(2025, 5, 12, 12, 0, tzinfo=JST), duration=1800)
+
+REPOSITORY_CALLS = {
+    "program.search": lambda c: SQLiteProgramRepository(c).search(ProgramQueryParams(name="Test", from_=AT, to=AT)),
+    "program.search_fts": lambda c: SQLiteProgramRepository(c).search(ProgramQueryParams(name="Program", sort="rank")),
+    "program.search_cursor": lambda c: SQLiteProgramRepository(c).search(ProgramQueryParams(cursor=encode_cursor(AT, 1))),
+    "program.get_by_id": lambda c: SQLiteProgramRepository(c).get_by_id(1),
+    "program.get_or_create": lambda c: SQLiteProgramRepository(c).get_or_create(PROGRAM, AT, AT),
+    "program.update": lambda c: SQLiteProgramRepository(c).update(1, "genre"),
+    "view.search": lambda c: SQLiteViewRepository(c).search(ViewQueryParams()),
+    "view.search_program_id": lambda c: SQLiteViewRepository(c).search(ViewQueryParams(program_id=1)),
+    "view.search_cursor": lambda c: SQLiteViewRepository(c).search(ViewQueryParams(cursor=encode_cursor(int(AT.timestamp()), 1, 1))),
+    "view.create": lambda c: SQLiteViewRepository(c).create(1, ViewBase(viewed_time=AT, created_at=AT)),
+    "recording.search": lambda c: SQLiteRecordingRepository(c).search(RecordingQueryParams()),
+    "recording.search_program_id": lambda c: SQLiteRecordingRepository(c).search(RecordingQueryParams(program_id=1)),
+    "recording.search_file_folder": lambda c: SQLiteRecordingRepository(c).search(RecordingQueryParams(file_folder="recorded")),
+    "recording.search_cursor": lambda c: SQLiteRecordingRepository(c).search(RecordingQueryParams(cursor=encode_cursor(AT, AT, 1))),
+    "recording.get_by_id": lambda c: SQLiteRecordingRepository(c).get_by_id(1),
+    "recording.create": lambda c: SQLiteRecordingRepository(c).create(
+        RecordingBase(program=PROGRAM, file_path="//server/recorded/test2", file_size=None, watched_at=None, deleted_at=None, created_at=AT), 1),
+    "recording.update_patch": lambda c: SQLiteRecordingRepository(c).update_patch(1, RecordingPatch(file_folder="recorded2")),
+    "series.search": lambda c: SQLiteSeriesRepository(c).search(SeriesQueryParams(name="series")),
+    "series.search_fts": lambda c: SQLiteSeriesRepository(c).search(SeriesQueryParams(name="series", sort="rank")),
+    "series.search_cursor": lambda c: SQLiteSeriesRepository(c).search(SeriesQueryParams(cursor=encode_cursor(AT, 1))),
+    "series.get_or_create": lambda c: SQLiteSeriesRepository(c).get_or_create("series1", AT),
+    "series.get_by_id": lambda c: SQLiteSeriesRepository(c).get_by_id(1),
+    "series.add_program": lambda c: SQLiteSeriesRepository(c).add_program(2, 1, AT),
+    "series.update": lambda c: SQLiteSeriesRepository(c).update(1, "series2"),
+    "series.update_program_series": lambda c: SQLiteSeriesRepository(c).update_program_series(1, 1, "series3"),
+    "ingest.ingest_view": lambda c: SQLiteIngestRepository(c).ingest_view(ViewPost(program=PROGRAM, viewed_time=AT)),
+    "ingest.ingest_recording": lambda c: SQLiteIngestRepository(c).ingest_recording(
+        RecordingPost(program=PROGRAM, file_path="//server/recorded/test2", created_at=AT), "series1"),
+    "digestion.list_digestions": lambda c: SQLiteDigestionRepository(c).list_digestions(DigestionQueryParams(name="Test")),
+    "digestion.list_digestions_short_name": lambda c: SQLiteDigestionRepository(c).list_digestions(DigestionQueryParams(name="Te")),
+    "stats.watch_stats": lambda c: SQLiteStatsRepository(c).watch_stats(StatsQueryParams(from_=AT.date(), to=AT.date(), group_by="series")),
+}
+
+@pytest.mark.parametrize("call", REPOSITORY_CALLS.values(), ids=REPOSITORY_CALLS.keys())
+def test_リポジトリのクエリが全件走査しない(con, recorder, call):
+    call(recorder)
+    assert recorder.statements
+
+    for sql, parameters in recorder.statements:
+        assert full_scans(con, sql, parameters) == [], sql
+
+def test_番組一覧の録画は件数によらず1回で引く(con, recorder):
+    con.executescript("""
+        INSERT INTO programs(id, event_id, service_id, name, start_time, duration, created_at) VALUES
+            (2, 12, 101, 'Test Program 2', unixepoch('2025-05-13T12:00:00+09:00'), 1800, unixepoch('2025-05-13T12:01:00+09:00'))
+          , (3, 13, 101, 'Test Program 3', unixepoch('2025-05-14T12:00:00+09:00'), 1800, unixepoch('2025-05-14T12:01:00+09:00'))
+        ;
+        INSERT INTO recordings(id, program_id, file_path, watched_at, deleted_at, created_at) VALUES
+            (2, 2, '//server/recorded/test2', NULL, NULL, unixepoch('2025-05-13T12:30:00+09:00'))
+          , (3, 2, '//server/recorded/test3', NULL, unixepoch('2025-05-13T13:00:00+09:00'), unixepoch('2025-05-13T12:30:00+09:00'))
+        ;
+    """)
+    programs = SQLiteProgramRepository(recorder).search(ProgramQueryParams())
+
+    assert [(p.id, p.recordings) for p in programs] == [(3, []), (2, [2, 3]), (1, [1])]
+    assert [p.viewed_times for p in programs][2] == [datetime(2025, 5, 12, 12, 5, tzinfo=JST)]
+    # アーカイブの確認 (PRAGMA) を除くと、番組と録画の2回
+    queries = [sql for sql, _ in recorder.statements if not sql.startswith("PRAGMA")]
+    assert len(queries) == 2
+    assert all("json_group_array" not in sql for sql in queries)
+
+FILTERED_CALLS = {
+    "program.search_from": (lambda c: SQLiteProgramRepository(c).search(ProgramQueryParams(from_=AT)), "SEARCH programs USING INDEX programs_start_time (start_time>?)"),
+    "program.search_to": (lambda c: SQLiteProgramRepository(c).search(ProgramQueryParams(to=AT)), "SEARCH programs USING INDEX programs_start_time (start_time<?)"),
+    "recording.search_from": (lambda c: SQLiteRecordingRepository(c).search(RecordingQueryParams(**{"from": AT})), "SEARCH programs USING INDEX programs_start_time (start_time>?)"),
+    "recording.search_program_id": (lambda c: SQLiteRecordingRepository(c).search(RecordingQueryParams(program_id=1)), "SEARCH programs USING INTEGER PRIMARY KEY (rowid=?)"),
+}
+
+@pytest.mark.parametrize("call, expected", FILTERED_CALLS.values(), ids=FILTERED_CALLS.keys())
+def test_絞り込みはインデックスを範囲で引く(con, recorder, call, expected):
+    call(recorder)
+    sql, parameters = [(sql, parameters) for sql, parameters in recorder.statements if not sql.startswith("PRAGMA")][0]
+
+    assert expected in [row["detail"] for row in con.execute("EXPLAIN QUERY PLAN " + sql, parameters)]
+
+def test_同じ条件の組み合わせなら同じ文を使う(con, recorder):
+    repo = SQLiteProgramRepository(recorder)
+    repo.search(ProgramQueryParams(name="Te", from_=AT))
+    repo.search(ProgramQueryParams(name="xy", from_=datetime(2024, 1, 1, tzinfo=JST)))
+    repo.search(ProgramQueryParams(name="Te"))
+
+    first, second, third = [sql for sql, _ in recorder.statements if not sql.startswith("PRAGMA") and "FROM programs" in sql][:3]
+    assert first == second
+    assert first != third
@@ -0,0 +1,97 @@
+import pytest
+from contextlib import contextmanager
+from datetime import datetime
+from app.dependencies import make_db_connection
+from app.models.api import JST
+from app.repositories.exceptions import InvalidDataError
+from app.repositories.sqlite.api import SQLiteSeriesRepository
+from app.repositories.sqlite.migrations import migrate
+from app.repositories.sqlite.pool import SQLiteConnectionPool
+from app.repositories.sqlite.write_queue import SQLiteWriteQueue
+
+@pytest.fixture
+def pool(tmp_path):
+    db_path = str(tmp_path / "tv.db")
+    pool = SQLiteConnectionPool(lambda: make_db_connection(db_path, check_same_thread=False), readers=2, timeout=0.5)
+    with pool.writer() as con:
+        migrate(con)
+        con.execute("CREATE TABLE t(x INTEGER UNIQUE)")
+        con.commit()
+    yield pool
+    pool.close()
+
+@pytest.fixture
+def batches(pool):
+    """書き込み用接続を借りた回数 (= コミットしたバッチ数)"""
+    count = []
+
+    @contextmanager
+    def writer():
+        count.append(1)
+        with pool.writer() as con:
+            yield con
+    return count, writer
+
+def insert(x):
+    def operation(con):
+        con.execute("INSERT INTO t VALUES(?)", (x,))
+        con.commit()
+        return x
+    return operation
+
+def test_write_queue_まとめて1回でコミットする(pool, batches):
+    count, writer = batches
+    queue = SQLiteWriteQueue(writer, max_batch=10, max_delay=0.2)
+    futures = [queue.submit(insert(x)) for x in range(5)]
+
+    assert [f.result(timeout=5) for f in futures] == list(range(5))
+    assert len(count) == 1
+    with pool.reader() as r:
+        assert r.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 5
+    queue.close()
+
+def test_write_queue_max_batch件ごとにコミットする(pool, batches):
+    count, writer = batches
+    queue = SQLiteWriteQueue(writer, max_batch=2, max_delay=0.2)
+    futures = [queue.submit(insert(x)) for x in range(5)]
+
+    for f in futures:
+        f.result(timeout=5)
+    assert len(count) == 3
+    queue.close()
+
+def test_write_queue_失敗した操作だけを取り消す(pool):
+    queue = SQLiteWriteQueue(pool.writer, max_delay=0.2)
+    ok1 = queue.submit(insert(1))
+    ng = queue.submit(insert(1))
+    ok2 = queue.submit(insert(2))
+
+    assert ok1.result(timeout=5) == 1
+    assert ok2.result(timeout=5) == 2
+    with pytest.raises(Exception):
+        ng.result(timeout=5)
+    with pool.reader() as r:
+        assert [row[0] for row in r.execute("SELECT x FROM t ORDER BY x")] == [1, 2]
+    queue.close()
+
+def test_write_queue_closeは投入済みの操作をコミットする(pool):
+    queue = SQLiteWriteQueue(pool.writer, max_delay=10)
+    future = queue.submit(insert(1))
+    queue.close()
+
+    assert future.result(timeout=0) == 1
+    with pool.reader() as r:
+        assert r.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 1
+
+def test_write_queue_リポジトリの書き込みをキューに流す(pool):
+    queue = SQLiteWriteQueue(pool.writer)
+    at = datetime(2025, 9, 2, tzinfo=JST)
+    with pool.reader() as r:
+        repo = SQLiteSeriesRepository(r, queue)
+        series_id = repo.get_or_create("series1", at)
+
+        assert repo.get_or_create("series1", at) == series_id
+        assert repo.get_by_id(series_id).name == "series1"
+        with pytest.raises(InvalidDataError):
+            repo.get_or_create("", at)
+    queue.close()
@@ -0,0 +1,102 @@
+from concurrent.futures import Future
+from contextlib import AbstractContextManager
+from queue import Empty, Queue
+from sqlite3 import Connection
+from threading import Thread
+from time import monotonic
+from typing import Any, Callable
+
+WriteOperation = Callable[[Connection], Any]
+
+class BatchConnection:
+    """commit() を何もしない接続
+       コミットはバッチ (や呼び出し側のトランザクション) の最後にまとめて行うので、内側の commit() は無視する
+    """
+    def __init__(self, con: Connection):
+        self._con = con
+
+    def commit(self) -> None:
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+class SQLiteWriteQueue:
+    """書き込み操作を専用のスレッドで受け付け、まとめて1トランザクションでコミットする
+       max_delay 秒待つか max_batch 件たまったらコミットし、それぞれの Future に結果を返す
+       操作ごとに SAVEPOINT を切るので、失敗した操作だけが取り消される
+    """
+    def __init__(self, writer: Callable[[], AbstractContextManager[Connection]],
+                 max_batch: int = 64, max_delay: float = 0.005, timeout: float = 30):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self._writer = writer
+        self._queue: Queue[tuple[WriteOperation, Future] | None] = Queue()
+        self._thread = Thread(target=self._run, name="sqlite-write-queue", daemon=True)
+        self._thread.start()
+
+    def submit(self, operation: WriteOperation) -> Future:
+        future = Future()
+        self._queue.put((operation, future))
+        return future
+
+    def run(self, operation: WriteOperation) -> Any:
+        """操作を投入し、コミットされるまで待って結果を返す"""
+        return self.submit(operation).result(timeout=self.timeout)
+
+    def close(self) -> None:
+        """投入済みの操作をコミットしてからスレッドを止める"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stopping = False
+            deadline = monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(deadline - monotonic(), 0))
+                except Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._commit(batch)
+            if stopping:
+                return
+
+    def _commit(self, batch: list[tuple[WriteOperation, Future]]) -> None:
+        results = []
+        try:
+            with self._writer() as con:
+                con.execute("BEGIN IMMEDIATE")
+                batch_con = BatchConnection(con)
+                for operation, future in batch:
+                    con.execute("SAVEPOINT operation")
+                    try:
+                        result = operation(batch_con)
+                    except Exception as e:
+                        con.execute("ROLLBACK TO operation")
+                        results.append((future, None, e))
+                    else:
+                        results.append((future, result, None))
+                    con.execute("RELEASE operation")
+                con.commit()
+        except Exception as e:
+            # コミットできなかったのでバッチ全体が失敗
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for future, result, exception in results:
+            if exception is None:
+                future.set_result(result)
+            else:
+                future.set_exception(exception)
@@ -0,0 +1,76 @@
+import asyncio
+from app.models.api import ProgramQueryParams
+from app.repositories.cache import QueryResultCache, SeriesIdCache, cached, invalidates
+
+def test_series_id_cache_maxsizeを超えたら古いものから消す():
+    cache = SeriesIdCache(maxsize=2)
+    cache.warm([("a", 1), ("b", 2)])
+    assert cache.get("a") == 1
+    cache.put("c", 3, cache.generation)
+
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+
+def test_series_id_cache_invalidateは名前とidの両方で消す():
+    cache = SeriesIdCache()
+    cache.warm([("a", 1), ("b", 1), ("c", 2)])
+    cache.invalidate(name="c", series_id=1)
+
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (None, None, None)
+
+def test_series_id_cache_引いている間にinvalidateされたら入れない():
+    cache = SeriesIdCache()
+    generation = cache.generation
+    cache.invalidate(series_id=1)
+    cache.put("a", 1, generation)
+
+    assert cache.get("a") is None
+
+def test_query_result_cache_ttlを過ぎたら捨てる():
+    now = [0.0]
+    cache = QueryResultCache(ttl=10, clock=lambda: now[0])
+    cache.put("a", None, cache.generations(["programs"]))
+    assert cache.get("a") == (True, None)
+
+    now[0] = 10
+    assert cache.get("a") == (False, None)
+
+def test_query_result_cache_引いたテーブルがinvalidateされたら捨てる():
+    cache = QueryResultCache(maxsize=2)
+    cache.put("a", 1, cache.generations(["programs"]))
+    cache.put("b", 2, cache.generations(["series"]))
+    cache.invalidate("programs")
+    assert (cache.get("a"), cache.get("b")) == ((False, None), (True, 2))
+
+    generations = cache.generations(["series"])
+    cache.invalidate("series")
+    cache.put("c", 3, generations)
+    assert cache.get("c") == (False, None)
+
+class Repository:
+    def __init__(self):
+        self.result_cache = QueryResultCache()
+        self.calls = 0
+
+    @cached("programs")
+    async def search(self, params: ProgramQueryParams) -> int:
+        self.calls += 1
+        return self.calls
+
+    @invalidates("programs")
+    async def update(self) -> None:
+        pass
+
+def test_cached_同じ引数なら引かずに返し書き込みで引き直す():
+    repo = Repository()
+
+    async def main():
+        return [
+            await repo.search(ProgramQueryParams(name="a")),
+            await repo.search(ProgramQueryParams(name="a")),
+            await repo.search(ProgramQueryParams(name="b")),
+            await repo.update(),
+            await repo.search(ProgramQueryParams(name="a")),
+        ]
+
+    assert asyncio.run(main()) == [1, 1, 2, None, 3]
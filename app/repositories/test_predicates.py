@@ -0,0 +1,23 @@
+from app.repositories.predicates import Predicates
+
+def build(where: str, desc: bool) -> str:
+    return f"SELECT * FROM programs WHERE {where} ORDER BY start_time{' DESC' if desc else ''}"
+
+def test_predicates_値のない条件は入れない():
+    where = (Predicates()
+        .add_if(None, ":from <= start_time", {"from": None})
+        .add_if("x", "name LIKE :name", {"name": "x"})
+        .add("duration > 0"))
+
+    assert where.sql == "(name LIKE :name) AND (duration > 0)"
+    assert where.params == {"name": "x"}
+    assert Predicates().add_if("", "name LIKE :name").sql == "TRUE"
+
+def test_predicates_文は条件の組み合わせごとにキャッシュする():
+    a = Predicates().add_if(1, ":from <= start_time", {"from": 1})
+    b = Predicates().add_if(2, ":from <= start_time", {"from": 2})
+
+    assert a.statement(build, True) is b.statement(build, True)
+    assert a.statement(build, True) == "SELECT * FROM programs WHERE (:from <= start_time) ORDER BY start_time DESC"
+    assert a.statement(build, False) != a.statement(build, True)
+    assert Predicates().statement(build, True) == "SELECT * FROM programs WHERE TRUE ORDER BY start_time DESC"
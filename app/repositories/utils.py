@@ -2,6 +2,8 @@ import unicodedata
 from pydantic import BaseModel
 import re
 import json
+from ..models.api import decode_cursor
+from .exceptions import InvalidDataError
 
 def extract_model_fields(model: type[BaseModel], row: dict, aliases: dict[str, str] = None) -> dict:
     aliases = aliases or {}
@@ -13,6 +15,15 @@ def extract_model_fields(model: type[BaseModel], row: dict, aliases: dict[str, s
             result[field_name] = row[source_key]
     return result
 
+def parse_cursor(cursor: str | None, *types: type | None) -> tuple | None:
+    """キーセットページングのカーソルを分解する。未指定なら None、不正なら InvalidDataError"""
+    if not cursor:
+        return None
+    try:
+        return decode_cursor(cursor, *types)
+    except ValueError:
+        raise InvalidDataError(detail="Invalid cursor")
+
 async def extract_series_title_llm(raw: str, github_token: str) -> str:
     import httpx
     import json
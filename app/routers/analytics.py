@@ -0,0 +1,34 @@
+from typing import Annotated
+from fastapi import APIRouter, Depends, HTTPException
+
+from ..models.api import AnalyticsQueryParams, AnalyticsResult
+from ..dependencies import AnalyticsDep
+from ..repositories.sqlite.analytics import ANALYTICS_QUERIES, DuckDBAnalytics
+
+router = APIRouter()
+
+def require_analytics(analytics: DuckDBAnalytics | None) -> DuckDBAnalytics:
+    if analytics is None:
+        raise HTTPException(status_code=404, detail="Analytics is only available for SQLite with duckdb installed")
+    return analytics
+
+@router.get("/api/analytics", response_model=list[str])
+def list_analytics(analytics: AnalyticsDep):
+    require_analytics(analytics)
+    return list(ANALYTICS_QUERIES)
+
+@router.post("/api/analytics/snapshot")
+def create_analytics_snapshot(analytics: AnalyticsDep):
+    """集計用のテーブルを Parquet に書き出す。SQLITE_ANALYTICS=parquet なら以降のクエリはこれを読む"""
+    path = require_analytics(analytics).snapshot()
+    return {"path": str(path)}
+
+@router.get("/api/analytics/{name}", response_model=AnalyticsResult)
+def get_analytics_result(name: str, params: Annotated[AnalyticsQueryParams, Depends()], analytics: AnalyticsDep):
+    analytics = require_analytics(analytics)
+    if name not in ANALYTICS_QUERIES:
+        raise HTTPException(status_code=404)
+    try:
+        return analytics.query(name, params)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=409, detail=str(e))
@@ -1,26 +1,47 @@
 import json
 import re
 import os
-from datetime import datetime
+from datetime import datetime, timezone
 from typing import Annotated, Literal
 from fastapi import APIRouter, Depends, Path, Body, HTTPException, Response, status
 from starlette.concurrency import run_in_threadpool
 
-from ..models.api import ProgramQueryParams, ProgramGet, ProgramPatch, Series, SeriesAddProgram, SeriesPost, SeriesWithPrograms, ViewQueryParams, ViewGet, ViewPost, RecordingQueryParams, RecordingGet, RecordingPost, RecordingPatch, SeriesQueryParams, Digestion, SeriesPatch, SeriesProgramPatch, DigestionQueryParams
-from ..dependencies import DigestionRepositoryDep, ProgramRepositoryDep, RecordingRepositoryDep, ViewRepositoryDep, SeriesRepositoryDep
+from ..models.api import ProgramQueryParams, ProgramGet, ProgramPatch, ProgramSearchPage, ProgramSearchResult, Series, SeriesSearchResult, SeriesAddProgram, SeriesPost, SeriesWithPrograms, ViewQueryParams, ViewGet, ViewPost, RecordingQueryParams, RecordingGet, RecordingPost, RecordingSearchPage, RecordingPatch, SeriesQueryParams, Digestion, SeriesPatch, SeriesProgramPatch, DigestionQueryParams, BackupStatus
+from ..dependencies import BackupDep, DigestionRepositoryDep, IngestRepositoryDep, ProgramRepositoryDep, RecordingRepositoryDep, ViewRepositoryDep, SeriesRepositoryDep
 from ..pubsub import publish_to_pubsub
 from ..repositories.utils import extract_series_title, extract_series_title_llm
 from ..repositories.exceptions import InvalidDataError, NotFoundError, UnexpectedError
 
 router = APIRouter()
 
-@router.get("/api/programs", response_model=list[ProgramGet])
-def get_programs(params: Annotated[ProgramQueryParams, Depends()], repo: ProgramRepositoryDep):
-    return repo.search(params)
+def set_next_cursor(response: Response | None, items: list, size: int | None) -> str | None:
+    """size 件そろっていれば続きがあるとみなし、最後の行のカーソルを X-Next-Cursor に入れて返す"""
+    if not (size and len(items) >= size):
+        return None
+    cursor = items[-1].cursor()
+    if response is not None:
+        response.headers["X-Next-Cursor"] = cursor
+    return cursor
+
+@router.get("/api/programs", response_model=list[ProgramSearchResult] | ProgramSearchPage)
+async def get_programs(params: Annotated[ProgramQueryParams, Depends()], repo: ProgramRepositoryDep, response: Response = None):
+    try:
+        if params.with_facets:
+            page = await repo.search_with_facets(params)
+            programs = page.items
+        else:
+            page = programs = await repo.search(params)
+    except InvalidDataError as e:
+        raise HTTPException(status_code=400, detail=e.detail)
+    if params.sort == "start_time":
+        next_cursor = set_next_cursor(response, programs, params.size)
+        if params.with_facets:
+            page.next_cursor = next_cursor
+    return page
 
 @router.get("/api/programs/{id}", response_model=ProgramGet)
-def get_program(id: int | str, repo: ProgramRepositoryDep):
-    program = repo.get_by_id(id)
+async def get_program(id: int | str, repo: ProgramRepositoryDep):
+    program = await repo.get_by_id(id)
     if program is None:
         raise HTTPException(status_code=404)
 
@@ -31,36 +52,50 @@ def create_program():
     raise NotImplementedError
 
 @router.patch("/api/programs/{id}", response_model=ProgramGet)
-def patch_program(id: int | str, item: ProgramPatch, repo: ProgramRepositoryDep):
-    repo.update(id, item.genre)
-    return repo.get_by_id(id)
+async def patch_program(id: int | str, item: ProgramPatch, repo: ProgramRepositoryDep):
+    await repo.update(id, item.genre)
+    return await repo.get_by_id(id)
 
 @router.get("/api/views", response_model=list[ViewGet])
-def get_views(params: Annotated[ViewQueryParams, Depends()], view_repo: ViewRepositoryDep):
-    return view_repo.search(params)
+async def get_views(params: Annotated[ViewQueryParams, Depends()], view_repo: ViewRepositoryDep, response: Response = None):
+    try:
+        views = await view_repo.search(params)
+    except InvalidDataError as e:
+        raise HTTPException(status_code=400, detail=e.detail)
+    if params.program_id is None:
+        set_next_cursor(response, views, params.size)
+    return views
 
 @router.post("/api/views")
-def create_view(item: ViewPost, prog_repo: ProgramRepositoryDep, view_repo: ViewRepositoryDep):
-    program_id = prog_repo.get_or_create(item.program, item.viewed_time, item.viewed_time)
-    view_repo.create(program_id, item)
+async def create_view(item: ViewPost, ingest_repo: IngestRepositoryDep):
+    await ingest_repo.ingest_view(item)
     return
 
-@router.get("/api/recordings", response_model=list[RecordingGet])
-def get_recordings(params: Annotated[RecordingQueryParams, Depends()], rec_repo: RecordingRepositoryDep):
-    return rec_repo.search(params)
+@router.get("/api/recordings", response_model=list[RecordingGet] | RecordingSearchPage)
+async def get_recordings(params: Annotated[RecordingQueryParams, Depends()], rec_repo: RecordingRepositoryDep, response: Response = None):
+    try:
+        if params.with_facets:
+            page = await rec_repo.search_with_facets(params)
+            recordings = page.items
+        else:
+            page = recordings = await rec_repo.search(params)
+    except InvalidDataError as e:
+        raise HTTPException(status_code=400, detail=e.detail)
+    next_cursor = set_next_cursor(response, recordings, params.size)
+    if params.with_facets:
+        page.next_cursor = next_cursor
+    return page
 
 @router.get("/api/recordings/{id}", response_model=RecordingGet)
-def get_recording(id: int | str, rec_repo: RecordingRepositoryDep):
-    return rec_repo.get_by_id(id)
+async def get_recording(id: int | str, rec_repo: RecordingRepositoryDep):
+    return await rec_repo.get_by_id(id)
 
 @router.post("/api/recordings", response_model=RecordingGet)
-async def create_recording(item: Annotated[RecordingPost, Body()], prog_repo: ProgramRepositoryDep, rec_repo: RecordingRepositoryDep, series_repo: SeriesRepositoryDep):
+async def create_recording(item: Annotated[RecordingPost, Body()], ingest_repo: IngestRepositoryDep):
     if not re.fullmatch("//[^/]+/[^/]+/.*", item.file_path):
         raise HTTPException(status_code=400, detail="Invalid file_path; should be '//server/folder/to/file'")
 
-    program_id = await run_in_threadpool(prog_repo.get_or_create, item.program, item.created_at, item.created_at)
-    id_ = await run_in_threadpool(rec_repo.create, item, program_id)
-
+    # シリーズ名の推定は外部 API を呼ぶので、トランザクションの外で先に済ませる
     series_name = await extract_series_title_llm(
         item.program.name,
         github_token=os.getenv("GITHUB_TOKEN")
@@ -71,10 +106,7 @@ async def create_recording(item: Annotated[RecordingPost, Body()], prog_repo: Pr
         series_name = item.program.name
 
     print(f"Extracted series name: {series_name}")
-    series_id = await run_in_threadpool(series_repo.get_or_create, series_name, item.created_at)
-    await run_in_threadpool(series_repo.add_program, series_id, program_id, item.created_at)
-
-    return await run_in_threadpool(rec_repo.get_by_id, id_)
+    return await ingest_repo.ingest_recording(item, series_name)
 
 @router.patch("/api/recordings/{id}")
 async def patch_recording(item: Annotated[RecordingPatch, Body()],
@@ -82,12 +114,12 @@ async def patch_recording(item: Annotated[RecordingPatch, Body()],
                           response: Response,
                           rec_repo: RecordingRepositoryDep):
     try:
-        old_rec = await run_in_threadpool(rec_repo.get_by_id, id)
+        old_rec = await rec_repo.get_by_id(id)
         if not old_rec:
             raise HTTPException(status_code=404, detail="Recording not found")
 
-        accepted = await run_in_threadpool(rec_repo.update_patch, id, item)
-        new_rec = await run_in_threadpool(rec_repo.get_by_id, id)
+        accepted = await rec_repo.update_patch(id, item)
+        new_rec = await rec_repo.get_by_id(id)
 
         if item.deleted_at is not None and old_rec.file_path:
             print(f"Publishing delete command for: {old_rec.file_path}")
@@ -118,45 +150,64 @@ async def patch_recording(item: Annotated[RecordingPatch, Body()],
         raise HTTPException(status_code=500, detail=e.detail)
 
 @router.get("/api/digestions", response_model=list[Digestion])
-def get_digestions(params: Annotated[DigestionQueryParams, Depends()], dig_repo: DigestionRepositoryDep):
-    return dig_repo.list_digestions(params)
+async def get_digestions(params: Annotated[DigestionQueryParams, Depends()], dig_repo: DigestionRepositoryDep):
+    return await dig_repo.list_digestions(params)
 
-@router.get("/api/series", response_model=list[Series])
-def get_series(params: Annotated[SeriesQueryParams, Depends()], series_repo: SeriesRepositoryDep):
-    return series_repo.search(params)
+@router.get("/api/series", response_model=list[SeriesSearchResult])
+async def get_series(params: Annotated[SeriesQueryParams, Depends()], series_repo: SeriesRepositoryDep, response: Response = None):
+    try:
+        series = await series_repo.search(params)
+    except InvalidDataError as e:
+        raise HTTPException(status_code=400, detail=e.detail)
+    if params.sort == "modified_at":
+        set_next_cursor(response, series, params.size)
+    return series
 
 @router.post("/api/series", response_model=Series)
-def create_series(params: Annotated[SeriesPost, Body()], series_repo: SeriesRepositoryDep):
-    id_ = series_repo.create(params.name, params.created_at)
-    return series_repo.get_by_id(id_)
+async def create_series(params: Annotated[SeriesPost, Body()], series_repo: SeriesRepositoryDep):
+    id_ = await series_repo.create(params.name, params.created_at)
+    return await series_repo.get_by_id(id_)
 
 @router.get("/api/series/{id}", response_model=SeriesWithPrograms)
-def get_series_by_id(id: int | str, series_repo: SeriesRepositoryDep, page: int = 1, size: int = 100):
+async def get_series_by_id(id: int | str, series_repo: SeriesRepositoryDep, page: int = 1, size: int = 100):
     try:
-        series = series_repo.get_by_id(id, page=page, size=size)
+        series = await series_repo.get_by_id(id, page=page, size=size)
     except NotFoundError as e:
         raise HTTPException(status_code=404, detail=e.detail)
     return series
 
 @router.patch("/api/series/{id}", response_model=SeriesWithPrograms)
-def update_series(id: int | str, item: SeriesPatch, series_repo: SeriesRepositoryDep):
-    series_repo.update(id, item.name)
-    return series_repo.get_by_id(id)
+async def update_series(id: int | str, item: SeriesPatch, series_repo: SeriesRepositoryDep):
+    await series_repo.update(id, item.name)
+    return await series_repo.get_by_id(id)
 
 @router.post("/api/series/{id}/programs")
-def add_program_to_series(id: int | str, params: SeriesAddProgram, series_repo: SeriesRepositoryDep):
+async def add_program_to_series(id: int | str, params: SeriesAddProgram, series_repo: SeriesRepositoryDep):
     try:
-        series_repo.add_program(id, params.program_id, datetime.now(timezone.utc))
+        await series_repo.add_program(id, params.program_id, datetime.now(timezone.utc))
     except NotFoundError as e:
         raise HTTPException(status_code=404, detail=e.detail)
     return
 
 @router.patch("/api/series/{series_id}/programs/{program_id}", response_model=SeriesWithPrograms)
-def update_program_series(
+async def update_program_series(
     series_id: int | str,
     program_id: int | str,
     item: SeriesProgramPatch,
     series_repo: SeriesRepositoryDep
 ):
-    series_repo.update_program_series(program_id, series_id, item.series_name)
-    return series_repo.get_by_id(series_id)
+    await series_repo.update_program_series(program_id, series_id, item.series_name)
+    return await series_repo.get_by_id(series_id)
+
+@router.get("/api/admin/backup", response_model=BackupStatus)
+def get_backup_status(backup: BackupDep):
+    if backup is None:
+        raise HTTPException(status_code=404, detail="Backup is only available for SQLite")
+    return backup.status
+
+@router.post("/api/admin/backup", response_model=BackupStatus, status_code=status.HTTP_202_ACCEPTED)
+def start_backup(backup: BackupDep):
+    """スナップショットを別スレッドで取り始める。進み具合は GET で見る"""
+    if backup is None:
+        raise HTTPException(status_code=404, detail="Backup is only available for SQLite")
+    return backup.start()
@@ -0,0 +1,17 @@
+from typing import Annotated
+from fastapi import APIRouter, Depends
+
+from ..models.api import StatsQueryParams, StatsRollup, WatchStats
+from ..dependencies import StatsRepositoryDep
+
+router = APIRouter()
+
+@router.get("/api/stats", response_model=list[WatchStats])
+async def get_stats(params: Annotated[StatsQueryParams, Depends()], stats_repo: StatsRepositoryDep):
+    """日次集計 (daily_watch_stats) だけから、期間ごと・group_by ごとの視聴時間と番組数を返す"""
+    return await stats_repo.watch_stats(params)
+
+@router.post("/api/admin/stats/rollup", response_model=StatsRollup)
+async def rollup_stats(stats_repo: StatsRepositoryDep):
+    """ストリーミング挿入した視聴を日次集計にまとめて足す。BigQuery では Cloud Scheduler などで定期的に呼ぶ"""
+    return StatsRollup(samples=await stats_repo.rollup())
@@ -172,6 +172,28 @@ def test_get_programs_search_name(con, client):
     assert len(programs2) == 1
     assert programs2[0]["id"] == 2
 
+def test_get_programs_with_facets(con, client):
+    con.executescript("""
+        INSERT INTO programs(id, event_id, service_id, name, start_time, duration, created_at) VALUES
+            (1, 11, 101, 'Test Program', unixepoch('2025-05-12T12:00:00+09:00'), 1800, unixepoch('2025-05-12T12:01:00+09:00'))
+          , (2, 12, 102, 'Test Program 2', unixepoch('2025-05-13T12:00:00+09:00'), 1800, unixepoch('2025-05-13T12:01:00+09:00'))
+          , (3, 13, 103, 'Other', unixepoch('2025-05-14T12:00:00+09:00'), 1800, unixepoch('2025-05-14T12:01:00+09:00'))
+        ;
+        INSERT INTO recordings(id, program_id, file_path, deleted_at, created_at) VALUES
+            (1, 1, '//server/recorded/test1', NULL, unixepoch('2025-05-12T12:30:00+09:00'))
+          , (2, 2, '//server/recorded/test2', unixepoch('2025-05-13T14:00:00+09:00'), unixepoch('2025-05-13T12:30:00+09:00'))
+        ;
+        INSERT INTO views(program_id, viewed_time, created_at) VALUES
+            (2, unixepoch('2025-05-13T12:05:00+09:00'), unixepoch('2025-05-13T12:05:00+09:00'))
+        ;
+    """)
+    response = client.get("/api/programs?name=Test&size=1&with_facets=true")
+    assert response.status_code == 200
+    page = response.json()
+    assert [p["id"] for p in page["items"]] == [2]
+    assert page["facets"] == {"total": 2, "viewed": 1, "recorded": 1}
+    assert "X-Next-Cursor" in response.headers
+
 def test_get_views_search_program_id(con, client):
     con.executescript("""
         INSERT INTO programs(id, event_id, service_id, name, start_time, duration, created_at) VALUES
@@ -335,6 +357,149 @@ def test_create_view_created_atより前のviewed_timeでdurationが変化して
     program = client.get("/api/programs/1").json()
     assert program["duration"] == 1800
 
+def test_create_view_続けて視聴したサンプルは区間にまとめる(con, client):
+    for viewed_time in ["2025-05-12T12:05:00+09:00", "2025-05-12T12:10:00+09:00", "2025-05-12T12:15:00+09:00", "2025-05-12T12:30:00+09:00"]:
+        response = client.post("/api/views", json={
+            "program": {
+                "event_id": 11,
+                "service_id": 101,
+                "name": "Test Program",
+                "start_time": "2025-05-12T12:00:00+09:00",
+                "duration": 3600,
+            },
+            "viewed_time": viewed_time,
+        })
+        assert response.status_code == 200
+    assert con.execute("SELECT COUNT(*) FROM view_segments").fetchone()[0] == 2
+
+    program = client.get("/api/programs/1").json()
+    assert program["viewed_times"] == [
+        "2025-05-12T12:05:00+09:00",
+        "2025-05-12T12:10:00+09:00",
+        "2025-05-12T12:15:00+09:00",
+        "2025-05-12T12:30:00+09:00",
+    ]
+    views = client.get("/api/views?program_id=1").json()
+    assert [v["viewed_time"] for v in views] == [
+        "2025-05-12T12:30:00+09:00",
+        "2025-05-12T12:15:00+09:00",
+        "2025-05-12T12:10:00+09:00",
+        "2025-05-12T12:05:00+09:00",
+    ]
+
+def test_create_view_視聴済みの分をビットマップに記録する(con, client):
+    for viewed_time, speed in [("2025-05-12T12:10:00+09:00", 1.0), ("2025-05-12T12:30:00+09:00", 2.0)]:
+        response = client.post("/api/views", json={
+            "program": {
+                "event_id": 11,
+                "service_id": 101,
+                "name": "Test Program",
+                "start_time": "2025-05-12T12:00:00+09:00",
+                "duration": 3600,
+            },
+            "viewed_time": viewed_time,
+            "speed": speed,
+        })
+        assert response.status_code == 200
+    # 12:05-12:10 の5分と、2倍速で 12:20-12:30 の10分
+    assert con.execute("SELECT watched_minutes FROM program_view_stats WHERE program_id = 1").fetchone()[0] == 15
+
+    program = client.get("/api/programs/1").json()
+    assert program["coverage"] == 15 / 60
+    assert program["first_unwatched_minute"] == 0
+
+    # 番組の時間が変わるとスロットを作り直す (12:25 開始なら 12:25-12:30 の5分だけ)
+    con.execute("UPDATE programs SET start_time = unixepoch('2025-05-12T12:25:00+09:00') WHERE id = 1")
+    program = client.get("/api/programs/1").json()
+    assert program["coverage"] == 5 / 60
+    assert program["first_unwatched_minute"] == 5
+
+def test_create_view_延びた区間はそのサンプルの分だけビットマップに足す(con, client):
+    for viewed_time in ["2025-05-12T12:10:00+09:00", "2025-05-12T12:15:00+09:00", "2025-05-12T12:20:00+09:00"]:
+        response = client.post("/api/views", json={
+            "program": {
+                "event_id": 11,
+                "service_id": 101,
+                "name": "Test Program",
+                "start_time": "2025-05-12T12:00:00+09:00",
+                "duration": 3600,
+            },
+            "viewed_time": viewed_time,
+        })
+        assert response.status_code == 200
+    assert con.execute("SELECT samples FROM view_segments WHERE program_id = 1").fetchone()[0] == 3
+    # 12:05-12:20 の15分 (5分目から19分目)
+    bitmap, minutes = con.execute("SELECT watched_bitmap, watched_minutes FROM program_view_stats WHERE program_id = 1").fetchone()
+    assert bitmap == b"\xe0\xff\x0f" + bytes(5)
+    assert minutes == 15
+
+    # 区間を消すと残りの区間から作り直す
+    con.execute("DELETE FROM view_segments WHERE program_id = 1")
+    assert con.execute("SELECT COUNT(*) FROM program_view_stats WHERE program_id = 1").fetchone()[0] == 0
+
+def test_create_view_同じ放送の番組は1件にまとめる(con, client):
+    for viewed_time in ["2025-05-12T12:05:00+09:00", "2025-05-12T12:10:00+09:00"]:
+        response = client.post("/api/views", json={
+            "program": {
+                "event_id": 11,
+                "service_id": 101,
+                "name": "Test Program",
+                "start_time": "2025-05-12T12:00:00+09:00",
+                "duration": 1800,
+            },
+            "viewed_time": viewed_time,
+        })
+        assert response.status_code == 200
+    programs = client.get("/api/programs").json()
+    assert len(programs) == 1
+    assert len(programs[0]["viewed_times"]) == 2
+
+def test_create_view_5時をまたいで繰り下がった番組も1件にまとめる(con, client):
+    # 4:50 開始の予定が 5:20 に繰り下がると放送日が変わる
+    for start_time, viewed_time in [
+        ("2025-05-13T04:50:00+09:00", "2025-05-13T04:40:00+09:00"),
+        ("2025-05-13T05:20:00+09:00", "2025-05-13T05:25:00+09:00"),
+        ("2025-05-13T04:50:00+09:00", "2025-05-13T05:30:00+09:00"),
+    ]:
+        response = client.post("/api/views", json={
+            "program": {
+                "event_id": 11,
+                "service_id": 101,
+                "name": "Test Program",
+                "start_time": start_time,
+                "duration": 1800,
+            },
+            "viewed_time": viewed_time,
+        })
+        assert response.status_code == 200
+    programs = client.get("/api/programs").json()
+    assert [(p["start_time"], len(p["viewed_times"])) for p in programs] == [("2025-05-13T05:20:00+09:00", 3)]
+
+def test_create_view_繰り下がった先の放送日に同じ番組があればそちらにまとめる(con, client):
+    # 前後の放送日に同じ番組が2件あるとき、4:50 の番組を 5:20 に動かすと 5:10 の番組と一意キーがぶつかる
+    con.executescript("""
+        INSERT INTO programs(id, event_id, service_id, name, start_time, duration, created_at) VALUES
+            (1, 11, 101, 'Test Program', unixepoch('2025-05-13T04:50:00+09:00'), 1800, unixepoch('2025-05-13T04:00:00+09:00'))
+          , (2, 11, 101, 'Test Program', unixepoch('2025-05-13T05:10:00+09:00'), 1800, unixepoch('2025-05-13T04:00:00+09:00'))
+        ;
+    """)
+    response = client.post("/api/views", json={
+        "program": {
+            "event_id": 11,
+            "service_id": 101,
+            "name": "Test Program",
+            "start_time": "2025-05-13T05:20:00+09:00",
+            "duration": 1800,
+        },
+        "viewed_time": "2025-05-13T05:25:00+09:00",
+    })
+    assert response.status_code == 200
+    programs = client.get("/api/programs").json()
+    assert sorted((p["id"], p["start_time"], len(p["viewed_times"])) for p in programs) == [
+        (1, "2025-05-13T04:50:00+09:00", 0),
+        (2, "2025-05-13T05:20:00+09:00", 1),
+    ]
+
 #def 延長追従
 
 #def プログラム予約でevent_id=65535を登録するとき、同じservice_idとstart_timeの番組があればそれを優先する
@@ -574,6 +739,37 @@ def test_get_recordings_search_file_folder(con, client):
     assert len(recordings2) == 1
     assert recordings2[0]["id"] == 2
 
+def test_get_recordings_with_facets(con, client):
+    con.executescript("""
+        INSERT INTO programs(id, event_id, service_id, name, start_time, duration, created_at) VALUES
+            (1, 11, 101, 'Test Program', unixepoch('2025-05-12T12:00:00+09:00'), 1800, unixepoch('2025-05-12T12:01:00+09:00'))
+          , (2, 12, 102, 'Test Program 2', unixepoch('2025-05-13T12:00:00+09:00'), 1800, unixepoch('2025-05-13T12:01:00+09:00'))
+        ;
+        INSERT INTO recordings(id, program_id, file_path, file_size, watched_at, deleted_at, created_at) VALUES
+            (1, 1, '//server/recorded1/test1', 100, unixepoch('2025-05-12T13:00:00+09:00'), NULL, unixepoch('2025-05-12T12:30:00+09:00'))
+          , (2, 1, '//server/recorded2/test1', NULL, NULL, unixepoch('2025-05-12T14:00:00+09:00'), unixepoch('2025-05-12T12:30:00+09:00'))
+          , (3, 2, '//server/recorded1/test2', 200, NULL, NULL, unixepoch('2025-05-13T12:30:00+09:00'))
+        ;
+    """)
+    response = client.get("/api/recordings?watched=true&deleted=true&size=1&with_facets=true")
+    assert response.status_code == 200
+    page = response.json()
+    assert [r["id"] for r in page["items"]] == [3]
+    assert page["facets"] == {
+        "total": 3, "watched": 1, "unwatched": 2, "deleted": 1, "kept": 2,
+        "file_size": 300, "file_folders": {"recorded1": 2, "recorded2": 1},
+    }
+    assert page["next_cursor"] == response.headers["X-Next-Cursor"]
+    # カーソルで続きを読んでも、集計は条件に合う全件のまま
+    next_page = client.get(f"/api/recordings?watched=true&deleted=true&size=1&with_facets=true&cursor={page['next_cursor']}").json()
+    assert [r["id"] for r in next_page["items"]] == [1]
+    assert next_page["facets"]["total"] == 3
+
+    empty = client.get("/api/recordings?file_folder=none&with_facets=true").json()
+    assert empty == {"items": [], "facets": {
+        "total": 0, "watched": 0, "unwatched": 0, "deleted": 0, "kept": 0, "file_size": 0, "file_folders": {},
+    }, "next_cursor": None}
+
 def test_create_recording(con, client):
     response = client.post("/api/recordings", json={
         "program": {
@@ -976,3 +1172,177 @@ def test_create_recording_with_genre_code(con, client):
     # DBに文字列として保存されているか確認
     db_program = client.get(f"/api/programs/{res_json['program']['id']}").json()
     assert db_program["genre"] == "アニメ／特撮 - 国内アニメ"
+
+def test_get_digestions_視聴集計で8割未満の番組だけ返す(con, client):
+    con.executescript("""
+        INSERT INTO programs(id, event_id, service_id, name, start_time, duration, created_at) VALUES
+            (1, 11, 101, 'Test Program', unixepoch('2025-05-12T12:00:00+09:00'), 1800, unixepoch('2025-05-12T12:01:00+09:00'))
+        ;
+        INSERT INTO recordings(id, program_id, file_path, watched_at, deleted_at, created_at) VALUES
+            (1, 1, '//server/recorded/test1', NULL, NULL, unixepoch('2025-05-12T12:30:00+09:00'))
+        ;
+        INSERT INTO views(program_id, viewed_time, created_at) VALUES
+            (1, unixepoch('2025-05-12T12:05:00+09:00'), unixepoch('2025-05-12T12:05:00+09:00'))
+          , (1, unixepoch('2025-05-12T12:10:00+09:00'), unixepoch('2025-05-12T12:10:00+09:00'))
+          , (1, unixepoch('2025-05-12T12:15:00+09:00'), unixepoch('2025-05-12T12:15:00+09:00'))
+          , (1, unixepoch('2025-05-12T12:20:00+09:00'), unixepoch('2025-05-12T12:20:00+09:00'))
+        ;
+    """)
+    response1 = client.get("/api/digestions")
+    assert response1.status_code == 200
+    assert [d["id"] for d in response1.json()] == [1]
+    assert response1.json()[0]["viewed_times"] == [
+        "2025-05-12T12:05:00+09:00",
+        "2025-05-12T12:10:00+09:00",
+        "2025-05-12T12:15:00+09:00",
+        "2025-05-12T12:20:00+09:00",
+    ]
+
+    con.executescript("""
+        INSERT INTO views(program_id, viewed_time, created_at) VALUES
+            (1, unixepoch('2025-05-12T12:25:00+09:00'), unixepoch('2025-05-12T12:25:00+09:00'))
+        ;
+    """)
+    response2 = client.get("/api/digestions")
+    assert response2.status_code == 200
+    assert response2.json() == []
+
+    con.executescript("""
+        UPDATE view_segments SET end_time = unixepoch('2025-05-12T12:20:00+09:00'), samples = samples - 1 WHERE program_id = 1;
+    """)
+    response3 = client.get("/api/digestions")
+    assert [d["id"] for d in response3.json()] == [1]
+
+def test_get_programs_cursor(con, client):
+    con.executescript("""
+        INSERT INTO programs(id, event_id, service_id, name, start_time, duration, created_at) VALUES
+            (1, 11, 101, 'Test Program 1', unixepoch('2025-05-12T12:00:00+09:00'), 1800, unixepoch('2025-05-12T12:01:00+09:00'))
+          , (2, 12, 101, 'Test Program 2', unixepoch('2025-05-12T12:30:00+09:00'), 1800, unixepoch('2025-05-12T12:31:00+09:00'))
+          , (3, 13, 102, 'Test Program 3', unixepoch('2025-05-12T12:30:00+09:00'), 1800, unixepoch('2025-05-12T12:31:00+09:00'))
+        ;
+    """)
+    response1 = client.get("/api/programs?size=2")
+    assert response1.status_code == 200
+    assert [p["id"] for p in response1.json()] == [3, 2]
+    cursor = response1.headers["X-Next-Cursor"]
+
+    response2 = client.get(f"/api/programs?size=2&cursor={cursor}&page=5")    # cursor 指定時 page は無視される
+    assert response2.status_code == 200
+    assert [p["id"] for p in response2.json()] == [1]
+    assert "X-Next-Cursor" not in response2.headers
+
+def test_get_recordings_cursor(con, client):
+    con.executescript("""
+        INSERT INTO programs(id, event_id, service_id, name, start_time, duration, created_at) VALUES
+            (1, 11, 101, 'Test Program 1', unixepoch('2025-05-12T12:00:00+09:00'), 1800, unixepoch('2025-05-12T12:01:00+09:00'))
+          , (2, 12, 101, 'Test Program 2', unixepoch('2025-05-12T12:30:00+09:00'), 1800, unixepoch('2025-05-12T12:31:00+09:00'))
+        ;
+        INSERT INTO recordings(id, program_id, file_path, created_at) VALUES
+            (1, 1, '//server/recorded/test1', unixepoch('2025-05-12T12:30:00+09:00'))
+          , (2, 2, '//server/recorded/test2', unixepoch('2025-05-12T13:00:00+09:00'))
+          , (3, 2, '//server/recorded/test2_2', unixepoch('2025-05-12T13:01:00+09:00'))
+        ;
+    """)
+    ids = []
+    cursor = None
+    for _ in range(3):
+        response = client.get("/api/recordings", params={"size": 1, "cursor": cursor} if cursor else {"size": 1})
+        assert response.status_code == 200
+        ids += [r["id"] for r in response.json()]
+        cursor = response.headers["X-Next-Cursor"]
+    assert ids == [2, 3, 1]
+
+def test_get_series_cursor(con, client):
+    con.executescript("""
+        INSERT INTO series(id, name, created_at, modified_at) VALUES
+            (1, 'series1', unixepoch('2025-09-02T00:00:00+09:00'), unixepoch('2025-09-02T00:00:00+09:00'))
+          , (2, 'series2', unixepoch('2025-09-03T00:00:00+09:00'), unixepoch('2025-09-03T00:00:00+09:00'))
+        ;
+    """)
+    response1 = client.get("/api/series?size=1")
+    assert [s["id"] for s in response1.json()] == [2]
+    response2 = client.get(f"/api/series?size=1&cursor={response1.headers['X-Next-Cursor']}")
+    assert [s["id"] for s in response2.json()] == [1]
+
+def test_get_views_cursor(con, client):
+    con.executescript("""
+        INSERT INTO programs(id, event_id, service_id, name, start_time, duration, created_at) VALUES
+            (1, 11, 101, 'Test Program', unixepoch('2025-05-12T12:00:00+09:00'), 1800, unixepoch('2025-05-12T12:01:00+09:00'))
+        ;
+        INSERT INTO views(program_id, viewed_time, created_at) VALUES
+            (1, unixepoch('2025-05-12T12:05:00+09:00'), unixepoch('2025-05-12T14:05:00+09:00'))
+          , (1, unixepoch('2025-05-12T12:10:00+09:00'), unixepoch('2025-05-12T14:05:00+09:00'))
+        ;
+    """)
+    response1 = client.get("/api/views?size=1")
+    assert [v["viewed_time"] for v in response1.json()] == ["2025-05-12T12:10:00+09:00"]
+    response2 = client.get(f"/api/views?size=1&cursor={response1.headers['X-Next-Cursor']}")
+    assert [v["viewed_time"] for v in response2.json()] == ["2025-05-12T12:05:00+09:00"]
+
+def test_get_views_cursor_区間をまたいでページングする(con, client):
+    con.executescript("""
+        INSERT INTO programs(id, event_id, service_id, name, start_time, duration, created_at) VALUES
+            (1, 11, 101, 'Test Program', unixepoch('2025-05-12T12:00:00+09:00'), 1800, unixepoch('2025-05-12T12:01:00+09:00'))
+          , (2, 12, 101, 'Test Program 2', unixepoch('2025-05-12T12:30:00+09:00'), 1800, unixepoch('2025-05-12T12:31:00+09:00'))
+        ;
+        INSERT INTO view_segments(program_id, start_time, end_time, speed, samples, created_at, updated_at) VALUES
+            (1, unixepoch('2025-05-12T12:00:00+09:00'), unixepoch('2025-05-12T12:10:00+09:00'), 1.0, 3, unixepoch('2025-05-12T14:00:00+09:00'), unixepoch('2025-05-12T14:10:00+09:00'))
+          , (2, unixepoch('2025-05-12T12:30:00+09:00'), unixepoch('2025-05-12T12:35:00+09:00'), 1.0, 2, unixepoch('2025-05-12T13:30:00+09:00'), unixepoch('2025-05-12T13:35:00+09:00'))
+        ;
+    """)
+    pages = []
+    cursor = ""
+    for _ in range(3):
+        response = client.get(f"/api/views?size=2{cursor}")
+        pages.append([(v["program_id"], v["viewed_time"][11:16]) for v in response.json()])
+        cursor = f"&cursor={response.headers.get('X-Next-Cursor')}"
+    assert pages == [
+        [(1, "12:10"), (1, "12:05")],
+        [(1, "12:00"), (2, "12:35")],
+        [(2, "12:30")],
+    ]
+    # ページ番号で飛ばしても同じ並び
+    assert [(v["program_id"], v["viewed_time"][11:16]) for v in client.get("/api/views?size=2&page=2").json()] == pages[1]
+
+@pytest.mark.parametrize("cursor", ["not-a-cursor", "WzFd"])
+def test_get_programs_cursor_不正なカーソルは400(cursor, con, client):
+    response = client.get(f"/api/programs?cursor={cursor}")
+    assert response.status_code in (400, 422)
+
+def test_get_programs_全文検索(con, client):
+    con.executescript("""
+        INSERT INTO programs(id, event_id, service_id, name, start_time, duration, text, ext_text, created_at) VALUES
+            (1, 11, 101, 'ニュース７', unixepoch('2025-05-12T19:00:00+09:00'), 1800, '今日の天気予報', NULL, unixepoch('2025-05-12T12:01:00+09:00'))
+          , (2, 12, 101, '天気予報', unixepoch('2025-05-12T19:30:00+09:00'), 600, NULL, NULL, unixepoch('2025-05-12T12:31:00+09:00'))
+          , (3, 13, 102, 'アニメ', unixepoch('2025-05-12T20:00:00+09:00'), 1800, NULL, NULL, unixepoch('2025-05-12T12:31:00+09:00'))
+        ;
+        UPDATE programs SET name = '天気予報ミニ' WHERE id = 2;
+    """)
+    response1 = client.get("/api/programs?name=天気予報")
+    assert response1.status_code == 200
+    assert [p["id"] for p in response1.json()] == [2, 1]
+    assert response1.json()[0]["snippet"] == "<mark>天気予報</mark>ミニ"
+    assert response1.json()[1]["snippet"] == "今日の<mark>天気予報</mark>"
+
+    response2 = client.get("/api/programs?name=天気予報&sort=rank")
+    assert response2.status_code == 200
+    assert [p["id"] for p in response2.json()] == [2, 1]    # name に一致したほうが上位
+
+    response3 = client.get("/api/programs?name=アニ")    # 3文字未満は部分一致
+    assert [p["id"] for p in response3.json()] == [3]
+    assert response3.json()[0]["snippet"] is None
+
+def test_get_series_全文検索(con, client):
+    con.executescript("""
+        INSERT INTO series(id, name, created_at, modified_at) VALUES
+            (1, 'ウィッチウォッチ', unixepoch('2025-09-02T00:00:00+09:00'), unixepoch('2025-09-02T00:00:00+09:00'))
+          , (2, '推しの子', unixepoch('2025-09-03T00:00:00+09:00'), unixepoch('2025-09-03T00:00:00+09:00'))
+        ;
+    """)
+    response = client.get("/api/series?name=ウォッチ")
+    assert response.status_code == 200
+    assert [(s["id"], s["snippet"]) for s in response.json()] == [(1, "ウィッチ<mark>ウォッチ</mark>")]
+
+    client.patch("/api/series/1", json={"name": "魔法使いの嫁"})
+    assert client.get("/api/series?name=ウォッチ").json() == []
+    assert [s["id"] for s in client.get("/api/series?name=使いの").json()] == [1]
@@ -0,0 +1,43 @@
+PROGRAM = {
+    "event_id": 11,
+    "service_id": 101,
+    "name": "Test Program",
+    "start_time": "2025-05-12T23:00:00+09:00",
+    "duration": 1800,
+    "genre": "anime",
+}
+
+def test_get_stats_取り込んだ視聴を日次で集計する(con, client):
+    con.executescript("""
+        INSERT INTO series(id, name, created_at, modified_at) VALUES
+            (1, 'series1', unixepoch('2025-05-01T00:00:00+09:00'), unixepoch('2025-05-01T00:00:00+09:00'))
+        ;
+    """)
+    # 23:05 から 25:00 (放送日は同じ 5/12) まで、あとで別の日にもう1回
+    for viewed_time in [
+        "2025-05-12T23:05:00+09:00", "2025-05-12T23:10:00+09:00", "2025-05-12T23:15:00+09:00",
+        "2025-05-12T23:20:00+09:00", "2025-05-12T23:25:00+09:00", "2025-05-13T00:00:00+09:00",
+    ]:
+        assert client.post("/api/views", json={"program": PROGRAM, "viewed_time": viewed_time}).status_code == 200
+    con.execute("INSERT INTO program_series(program_id, series_id) VALUES (1, 1)")
+    assert client.post("/api/views", json={
+        "program": PROGRAM, "viewed_time": "2025-05-14T20:00:00+09:00", "speed": 1.5,
+    }).status_code == 200
+
+    response = client.get("/api/stats?period=day&group_by=series")
+    assert response.status_code == 200
+    assert response.json() == [
+        {
+            "period": "2025-05-12", "key": 0, "name": None,
+            "watched_seconds": 1800.0, "watched_hours": 0.5, "programs_started": 1, "programs_finished": 1,
+        },
+        {
+            "period": "2025-05-14", "key": 1, "name": "series1",
+            "watched_seconds": 450.0, "watched_hours": 0.125, "programs_started": 0, "programs_finished": 0,
+        },
+    ]
+
+    response = client.get("/api/stats?from_=2025-05-13&to=2025-05-31&group_by=genre")
+    assert [(s["period"], s["key"], s["watched_seconds"]) for s in response.json()] == [("2025-05", "anime", 450.0)]
+    response = client.get("/api/stats?period=year")
+    assert [(s["period"], s["key"], s["watched_seconds"]) for s in response.json()] == [("2025", None, 2250.0)]
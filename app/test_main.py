@@ -61,3 +61,33 @@ def test_programs(con, client):
         """)
     response = client.get("/programs")
     assert response.status_code == 200
+
+def test_programs_with_facets(con, client):
+    con.executescript("""
+        INSERT INTO programs (id, event_id, service_id, name, start_time, duration, created_at) VALUES
+            (1, 11, 101, 'Test Program', unixepoch('2025-05-12T12:00:00+09:00'), 1800, unixepoch('2025-05-12T12:01:00+09:00'))
+        ;
+        INSERT INTO recordings (id, program_id, file_path, watched_at, deleted_at, created_at) VALUES
+            (1, 1, '//recorded/test1', unixepoch('2025-05-12T12:30:00+09:00'), NULL, 0)
+        ;
+        """)
+    response = client.get("/programs", params={"with_facets": "true"})
+    assert response.status_code == 200
+    assert "Test Program" in response.text
+    assert "全 1 件" in response.text
+
+def test_recordings_with_facets(con, client):
+    con.executescript("""
+        INSERT INTO programs (id, event_id, service_id, name, start_time, duration, created_at) VALUES
+            (1, 11, 101, 'Test Program', unixepoch('2025-05-12T12:00:00+09:00'), 1800, unixepoch('2025-05-12T12:01:00+09:00'))
+        ;
+        INSERT INTO recordings (id, program_id, file_path, watched_at, deleted_at, created_at) VALUES
+            (1, 1, '//recorded/test1', NULL, NULL, 0)
+          , (2, 1, '//recorded/test2', NULL, NULL, 0)
+        ;
+        """)
+    response = client.get("/recordings", params={"with_facets": "true"})
+    assert response.status_code == 200
+    assert "Test Program" in response.text
+    assert "全 2 件" in response.text
+    assert "test1: 1 件" in response.text
@@ -0,0 +1,6 @@
+-- recordings.file_folder を追加して既存行を埋める
+ALTER TABLE {DATASET}.recordings ADD COLUMN IF NOT EXISTS file_folder STRING;
+
+UPDATE {DATASET}.recordings
+SET file_folder = SPLIT(file_path, '/')[SAFE_OFFSET(3)]
+WHERE file_folder IS NULL;
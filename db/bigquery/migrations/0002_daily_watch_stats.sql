@@ -0,0 +1,50 @@
+-- 視聴の日次集計を作り、既存の視聴から埋める
+CREATE TABLE IF NOT EXISTS {DATASET}.daily_watch_stats (
+  day DATE NOT NULL,
+  series_id STRING NOT NULL,
+  genre STRING NOT NULL,
+  service_id INT64 NOT NULL,
+  watched_seconds FLOAT64 NOT NULL,
+  programs_started INT64 NOT NULL,
+  programs_finished INT64 NOT NULL,
+  PRIMARY KEY(day, series_id, genre, service_id) NOT ENFORCED
+)
+PARTITION BY day;
+
+-- 見終わった日は、8割に達している番組の最後の視聴の日とする
+INSERT INTO {DATASET}.daily_watch_stats(day, series_id, genre, service_id, watched_seconds, programs_started, programs_finished)
+WITH samples AS (
+  SELECT
+    p.id,
+    p.start_time,
+    p.duration,
+    COALESCE((SELECT MIN(series_id) FROM {DATASET}.program_series ps WHERE ps.program_id = p.id), '') AS series_id,
+    COALESCE(p.genre, '') AS genre,
+    p.service_id,
+    v.viewed_time,
+    DATE(TIMESTAMP_SUB(v.viewed_time, INTERVAL 5 HOUR), 'Asia/Tokyo') AS day,
+    5 * 60 * COALESCE(v.speed, 1.0) AS seconds
+  FROM {DATASET}.views v
+  JOIN {DATASET}.programs p ON p.id = v.program_id
+), watched AS (
+  SELECT s.id, COUNT(DISTINCT slot) AS minutes
+  FROM samples s, UNNEST(GENERATE_ARRAY(
+    CAST(FLOOR((TIMESTAMP_DIFF(s.viewed_time, s.start_time, SECOND) - 5 * 60 + 30) / 60) AS INT64),
+    CAST(FLOOR((TIMESTAMP_DIFF(s.viewed_time, s.start_time, SECOND) + 30) / 60) AS INT64) - 1
+  )) AS slot
+  WHERE slot >= 0 AND slot < DIV(s.duration + 59, 60)
+  GROUP BY s.id
+)
+SELECT day, series_id, genre, service_id, SUM(seconds), SUM(started), SUM(finished)
+FROM (
+  SELECT day, series_id, genre, service_id, seconds, 0 AS started, 0 AS finished FROM samples
+  UNION ALL
+  SELECT MIN(day), ANY_VALUE(series_id), ANY_VALUE(genre), ANY_VALUE(service_id), 0, 1, 0
+  FROM samples GROUP BY id
+  UNION ALL
+  SELECT MAX(s.day), ANY_VALUE(s.series_id), ANY_VALUE(s.genre), ANY_VALUE(s.service_id), 0, 0, 1
+  FROM samples s JOIN watched w ON w.id = s.id
+  GROUP BY s.id
+  HAVING ANY_VALUE(w.minutes) >= DIV(ANY_VALUE(s.duration) + 59, 60) * 0.8
+)
+GROUP BY day, series_id, genre, service_id;
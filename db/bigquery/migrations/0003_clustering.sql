@@ -0,0 +1,59 @@
+-- programs, recordings, views, series にクラスタリングを付け、既存の行をその順に書き直す
+-- 列と制約は schemas.sql と同じ。書き直している間に入った行は消えるので、取り込みを止めてから実行する
+CREATE OR REPLACE TABLE {DATASET}.programs (
+  id STRING NOT NULL,
+  event_id INT64 NOT NULL,
+  service_id INT64 NOT NULL,
+  name STRING NOT NULL,
+  start_time TIMESTAMP NOT NULL,
+  duration INT64 NOT NULL,
+  text STRING,
+  ext_text STRING,
+  genre STRING,
+  created_at TIMESTAMP NOT NULL,
+  PRIMARY KEY(id) NOT ENFORCED
+)
+PARTITION BY DATE(start_time)
+CLUSTER BY service_id, event_id
+AS SELECT id, event_id, service_id, name, start_time, duration, text, ext_text, genre, created_at
+FROM {DATASET}.programs;
+
+CREATE OR REPLACE TABLE {DATASET}.recordings (
+  id STRING NOT NULL,
+  program_id STRING NOT NULL,
+  file_path STRING NOT NULL,
+  file_folder STRING,
+  file_size INT64,
+  watched_at TIMESTAMP,
+  deleted_at TIMESTAMP,
+  created_at TIMESTAMP NOT NULL,
+  PRIMARY KEY(id) NOT ENFORCED,
+  FOREIGN KEY(program_id) REFERENCES {DATASET}.programs(id) NOT ENFORCED
+)
+PARTITION BY DATE(created_at)
+CLUSTER BY program_id, deleted_at
+AS SELECT id, program_id, file_path, file_folder, file_size, watched_at, deleted_at, created_at
+FROM {DATASET}.recordings;
+
+CREATE OR REPLACE TABLE {DATASET}.views (
+  program_id STRING NOT NULL,
+  viewed_time TIMESTAMP NOT NULL,
+  speed FLOAT64,
+  created_at TIMESTAMP NOT NULL,
+  FOREIGN KEY(program_id) REFERENCES {DATASET}.programs(id) NOT ENFORCED
+)
+PARTITION BY DATE(viewed_time)
+CLUSTER BY program_id
+AS SELECT program_id, viewed_time, speed, created_at
+FROM {DATASET}.views;
+
+CREATE OR REPLACE TABLE {DATASET}.series (
+  id STRING NOT NULL,
+  name STRING NOT NULL,
+  created_at TIMESTAMP NOT NULL,
+  modified_at TIMESTAMP NOT NULL,
+  PRIMARY KEY(id) NOT ENFORCED
+)
+CLUSTER BY name
+AS SELECT id, name, created_at, modified_at
+FROM {DATASET}.series;
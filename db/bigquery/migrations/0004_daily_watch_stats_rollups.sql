@@ -0,0 +1,10 @@
+-- 視聴をストリーミング挿入するときに、日次集計へまとめて足したところを記録する
+-- それまでの視聴は取り込みの MERGE で足してあるので、今から先を足す
+CREATE TABLE IF NOT EXISTS {DATASET}.daily_watch_stats_rollups (
+  rolled_up_to TIMESTAMP NOT NULL,
+  created_at TIMESTAMP NOT NULL
+);
+INSERT INTO {DATASET}.daily_watch_stats_rollups(rolled_up_to, created_at)
+SELECT CURRENT_TIMESTAMP(), CURRENT_TIMESTAMP()
+FROM (SELECT 1)
+WHERE NOT EXISTS (SELECT 1 FROM {DATASET}.daily_watch_stats_rollups);
@@ -0,0 +1,47 @@
+-- 番組ごとの視聴の集計を作り、既存の視聴から埋める
+CREATE TABLE IF NOT EXISTS {DATASET}.program_view_stats (
+  program_id STRING NOT NULL,
+  viewed_times ARRAY<TIMESTAMP>,
+  -- 視聴済みの分スロット (ビット i が番組開始から i 分目、LSB から詰める)
+  watched_bitmap BYTES NOT NULL,
+  -- watched_bitmap の立っているビット数
+  watched_minutes INT64 NOT NULL,
+  PRIMARY KEY(program_id) NOT ENFORCED,
+  FOREIGN KEY(program_id) REFERENCES {DATASET}.programs(id) NOT ENFORCED
+)
+CLUSTER BY program_id;
+
+INSERT INTO {DATASET}.program_view_stats(program_id, viewed_times, watched_bitmap, watched_minutes)
+WITH v AS (
+  SELECT program_id, viewed_time, ANY_VALUE(speed) AS speed
+  FROM {DATASET}.views
+  GROUP BY program_id, viewed_time
+), slots AS (
+  SELECT DISTINCT v.program_id, slot
+  FROM v
+  JOIN {DATASET}.programs p ON p.id = v.program_id,
+  UNNEST(GENERATE_ARRAY(
+    GREATEST(CAST(FLOOR((TIMESTAMP_DIFF(v.viewed_time, p.start_time, SECOND) - 5 * 60 * COALESCE(v.speed, 1.0) + 30) / 60) AS INT64), 0),
+    LEAST(CAST(FLOOR((TIMESTAMP_DIFF(v.viewed_time, p.start_time, SECOND) + 30) / 60) AS INT64), DIV(p.duration + 59, 60)) - 1
+  )) AS slot
+), bytes AS (
+  SELECT p.id AS program_id, i, COALESCE(BIT_OR(1 << MOD(slots.slot, 8)), 0) AS value, COUNT(slots.slot) AS minutes
+  FROM {DATASET}.programs p
+  CROSS JOIN UNNEST(GENERATE_ARRAY(0, DIV(DIV(p.duration + 59, 60) + 7, 8) - 1)) AS i
+  LEFT JOIN slots ON slots.program_id = p.id AND DIV(slots.slot, 8) = i
+  WHERE p.id IN (SELECT program_id FROM v)
+  GROUP BY p.id, i
+)
+SELECT
+  times.program_id,
+  times.viewed_times,
+  COALESCE(bitmap.watched_bitmap, b''),
+  COALESCE(bitmap.watched_minutes, 0)
+FROM (
+  SELECT program_id, ARRAY_AGG(viewed_time ORDER BY viewed_time) AS viewed_times
+  FROM v GROUP BY program_id
+) AS times
+LEFT JOIN (
+  SELECT program_id, CODE_POINTS_TO_BYTES(ARRAY_AGG(value ORDER BY i)) AS watched_bitmap, SUM(minutes) AS watched_minutes
+  FROM bytes GROUP BY program_id
+) AS bitmap USING (program_id);
@@ -11,12 +11,16 @@ CREATE TABLE IF NOT EXISTS {DATASET}.programs (
   created_at TIMESTAMP NOT NULL,
   PRIMARY KEY(id) NOT ENFORCED
 )
-PARTITION BY DATE(start_time);
+PARTITION BY DATE(start_time)
+-- get_or_create は event_id と service_id で引く
+CLUSTER BY service_id, event_id;
 
 CREATE TABLE IF NOT EXISTS {DATASET}.recordings (
   id STRING NOT NULL,
   program_id STRING NOT NULL,
   file_path STRING NOT NULL,
+  -- SPLIT(file_path, '/')[SAFE_OFFSET(3)]。生成列がないので書き込み時に入れる
+  file_folder STRING,
   file_size INT64,
   watched_at TIMESTAMP,
   deleted_at TIMESTAMP,
@@ -24,7 +28,9 @@ CREATE TABLE IF NOT EXISTS {DATASET}.recordings (
   PRIMARY KEY(id) NOT ENFORCED,
   FOREIGN KEY(program_id) REFERENCES {DATASET}.programs(id) NOT ENFORCED
 )
-PARTITION BY DATE(created_at);
+PARTITION BY DATE(created_at)
+-- 番組の録画は program_id で引き、削除済みかで絞る
+CLUSTER BY program_id, deleted_at;
 
 CREATE TABLE IF NOT EXISTS {DATASET}.views (
   program_id STRING NOT NULL,
@@ -33,7 +39,9 @@ CREATE TABLE IF NOT EXISTS {DATASET}.views (
   created_at TIMESTAMP NOT NULL,
   FOREIGN KEY(program_id) REFERENCES {DATASET}.programs(id) NOT ENFORCED
 )
-PARTITION BY DATE(viewed_time);
+PARTITION BY DATE(viewed_time)
+-- 番組の視聴は program_id で引く
+CLUSTER BY program_id;
 
 CREATE TABLE IF NOT EXISTS {DATASET}.series (
   id STRING NOT NULL,
@@ -41,7 +49,9 @@ CREATE TABLE IF NOT EXISTS {DATASET}.series (
   created_at TIMESTAMP NOT NULL,
   modified_at TIMESTAMP NOT NULL,
   PRIMARY KEY(id) NOT ENFORCED
-);
+)
+-- 取り込みではシリーズを名前で引く
+CLUSTER BY name;
 
 CREATE TABLE IF NOT EXISTS {DATASET}.program_series (
   program_id STRING NOT NULL,
@@ -50,3 +60,41 @@ CREATE TABLE IF NOT EXISTS {DATASET}.program_series (
   FOREIGN KEY(program_id) REFERENCES {DATASET}.programs (id) NOT ENFORCED,
   FOREIGN KEY(series_id)  REFERENCES {DATASET}.series (id) NOT ENFORCED
 );
+
+-- 番組ごとの視聴の集計。消化一覧は views を読まずにこれだけで絞り込む
+-- 取り込みで views から作り直す。視聴をストリーミング挿入するときは /api/admin/stats/rollup で作り直す
+CREATE TABLE IF NOT EXISTS {DATASET}.program_view_stats (
+  program_id STRING NOT NULL,
+  viewed_times ARRAY<TIMESTAMP>,
+  -- 視聴済みの分スロット (ビット i が番組開始から i 分目、LSB から詰める)
+  watched_bitmap BYTES NOT NULL,
+  -- watched_bitmap の立っているビット数
+  watched_minutes INT64 NOT NULL,
+  PRIMARY KEY(program_id) NOT ENFORCED,
+  FOREIGN KEY(program_id) REFERENCES {DATASET}.programs(id) NOT ENFORCED
+)
+CLUSTER BY program_id;
+
+-- 放送日 (JST 5:00 区切り) × シリーズ × ジャンル × サービスごとの視聴の日次集計
+-- 取り込みで MERGE して足し込む。視聴をストリーミング挿入するときは /api/admin/stats/rollup でまとめて足す
+-- シリーズは番組のシリーズのうち id の小さいほう、なければ ''。ジャンルがなければ ''
+CREATE TABLE IF NOT EXISTS {DATASET}.daily_watch_stats (
+  day DATE NOT NULL,
+  series_id STRING NOT NULL,
+  genre STRING NOT NULL,
+  service_id INT64 NOT NULL,
+  -- 1サンプル5分を再生速度で重み付けした視聴秒数
+  watched_seconds FLOAT64 NOT NULL,
+  -- その日に初めて視聴した番組数
+  programs_started INT64 NOT NULL,
+  -- その日に視聴済みの分が8割に達した番組数
+  programs_finished INT64 NOT NULL,
+  PRIMARY KEY(day, series_id, genre, service_id) NOT ENFORCED
+)
+PARTITION BY day;
+
+-- 日次集計にまとめて足した視聴の created_at の上限 (この時刻より前に取り込んだ視聴は足してある)
+CREATE TABLE IF NOT EXISTS {DATASET}.daily_watch_stats_rollups (
+  rolled_up_to TIMESTAMP NOT NULL,
+  created_at TIMESTAMP NOT NULL
+);
@@ -0,0 +1,28 @@
+-- 放送年ごとのアーカイブ (db/archive/tv-YYYY.db) 。{SCHEMA} は ATTACH したスキーマ名
+-- 本体の view_segments, recordings と同じ列を持つ。生成列はそのまま値として入れる
+CREATE TABLE IF NOT EXISTS {SCHEMA}."view_segments"(
+    id INTEGER PRIMARY KEY
+  , program_id INTEGER NOT NULL
+  , start_time INTEGER NOT NULL
+  , end_time INTEGER NOT NULL
+  , speed REAL
+  , samples INTEGER NOT NULL
+  , created_at INTEGER NOT NULL
+  , updated_at INTEGER NOT NULL
+) STRICT
+;
+CREATE INDEX IF NOT EXISTS {SCHEMA}."view_segments_program_id_end_time" ON view_segments(program_id, end_time);
+
+CREATE TABLE IF NOT EXISTS {SCHEMA}."recordings"(
+    id INTEGER PRIMARY KEY
+  , program_id INTEGER NOT NULL
+  , file_path TEXT NOT NULL
+  , file_size INTEGER
+  , watched_at INTEGER
+  , deleted_at INTEGER
+  , created_at INTEGER NOT NULL
+  , server TEXT
+  , file_folder TEXT
+) STRICT
+;
+CREATE INDEX IF NOT EXISTS {SCHEMA}."recordings_program_id_deleted_at_watched_at" ON recordings(program_id, deleted_at, watched_at);
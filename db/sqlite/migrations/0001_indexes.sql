@@ -0,0 +1,25 @@
+-- 視聴状態の元のテーブル。0005 で view_segments にまとめて消すので、schemas.sql ではなくここで作る
+CREATE TABLE IF NOT EXISTS "views"(
+    program_id INTEGER NOT NULL
+  , viewed_time INTEGER NOT NULL
+  , speed REAL
+  , created_at INTEGER NOT NULL
+  , FOREIGN KEY (program_id) REFERENCES programs(id)
+) STRICT
+;
+-- get_or_create の (service_id, event_id, start_time) 検索
+CREATE INDEX IF NOT EXISTS "programs_service_id_event_id_start_time" ON programs(service_id, event_id, start_time);
+-- 一覧の start_time 順と期間絞り込み
+CREATE INDEX IF NOT EXISTS "programs_start_time" ON programs(start_time);
+-- 番組ごとの視聴 (program_view_stats の再集計も含めてカバーする)
+CREATE INDEX IF NOT EXISTS "views_program_id_viewed_time" ON views(program_id, viewed_time, speed);
+-- 視聴一覧の created_at 順
+CREATE INDEX IF NOT EXISTS "views_created_at" ON views(created_at);
+-- 番組ごとの録画 (未視聴・未削除の EXISTS をカバーする)
+CREATE INDEX IF NOT EXISTS "recordings_program_id_deleted_at_watched_at" ON recordings(program_id, deleted_at, watched_at);
+-- シリーズから番組を引く (主キーは program_id が先頭)
+CREATE INDEX IF NOT EXISTS "program_series_series_id_program_id" ON program_series(series_id, program_id);
+-- get_or_create・名前変更時の名前検索
+CREATE INDEX IF NOT EXISTS "series_name" ON series(name);
+-- シリーズ一覧の modified_at 順
+CREATE INDEX IF NOT EXISTS "series_modified_at" ON series(modified_at);
@@ -0,0 +1,47 @@
+-- 番組名・説明の全文検索 (trigram なので日本語も3文字以上の部分一致で引ける)
+CREATE VIRTUAL TABLE IF NOT EXISTS "programs_fts" USING fts5(
+    name, text, ext_text
+  , content='programs', content_rowid='id'
+  , tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS "programs_fts_insert"
+AFTER INSERT ON programs
+BEGIN
+  INSERT INTO programs_fts(rowid, name, text, ext_text) VALUES(NEW.id, NEW.name, NEW.text, NEW.ext_text);
+END;
+CREATE TRIGGER IF NOT EXISTS "programs_fts_delete"
+AFTER DELETE ON programs
+BEGIN
+  INSERT INTO programs_fts(programs_fts, rowid, name, text, ext_text) VALUES('delete', OLD.id, OLD.name, OLD.text, OLD.ext_text);
+END;
+CREATE TRIGGER IF NOT EXISTS "programs_fts_update"
+AFTER UPDATE OF name, text, ext_text ON programs
+BEGIN
+  INSERT INTO programs_fts(programs_fts, rowid, name, text, ext_text) VALUES('delete', OLD.id, OLD.name, OLD.text, OLD.ext_text);
+  INSERT INTO programs_fts(rowid, name, text, ext_text) VALUES(NEW.id, NEW.name, NEW.text, NEW.ext_text);
+END;
+INSERT INTO programs_fts(programs_fts) VALUES('rebuild');
+
+-- シリーズ名の全文検索
+CREATE VIRTUAL TABLE IF NOT EXISTS "series_fts" USING fts5(
+    name
+  , content='series', content_rowid='id'
+  , tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS "series_fts_insert"
+AFTER INSERT ON series
+BEGIN
+  INSERT INTO series_fts(rowid, name) VALUES(NEW.id, NEW.name);
+END;
+CREATE TRIGGER IF NOT EXISTS "series_fts_delete"
+AFTER DELETE ON series
+BEGIN
+  INSERT INTO series_fts(series_fts, rowid, name) VALUES('delete', OLD.id, OLD.name);
+END;
+CREATE TRIGGER IF NOT EXISTS "series_fts_update"
+AFTER UPDATE OF name ON series
+BEGIN
+  INSERT INTO series_fts(series_fts, rowid, name) VALUES('delete', OLD.id, OLD.name);
+  INSERT INTO series_fts(rowid, name) VALUES(NEW.id, NEW.name);
+END;
+INSERT INTO series_fts(series_fts) VALUES('rebuild');
@@ -0,0 +1,42 @@
+-- file_path (//server/folder/to/file) の server と folder を生成列として持つ
+-- STORED の生成列は ALTER TABLE ADD COLUMN できないので recordings を作り直す
+CREATE TABLE "recordings_new"(
+    id INTEGER PRIMARY KEY
+  , program_id INTEGER NOT NULL
+  , file_path TEXT NOT NULL
+  , file_size INTEGER
+  , watched_at INTEGER
+  , deleted_at INTEGER
+  , created_at INTEGER NOT NULL
+    -- '//' の直後から次の '/' まで
+  , server TEXT GENERATED ALWAYS AS (
+      CASE WHEN substr(file_path, 1, 2) = '//' AND instr(substr(file_path, 3), '/') > 0
+        THEN substr(file_path, 3, instr(substr(file_path, 3), '/') - 1)
+      END
+    ) STORED
+    -- server の次の要素 (file_path.split("/")[3] と同じ)
+  , file_folder TEXT GENERATED ALWAYS AS (
+      CASE WHEN substr(file_path, 1, 2) = '//' AND instr(substr(file_path, 3), '/') > 0
+        THEN CASE WHEN instr(substr(file_path, 3 + instr(substr(file_path, 3), '/')), '/') > 0
+          THEN substr(
+            substr(file_path, 3 + instr(substr(file_path, 3), '/')),
+            1,
+            instr(substr(file_path, 3 + instr(substr(file_path, 3), '/')), '/') - 1
+          )
+          ELSE substr(file_path, 3 + instr(substr(file_path, 3), '/'))
+        END
+      END
+    ) STORED
+  , FOREIGN KEY (program_id) REFERENCES programs(id)
+) STRICT
+;
+INSERT INTO recordings_new(id, program_id, file_path, file_size, watched_at, deleted_at, created_at)
+SELECT id, program_id, file_path, file_size, watched_at, deleted_at, created_at FROM recordings
+;
+DROP TABLE recordings;
+ALTER TABLE recordings_new RENAME TO recordings;
+
+-- 番組ごとの録画 (0001 で作ったものを作り直す)
+CREATE INDEX "recordings_program_id_deleted_at_watched_at" ON recordings(program_id, deleted_at, watched_at);
+-- 録画一覧のフォルダ絞り込み (未視聴・未削除まで等価で引ける)
+CREATE INDEX "recordings_file_folder_deleted_at_watched_at" ON recordings(file_folder, deleted_at, watched_at);
@@ -0,0 +1,37 @@
+-- 放送日 (JST 5:00 区切り) 。(service_id, event_id, broadcast_day) を番組の一意キーにする
+ALTER TABLE programs ADD COLUMN broadcast_day INTEGER GENERATED ALWAYS AS ((start_time + 4 * 3600) / 86400) VIRTUAL;
+
+-- 既存の重複は start_time の遅いほう (同じなら id の小さいほう) に寄せる
+CREATE TEMP TABLE "program_merge" AS
+SELECT id, keep_id FROM (
+  SELECT
+      id
+    , FIRST_VALUE(id) OVER (PARTITION BY service_id, event_id, broadcast_day ORDER BY start_time DESC, id) AS keep_id
+  FROM programs
+)
+WHERE id != keep_id
+;
+UPDATE views SET program_id = (SELECT keep_id FROM program_merge WHERE program_merge.id = views.program_id)
+WHERE program_id IN (SELECT id FROM program_merge);
+UPDATE recordings SET program_id = (SELECT keep_id FROM program_merge WHERE program_merge.id = recordings.program_id)
+WHERE program_id IN (SELECT id FROM program_merge);
+INSERT OR IGNORE INTO program_series(program_id, series_id)
+SELECT program_merge.keep_id, program_series.series_id
+FROM program_series INNER JOIN program_merge ON program_merge.id = program_series.program_id;
+DELETE FROM program_series WHERE program_id IN (SELECT id FROM program_merge);
+DELETE FROM programs WHERE id IN (SELECT id FROM program_merge);
+DROP TABLE program_merge;
+
+CREATE UNIQUE INDEX "programs_service_id_event_id_broadcast_day" ON programs(service_id, event_id, broadcast_day);
+-- get_or_create は一意キーの UPSERT で引くので不要
+DROP INDEX IF EXISTS "programs_service_id_event_id_start_time";
+
+-- UPSERT は毎回 UPDATE になるので、全文検索の索引は中身が変わったときだけ更新する
+DROP TRIGGER IF EXISTS "programs_fts_update";
+CREATE TRIGGER "programs_fts_update"
+AFTER UPDATE OF name, text, ext_text ON programs
+WHEN OLD.name IS NOT NEW.name OR OLD.text IS NOT NEW.text OR OLD.ext_text IS NOT NEW.ext_text
+BEGIN
+  INSERT INTO programs_fts(programs_fts, rowid, name, text, ext_text) VALUES('delete', OLD.id, OLD.name, OLD.text, OLD.ext_text);
+  INSERT INTO programs_fts(rowid, name, text, ext_text) VALUES(NEW.id, NEW.name, NEW.text, NEW.ext_text);
+END;
@@ -0,0 +1,103 @@
+-- 5分ごとの視聴サンプルを、同じ番組・同じ再生速度で続いている区間にまとめる
+CREATE TABLE "view_segments"(
+    id INTEGER PRIMARY KEY
+  , program_id INTEGER NOT NULL
+  , start_time INTEGER NOT NULL
+  , end_time INTEGER NOT NULL
+  , speed REAL
+    -- まとめたサンプル数
+  , samples INTEGER NOT NULL
+    -- 最初と最後のサンプルの created_at
+  , created_at INTEGER NOT NULL
+  , updated_at INTEGER NOT NULL
+  , FOREIGN KEY (program_id) REFERENCES programs(id)
+) STRICT
+;
+-- 番組ごとの区間と、続きのサンプルをつなげる区間の検索
+CREATE INDEX "view_segments_program_id_end_time" ON view_segments(program_id, end_time);
+-- 視聴一覧の新しい順
+CREATE INDEX "view_segments_updated_at" ON view_segments(updated_at);
+
+-- 既存の views を区間にまとめる (前のサンプルから 0 秒超 7分30秒以内なら続き)
+INSERT INTO view_segments(program_id, start_time, end_time, speed, samples, created_at, updated_at)
+SELECT program_id, MIN(viewed_time), MAX(viewed_time), speed, COUNT(*), MIN(created_at), MAX(created_at)
+FROM (
+  SELECT *, SUM(is_new) OVER (PARTITION BY program_id, speed ORDER BY viewed_time, rowid) AS segment
+  FROM (
+    SELECT
+        program_id, viewed_time, speed, created_at, rowid
+      , CASE WHEN viewed_time - LAG(viewed_time) OVER w BETWEEN 1 AND 450 THEN 0 ELSE 1 END AS is_new
+    FROM views
+    WINDOW w AS (PARTITION BY program_id, speed ORDER BY viewed_time, rowid)
+  )
+)
+GROUP BY program_id, speed, segment
+;
+DROP TABLE views;
+
+-- デバッグ・手作業の投入用: 区間をサンプルに展開したビュー。両端以外の viewed_time, created_at は等間隔で補間する
+-- アプリはこのビューを読み書きせず、view_segments を直接使う (再帰で全区間を展開するので一覧には使わない)
+CREATE VIEW "views"(program_id, viewed_time, speed, created_at) AS
+WITH RECURSIVE samples(id, k) AS (
+  SELECT id, 0 FROM view_segments
+  UNION ALL
+  SELECT samples.id, k + 1 FROM samples INNER JOIN view_segments ON view_segments.id = samples.id
+  WHERE k + 1 < view_segments.samples
+)
+SELECT
+    program_id
+  , start_time + (end_time - start_time) * k / MAX(samples - 1, 1)
+  , speed
+  , created_at + (updated_at - created_at) * k / MAX(samples - 1, 1)
+FROM samples INNER JOIN view_segments USING (id)
+;
+-- views への INSERT は、続きになる区間があれば延ばし、なければ区間を作る
+CREATE TRIGGER "views_insert_view_segments"
+INSTEAD OF INSERT ON views
+BEGIN
+  UPDATE view_segments SET end_time = NEW.viewed_time, samples = samples + 1, updated_at = NEW.created_at
+  WHERE id = (
+    SELECT id FROM view_segments
+    WHERE program_id = NEW.program_id AND speed IS NEW.speed
+    AND end_time BETWEEN NEW.viewed_time - 450 AND NEW.viewed_time - 1
+    ORDER BY end_time DESC
+    LIMIT 1
+  );
+  INSERT INTO view_segments(program_id, start_time, end_time, speed, samples, created_at, updated_at)
+  SELECT NEW.program_id, NEW.viewed_time, NEW.viewed_time, NEW.speed, 1, NEW.created_at, NEW.created_at
+  WHERE changes() = 0;
+END;
+
+-- 区間は番組あたり数件なので、変わった番組の集計を作り直す
+CREATE TRIGGER "view_segments_insert_program_view_stats"
+AFTER INSERT ON view_segments
+BEGIN
+  DELETE FROM program_view_stats WHERE program_id = NEW.program_id;
+  INSERT INTO program_view_stats(program_id, view_count, first_viewed, last_viewed, watched_seconds, viewed_times_json)
+  SELECT program_id, SUM(samples), MIN(start_time), MAX(end_time), SUM(samples * 5 * 60 * COALESCE(speed, 1.0)), json_group_array(json_array(start_time, end_time, samples))
+  FROM (SELECT * FROM view_segments WHERE program_id = NEW.program_id ORDER BY start_time, id) GROUP BY program_id;
+END;
+CREATE TRIGGER "view_segments_update_program_view_stats"
+AFTER UPDATE ON view_segments
+BEGIN
+  DELETE FROM program_view_stats WHERE program_id IN (OLD.program_id, NEW.program_id);
+  INSERT INTO program_view_stats(program_id, view_count, first_viewed, last_viewed, watched_seconds, viewed_times_json)
+  SELECT program_id, SUM(samples), MIN(start_time), MAX(end_time), SUM(samples * 5 * 60 * COALESCE(speed, 1.0)), json_group_array(json_array(start_time, end_time, samples))
+  FROM (SELECT * FROM view_segments WHERE program_id IN (OLD.program_id, NEW.program_id) ORDER BY program_id, start_time, id) GROUP BY program_id;
+END;
+CREATE TRIGGER "view_segments_delete_program_view_stats"
+AFTER DELETE ON view_segments
+BEGIN
+  DELETE FROM program_view_stats WHERE program_id = OLD.program_id;
+  INSERT INTO program_view_stats(program_id, view_count, first_viewed, last_viewed, watched_seconds, viewed_times_json)
+  SELECT program_id, SUM(samples), MIN(start_time), MAX(end_time), SUM(samples * 5 * 60 * COALESCE(speed, 1.0)), json_group_array(json_array(start_time, end_time, samples))
+  FROM (SELECT * FROM view_segments WHERE program_id = OLD.program_id ORDER BY start_time, id) GROUP BY program_id;
+END;
+
+-- 集計を区間から作り直す
+DELETE FROM program_view_stats;
+INSERT INTO program_view_stats(program_id, view_count, first_viewed, last_viewed, watched_seconds, viewed_times_json)
+SELECT program_id, SUM(samples), MIN(start_time), MAX(end_time), SUM(samples * 5 * 60 * COALESCE(speed, 1.0)), json_group_array(json_array(start_time, end_time, samples))
+FROM (SELECT * FROM view_segments ORDER BY program_id, start_time, id)
+GROUP BY program_id
+;
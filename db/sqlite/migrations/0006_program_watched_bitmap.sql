@@ -0,0 +1,194 @@
+-- 番組ごとに視聴済みの分スロットをビットマップ (BLOB) で持つ (ビット i が番組開始から i 分目、LSB から詰める)
+-- 集計は関数を使わず SQL だけで作る。サンプルが増えたときは、そのサンプルが覆うバイトだけを OR で書き換える
+ALTER TABLE program_view_stats ADD COLUMN watched_bitmap BLOB;
+-- watched_bitmap の立っているビット数
+ALTER TABLE program_view_stats ADD COLUMN watched_minutes INTEGER;
+
+-- 0 から 4095 までの整数。区間のサンプルと分スロットを再帰なしで展開する
+CREATE TABLE "integers"(i INTEGER PRIMARY KEY) STRICT;
+INSERT INTO integers(i)
+WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i < 4095)
+SELECT i FROM n;
+
+-- 1バイトの値と BLOB と立っているビット数の対応。SQLite 3.40 には unhex() がなく、整数から BLOB を作れないので表から引く
+CREATE TABLE "bitmap_bytes"(value INTEGER PRIMARY KEY, byte BLOB NOT NULL UNIQUE, bits INTEGER NOT NULL) STRICT;
+INSERT INTO bitmap_bytes(value, byte, bits)
+SELECT column1, column2, (column1 & 1) + (column1 >> 1 & 1) + (column1 >> 2 & 1) + (column1 >> 3 & 1) + (column1 >> 4 & 1) + (column1 >> 5 & 1) + (column1 >> 6 & 1) + (column1 >> 7 & 1)
+FROM (VALUES
+  (0, x'00'), (1, x'01'), (2, x'02'), (3, x'03'), (4, x'04'), (5, x'05'), (6, x'06'), (7, x'07'), (8, x'08'), (9, x'09'), (10, x'0A'), (11, x'0B'), (12, x'0C'), (13, x'0D'), (14, x'0E'), (15, x'0F'),
+  (16, x'10'), (17, x'11'), (18, x'12'), (19, x'13'), (20, x'14'), (21, x'15'), (22, x'16'), (23, x'17'), (24, x'18'), (25, x'19'), (26, x'1A'), (27, x'1B'), (28, x'1C'), (29, x'1D'), (30, x'1E'), (31, x'1F'),
+  (32, x'20'), (33, x'21'), (34, x'22'), (35, x'23'), (36, x'24'), (37, x'25'), (38, x'26'), (39, x'27'), (40, x'28'), (41, x'29'), (42, x'2A'), (43, x'2B'), (44, x'2C'), (45, x'2D'), (46, x'2E'), (47, x'2F'),
+  (48, x'30'), (49, x'31'), (50, x'32'), (51, x'33'), (52, x'34'), (53, x'35'), (54, x'36'), (55, x'37'), (56, x'38'), (57, x'39'), (58, x'3A'), (59, x'3B'), (60, x'3C'), (61, x'3D'), (62, x'3E'), (63, x'3F'),
+  (64, x'40'), (65, x'41'), (66, x'42'), (67, x'43'), (68, x'44'), (69, x'45'), (70, x'46'), (71, x'47'), (72, x'48'), (73, x'49'), (74, x'4A'), (75, x'4B'), (76, x'4C'), (77, x'4D'), (78, x'4E'), (79, x'4F'),
+  (80, x'50'), (81, x'51'), (82, x'52'), (83, x'53'), (84, x'54'), (85, x'55'), (86, x'56'), (87, x'57'), (88, x'58'), (89, x'59'), (90, x'5A'), (91, x'5B'), (92, x'5C'), (93, x'5D'), (94, x'5E'), (95, x'5F'),
+  (96, x'60'), (97, x'61'), (98, x'62'), (99, x'63'), (100, x'64'), (101, x'65'), (102, x'66'), (103, x'67'), (104, x'68'), (105, x'69'), (106, x'6A'), (107, x'6B'), (108, x'6C'), (109, x'6D'), (110, x'6E'), (111, x'6F'),
+  (112, x'70'), (113, x'71'), (114, x'72'), (115, x'73'), (116, x'74'), (117, x'75'), (118, x'76'), (119, x'77'), (120, x'78'), (121, x'79'), (122, x'7A'), (123, x'7B'), (124, x'7C'), (125, x'7D'), (126, x'7E'), (127, x'7F'),
+  (128, x'80'), (129, x'81'), (130, x'82'), (131, x'83'), (132, x'84'), (133, x'85'), (134, x'86'), (135, x'87'), (136, x'88'), (137, x'89'), (138, x'8A'), (139, x'8B'), (140, x'8C'), (141, x'8D'), (142, x'8E'), (143, x'8F'),
+  (144, x'90'), (145, x'91'), (146, x'92'), (147, x'93'), (148, x'94'), (149, x'95'), (150, x'96'), (151, x'97'), (152, x'98'), (153, x'99'), (154, x'9A'), (155, x'9B'), (156, x'9C'), (157, x'9D'), (158, x'9E'), (159, x'9F'),
+  (160, x'A0'), (161, x'A1'), (162, x'A2'), (163, x'A3'), (164, x'A4'), (165, x'A5'), (166, x'A6'), (167, x'A7'), (168, x'A8'), (169, x'A9'), (170, x'AA'), (171, x'AB'), (172, x'AC'), (173, x'AD'), (174, x'AE'), (175, x'AF'),
+  (176, x'B0'), (177, x'B1'), (178, x'B2'), (179, x'B3'), (180, x'B4'), (181, x'B5'), (182, x'B6'), (183, x'B7'), (184, x'B8'), (185, x'B9'), (186, x'BA'), (187, x'BB'), (188, x'BC'), (189, x'BD'), (190, x'BE'), (191, x'BF'),
+  (192, x'C0'), (193, x'C1'), (194, x'C2'), (195, x'C3'), (196, x'C4'), (197, x'C5'), (198, x'C6'), (199, x'C7'), (200, x'C8'), (201, x'C9'), (202, x'CA'), (203, x'CB'), (204, x'CC'), (205, x'CD'), (206, x'CE'), (207, x'CF'),
+  (208, x'D0'), (209, x'D1'), (210, x'D2'), (211, x'D3'), (212, x'D4'), (213, x'D5'), (214, x'D6'), (215, x'D7'), (216, x'D8'), (217, x'D9'), (218, x'DA'), (219, x'DB'), (220, x'DC'), (221, x'DD'), (222, x'DE'), (223, x'DF'),
+  (224, x'E0'), (225, x'E1'), (226, x'E2'), (227, x'E3'), (228, x'E4'), (229, x'E5'), (230, x'E6'), (231, x'E7'), (232, x'E8'), (233, x'E9'), (234, x'EA'), (235, x'EB'), (236, x'EC'), (237, x'ED'), (238, x'EE'), (239, x'EF'),
+  (240, x'F0'), (241, x'F1'), (242, x'F2'), (243, x'F3'), (244, x'F4'), (245, x'F5'), (246, x'F6'), (247, x'F7'), (248, x'F8'), (249, x'F9'), (250, x'FA'), (251, x'FB'), (252, x'FC'), (253, x'FD'), (254, x'FE'), (255, x'FF')
+);
+
+-- 区間の k 番目のサンプル (views ビューと同じ補間) が覆う分スロット
+-- サンプルは viewed_time までの5分を speed 倍で再生したものとみなし、丸めて [first, last) の分にする
+CREATE VIEW "view_segment_watched_slots"(segment_id, program_id, k, slot) AS
+SELECT sample.id, sample.program_id, sample.k, slot.i
+FROM (
+  SELECT
+      view_segments.id, view_segments.program_id, k.i AS k
+    , view_segments.start_time + (view_segments.end_time - view_segments.start_time) * k.i / MAX(view_segments.samples - 1, 1) - programs.start_time AS elapsed
+    , COALESCE(view_segments.speed, 1.0) AS speed
+    , (programs.duration + 59) / 60 AS slots
+  FROM view_segments
+  INNER JOIN programs ON programs.id = view_segments.program_id
+  INNER JOIN integers AS k ON k.i < view_segments.samples
+) AS sample
+INNER JOIN integers AS slot
+ON slot.i >= MAX(CAST((sample.elapsed - 300 * sample.speed + 30) / 60 AS INTEGER), 0)
+AND slot.i < MIN((sample.elapsed + 30) / 60, sample.slots)
+;
+
+-- 番組のビットマップを区間から作り直す。program_id で絞って読む
+CREATE VIEW "program_watched_bitmap"(program_id, watched_bitmap, watched_minutes) AS
+SELECT
+    programs.id
+  , COALESCE((
+      SELECT CAST(group_concat(bitmap_bytes.byte, '') AS BLOB)
+      FROM (
+        SELECT i.i, COALESCE(SUM(1 << watched.slot % 8), 0) AS value
+        FROM integers AS i
+        LEFT JOIN (SELECT DISTINCT slot FROM view_segment_watched_slots WHERE program_id = programs.id) AS watched
+        ON watched.slot / 8 = i.i
+        WHERE i.i < ((programs.duration + 59) / 60 + 7) / 8
+        GROUP BY i.i
+        ORDER BY i.i
+      ) AS byte
+      INNER JOIN bitmap_bytes USING (value)
+    ), x'')
+  , (SELECT COUNT(DISTINCT slot) FROM view_segment_watched_slots WHERE program_id = programs.id)
+FROM programs
+;
+
+-- 区間の k 番目のサンプルが覆うバイトごとに、番組のいまのビットマップに OR した値と増えたビット数
+-- 1サンプルが覆う分スロットは続いているので、書き換えるバイトも続いている
+CREATE VIEW "view_sample_watched_bytes"(segment_id, k, i, byte, minutes) AS
+SELECT watched.segment_id, watched.k, watched.i, merged.byte, merged.bits - old.bits
+FROM (
+  SELECT segment_id, program_id, k, slot / 8 AS i, SUM(1 << slot % 8) AS value
+  FROM view_segment_watched_slots
+  GROUP BY segment_id, program_id, k, slot / 8
+) AS watched
+INNER JOIN program_view_stats USING (program_id)
+INNER JOIN bitmap_bytes AS old ON old.byte = substr(program_view_stats.watched_bitmap, watched.i + 1, 1)
+INNER JOIN bitmap_bytes AS merged ON merged.value = old.value | watched.value
+;
+
+DROP TRIGGER "view_segments_insert_program_view_stats";
+DROP TRIGGER "view_segments_update_program_view_stats";
+DROP TRIGGER "view_segments_delete_program_view_stats";
+-- 視聴の取り込みで1サンプルの区間ができたときと、区間が1サンプル延びたときは、そのサンプルの分だけビットマップに足す
+-- 延びた区間の途中のサンプルは補間の位置がずれるが、5分ごとのサンプルなら足した位置と変わらない
+CREATE TRIGGER "view_segments_insert_program_view_stats"
+AFTER INSERT ON view_segments
+WHEN NEW.samples = 1
+BEGIN
+  INSERT INTO program_view_stats(program_id, view_count, first_viewed, last_viewed, watched_seconds, viewed_times_json, watched_bitmap, watched_minutes)
+  SELECT program_id, SUM(samples), MIN(start_time), MAX(end_time), SUM(samples * 5 * 60 * COALESCE(speed, 1.0)), json_group_array(json_array(start_time, end_time, samples))
+    , COALESCE((SELECT zeroblob(((duration + 59) / 60 + 7) / 8) FROM programs WHERE id = NEW.program_id), x''), 0
+  FROM (SELECT * FROM view_segments WHERE program_id = NEW.program_id ORDER BY start_time, id) GROUP BY program_id
+  ON CONFLICT(program_id) DO UPDATE SET
+      view_count = excluded.view_count, first_viewed = excluded.first_viewed, last_viewed = excluded.last_viewed
+    , watched_seconds = excluded.watched_seconds, viewed_times_json = excluded.viewed_times_json;
+  UPDATE program_view_stats SET
+      watched_bitmap = CAST(substr(watched_bitmap, 1, merged.first_byte) || merged.bytes || substr(watched_bitmap, merged.last_byte + 2) AS BLOB)
+    , watched_minutes = watched_minutes + merged.minutes
+  FROM (
+    SELECT MIN(i) AS first_byte, MAX(i) AS last_byte, group_concat(byte, '') AS bytes, SUM(minutes) AS minutes
+    FROM (SELECT * FROM view_sample_watched_bytes WHERE segment_id = NEW.id AND k = 0 ORDER BY i)
+  ) AS merged
+  WHERE program_view_stats.program_id = NEW.program_id AND merged.bytes IS NOT NULL;
+END;
+CREATE TRIGGER "view_segments_extend_program_view_stats"
+AFTER UPDATE ON view_segments
+WHEN OLD.program_id = NEW.program_id AND OLD.start_time = NEW.start_time AND OLD.speed IS NEW.speed AND NEW.samples = OLD.samples + 1
+BEGIN
+  INSERT INTO program_view_stats(program_id, view_count, first_viewed, last_viewed, watched_seconds, viewed_times_json, watched_bitmap, watched_minutes)
+  SELECT program_id, SUM(samples), MIN(start_time), MAX(end_time), SUM(samples * 5 * 60 * COALESCE(speed, 1.0)), json_group_array(json_array(start_time, end_time, samples))
+    , COALESCE((SELECT zeroblob(((duration + 59) / 60 + 7) / 8) FROM programs WHERE id = NEW.program_id), x''), 0
+  FROM (SELECT * FROM view_segments WHERE program_id = NEW.program_id ORDER BY start_time, id) GROUP BY program_id
+  ON CONFLICT(program_id) DO UPDATE SET
+      view_count = excluded.view_count, first_viewed = excluded.first_viewed, last_viewed = excluded.last_viewed
+    , watched_seconds = excluded.watched_seconds, viewed_times_json = excluded.viewed_times_json;
+  UPDATE program_view_stats SET
+      watched_bitmap = CAST(substr(watched_bitmap, 1, merged.first_byte) || merged.bytes || substr(watched_bitmap, merged.last_byte + 2) AS BLOB)
+    , watched_minutes = watched_minutes + merged.minutes
+  FROM (
+    SELECT MIN(i) AS first_byte, MAX(i) AS last_byte, group_concat(byte, '') AS bytes, SUM(minutes) AS minutes
+    FROM (SELECT * FROM view_sample_watched_bytes WHERE segment_id = NEW.id AND k = NEW.samples - 1 ORDER BY i)
+  ) AS merged
+  WHERE program_view_stats.program_id = NEW.program_id AND merged.bytes IS NOT NULL;
+END;
+-- それ以外 (手作業で入れた複数サンプルの区間、区間の書き換えや削除) は区間から作り直す
+CREATE TRIGGER "view_segments_insert_segment_program_view_stats"
+AFTER INSERT ON view_segments
+WHEN NEW.samples > 1
+BEGIN
+  DELETE FROM program_view_stats WHERE program_id = NEW.program_id;
+  INSERT INTO program_view_stats(program_id, view_count, first_viewed, last_viewed, watched_seconds, viewed_times_json, watched_bitmap, watched_minutes)
+  SELECT stats.*, COALESCE(bitmap.watched_bitmap, x''), COALESCE(bitmap.watched_minutes, 0) FROM (
+    SELECT program_id, SUM(samples), MIN(start_time), MAX(end_time), SUM(samples * 5 * 60 * COALESCE(speed, 1.0)), json_group_array(json_array(start_time, end_time, samples))
+    FROM (SELECT * FROM view_segments WHERE program_id = NEW.program_id ORDER BY program_id, start_time, id) GROUP BY program_id
+  ) AS stats
+  LEFT JOIN program_watched_bitmap AS bitmap USING (program_id);
+END;
+CREATE TRIGGER "view_segments_update_program_view_stats"
+AFTER UPDATE ON view_segments
+WHEN NOT (OLD.program_id = NEW.program_id AND OLD.start_time = NEW.start_time AND OLD.speed IS NEW.speed AND NEW.samples = OLD.samples + 1)
+BEGIN
+  DELETE FROM program_view_stats WHERE program_id IN (OLD.program_id, NEW.program_id);
+  INSERT INTO program_view_stats(program_id, view_count, first_viewed, last_viewed, watched_seconds, viewed_times_json, watched_bitmap, watched_minutes)
+  SELECT stats.*, COALESCE(bitmap.watched_bitmap, x''), COALESCE(bitmap.watched_minutes, 0) FROM (
+    SELECT program_id, SUM(samples), MIN(start_time), MAX(end_time), SUM(samples * 5 * 60 * COALESCE(speed, 1.0)), json_group_array(json_array(start_time, end_time, samples))
+    FROM (SELECT * FROM view_segments WHERE program_id IN (OLD.program_id, NEW.program_id) ORDER BY program_id, start_time, id) GROUP BY program_id
+  ) AS stats
+  LEFT JOIN program_watched_bitmap AS bitmap USING (program_id);
+END;
+CREATE TRIGGER "view_segments_delete_program_view_stats"
+AFTER DELETE ON view_segments
+BEGIN
+  DELETE FROM program_view_stats WHERE program_id = OLD.program_id;
+  INSERT INTO program_view_stats(program_id, view_count, first_viewed, last_viewed, watched_seconds, viewed_times_json, watched_bitmap, watched_minutes)
+  SELECT stats.*, COALESCE(bitmap.watched_bitmap, x''), COALESCE(bitmap.watched_minutes, 0) FROM (
+    SELECT program_id, SUM(samples), MIN(start_time), MAX(end_time), SUM(samples * 5 * 60 * COALESCE(speed, 1.0)), json_group_array(json_array(start_time, end_time, samples))
+    FROM (SELECT * FROM view_segments WHERE program_id = OLD.program_id ORDER BY program_id, start_time, id) GROUP BY program_id
+  ) AS stats
+  LEFT JOIN program_watched_bitmap AS bitmap USING (program_id);
+END;
+-- 番組の時間が変わるとスロットの位置も変わるので作り直す
+-- 区間をアーカイブに移した番組は本体の区間から作り直せないので、集計をそのまま残す
+CREATE TRIGGER "programs_update_program_view_stats"
+AFTER UPDATE OF start_time, duration ON programs
+WHEN (OLD.start_time IS NOT NEW.start_time OR OLD.duration IS NOT NEW.duration)
+AND EXISTS (SELECT 1 FROM view_segments WHERE program_id = NEW.id)
+BEGIN
+  DELETE FROM program_view_stats WHERE program_id = NEW.id;
+  INSERT INTO program_view_stats(program_id, view_count, first_viewed, last_viewed, watched_seconds, viewed_times_json, watched_bitmap, watched_minutes)
+  SELECT stats.*, COALESCE(bitmap.watched_bitmap, x''), COALESCE(bitmap.watched_minutes, 0) FROM (
+    SELECT program_id, SUM(samples), MIN(start_time), MAX(end_time), SUM(samples * 5 * 60 * COALESCE(speed, 1.0)), json_group_array(json_array(start_time, end_time, samples))
+    FROM (SELECT * FROM view_segments WHERE program_id = NEW.id ORDER BY program_id, start_time, id) GROUP BY program_id
+  ) AS stats
+  LEFT JOIN program_watched_bitmap AS bitmap USING (program_id);
+END;
+
+-- 集計を区間から作り直す
+DELETE FROM program_view_stats;
+INSERT INTO program_view_stats(program_id, view_count, first_viewed, last_viewed, watched_seconds, viewed_times_json, watched_bitmap, watched_minutes)
+SELECT stats.*, COALESCE(bitmap.watched_bitmap, x''), COALESCE(bitmap.watched_minutes, 0) FROM (
+  SELECT program_id, SUM(samples), MIN(start_time), MAX(end_time), SUM(samples * 5 * 60 * COALESCE(speed, 1.0)), json_group_array(json_array(start_time, end_time, samples))
+  FROM (SELECT * FROM view_segments ORDER BY program_id, start_time, id) GROUP BY program_id
+) AS stats
+LEFT JOIN program_watched_bitmap AS bitmap USING (program_id);
@@ -0,0 +1,125 @@
+-- 放送日 (programs.broadcast_day と同じ JST 5:00 区切りの日数) × シリーズ × ジャンル × サービスごとの視聴の日次集計
+-- 視聴の取り込みでトリガーが足し込むので、/api/stats は views を読まずにこの表だけで答えられる
+-- シリーズは集計した時点の番組のシリーズ (複数あれば id の小さいほう、なければ 0) 、ジャンルがなければ ''
+CREATE TABLE "daily_watch_stats"(
+    day INTEGER NOT NULL
+  , series_id INTEGER NOT NULL
+  , genre TEXT NOT NULL
+  , service_id INTEGER NOT NULL
+    -- 1サンプル5分を再生速度で重み付けした視聴秒数
+  , watched_seconds REAL NOT NULL DEFAULT 0
+    -- その日に初めて視聴した番組数
+  , programs_started INTEGER NOT NULL DEFAULT 0
+    -- その日に視聴済みの分が8割 (消化一覧から外れる基準) に達した番組数
+  , programs_finished INTEGER NOT NULL DEFAULT 0
+  , PRIMARY KEY (day, series_id, genre, service_id)
+) STRICT, WITHOUT ROWID
+;
+
+-- 番組ごとに、見始めた日と見終わった日。一度数えた番組は数え直さない
+CREATE TABLE "program_watch_days"(
+    program_id INTEGER PRIMARY KEY
+  , started_day INTEGER NOT NULL
+  , finished_day INTEGER
+  , FOREIGN KEY (program_id) REFERENCES programs(id)
+) STRICT
+;
+
+-- 番組の集計キー (放送日は呼び出し側で決める)
+CREATE VIEW "program_stats_keys"(program_id, series_id, genre, service_id) AS
+SELECT
+    programs.id
+  , COALESCE((SELECT MIN(series_id) FROM program_series WHERE program_series.program_id = programs.id), 0)
+  , COALESCE(programs.genre, '')
+  , programs.service_id
+FROM programs
+;
+
+-- 既存の視聴を集計する。アーカイブに移した区間も program_view_stats に残っているので、その区間の配列から作る
+-- 区間ごとの視聴秒数は、番組の視聴秒数をサンプル数で割ったものにサンプル数を掛ける
+INSERT INTO daily_watch_stats(day, series_id, genre, service_id, watched_seconds)
+SELECT
+    (json_extract(segment.value, '$[1]') + 4 * 3600) / 86400, k.series_id, k.genre, k.service_id
+  , SUM(json_extract(segment.value, '$[2]') * program_view_stats.watched_seconds / program_view_stats.view_count)
+FROM program_view_stats
+INNER JOIN json_each(program_view_stats.viewed_times_json) AS segment
+INNER JOIN program_stats_keys AS k ON k.program_id = program_view_stats.program_id
+GROUP BY 1, 2, 3, 4
+;
+INSERT INTO program_watch_days(program_id, started_day, finished_day)
+SELECT
+    program_view_stats.program_id
+  , (program_view_stats.first_viewed + 4 * 3600) / 86400
+  , CASE WHEN program_view_stats.watched_minutes >= (programs.duration + 59) / 60 * 0.8 THEN (program_view_stats.last_viewed + 4 * 3600) / 86400 END
+FROM program_view_stats
+INNER JOIN programs ON programs.id = program_view_stats.program_id
+;
+INSERT INTO daily_watch_stats(day, series_id, genre, service_id, programs_started)
+SELECT started_day, k.series_id, k.genre, k.service_id, COUNT(*)
+FROM program_watch_days INNER JOIN program_stats_keys AS k USING (program_id)
+WHERE TRUE
+GROUP BY 1, 2, 3, 4
+ON CONFLICT(day, series_id, genre, service_id) DO UPDATE SET programs_started = excluded.programs_started
+;
+INSERT INTO daily_watch_stats(day, series_id, genre, service_id, programs_finished)
+SELECT finished_day, k.series_id, k.genre, k.service_id, COUNT(*)
+FROM program_watch_days INNER JOIN program_stats_keys AS k USING (program_id)
+WHERE finished_day IS NOT NULL
+GROUP BY 1, 2, 3, 4
+ON CONFLICT(day, series_id, genre, service_id) DO UPDATE SET programs_finished = excluded.programs_finished
+;
+
+-- 区間ができたとき (取り込みでは1サンプル) と、延びたとき (増えたサンプル分) に、最後のサンプルの日に視聴秒数を足す
+CREATE TRIGGER "view_segments_insert_daily_watch_stats"
+AFTER INSERT ON view_segments
+BEGIN
+  INSERT INTO daily_watch_stats(day, series_id, genre, service_id, watched_seconds)
+  SELECT (NEW.end_time + 4 * 3600) / 86400, series_id, genre, service_id, NEW.samples * 5 * 60 * COALESCE(NEW.speed, 1.0)
+  FROM program_stats_keys WHERE program_id = NEW.program_id
+  ON CONFLICT(day, series_id, genre, service_id) DO UPDATE SET watched_seconds = watched_seconds + excluded.watched_seconds;
+END;
+CREATE TRIGGER "view_segments_update_daily_watch_stats"
+AFTER UPDATE OF samples ON view_segments
+WHEN NEW.samples > OLD.samples
+BEGIN
+  INSERT INTO daily_watch_stats(day, series_id, genre, service_id, watched_seconds)
+  SELECT (NEW.end_time + 4 * 3600) / 86400, series_id, genre, service_id, (NEW.samples - OLD.samples) * 5 * 60 * COALESCE(NEW.speed, 1.0)
+  FROM program_stats_keys WHERE program_id = NEW.program_id
+  ON CONFLICT(day, series_id, genre, service_id) DO UPDATE SET watched_seconds = watched_seconds + excluded.watched_seconds;
+END;
+
+-- program_view_stats は作り直されたり視聴済みの分が足されたりするので、見始めと8割に達したことを program_watch_days で一度だけ記録する
+CREATE TRIGGER "program_view_stats_insert_program_watch_days"
+AFTER INSERT ON program_view_stats
+BEGIN
+  INSERT INTO program_watch_days(program_id, started_day)
+  VALUES(NEW.program_id, (NEW.first_viewed + 4 * 3600) / 86400)
+  ON CONFLICT(program_id) DO NOTHING;
+  UPDATE program_watch_days SET finished_day = (NEW.last_viewed + 4 * 3600) / 86400
+  WHERE program_id = NEW.program_id AND finished_day IS NULL
+  AND NEW.watched_minutes >= (SELECT (duration + 59) / 60 * 0.8 FROM programs WHERE id = NEW.program_id);
+END;
+CREATE TRIGGER "program_view_stats_update_program_watch_days"
+AFTER UPDATE OF watched_minutes ON program_view_stats
+BEGIN
+  UPDATE program_watch_days SET finished_day = (NEW.last_viewed + 4 * 3600) / 86400
+  WHERE program_id = NEW.program_id AND finished_day IS NULL
+  AND NEW.watched_minutes >= (SELECT (duration + 59) / 60 * 0.8 FROM programs WHERE id = NEW.program_id);
+END;
+CREATE TRIGGER "program_watch_days_insert_daily_watch_stats"
+AFTER INSERT ON program_watch_days
+BEGIN
+  INSERT INTO daily_watch_stats(day, series_id, genre, service_id, programs_started)
+  SELECT NEW.started_day, series_id, genre, service_id, 1
+  FROM program_stats_keys WHERE program_id = NEW.program_id
+  ON CONFLICT(day, series_id, genre, service_id) DO UPDATE SET programs_started = programs_started + 1;
+END;
+CREATE TRIGGER "program_watch_days_update_daily_watch_stats"
+AFTER UPDATE OF finished_day ON program_watch_days
+WHEN OLD.finished_day IS NULL AND NEW.finished_day IS NOT NULL
+BEGIN
+  INSERT INTO daily_watch_stats(day, series_id, genre, service_id, programs_finished)
+  SELECT NEW.finished_day, series_id, genre, service_id, 1
+  FROM program_stats_keys WHERE program_id = NEW.program_id
+  ON CONFLICT(day, series_id, genre, service_id) DO UPDATE SET programs_finished = programs_finished + 1;
+END;
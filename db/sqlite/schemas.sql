@@ -24,15 +24,6 @@ CREATE TABLE IF NOT EXISTS "recordings"(
   , FOREIGN KEY (program_id) REFERENCES programs(id)
 ) STRICT
 ;
--- 視聴状態
-CREATE TABLE IF NOT EXISTS "views"(
-    program_id INTEGER NOT NULL
-  , viewed_time INTEGER NOT NULL
-  , speed REAL
-  , created_at INTEGER NOT NULL
-  , FOREIGN KEY (program_id) REFERENCES programs(id)
-) STRICT
-;
 -- 連続番組
 CREATE TABLE IF NOT EXISTS "series"(
     id INTEGER PRIMARY KEY
@@ -50,3 +41,16 @@ CREATE TABLE IF NOT EXISTS "program_series"(
   , FOREIGN KEY (series_id)  REFERENCES series(id)
 ) STRICT
 ;
+-- 番組ごとの視聴集計 (view_segments のトリガーで更新する)
+CREATE TABLE IF NOT EXISTS "program_view_stats"(
+    program_id INTEGER PRIMARY KEY
+  , view_count INTEGER NOT NULL
+  , first_viewed INTEGER NOT NULL
+  , last_viewed INTEGER NOT NULL
+    -- 1サンプル5分を再生速度で重み付けした視聴秒数
+  , watched_seconds REAL NOT NULL
+    -- [start_time, end_time, samples] の配列
+  , viewed_times_json TEXT NOT NULL
+  , FOREIGN KEY (program_id) REFERENCES programs(id)
+) STRICT
+;
@@ -1,9 +1,7 @@
 #!/bin/sh
 set -eux
 
-if [ "${DB:-}" = "sqlite" ]; then
-  (cat /app/db/sqlite/schemas.sql; echo ".quit") | python -m sqlite3 /app/db/tv.db
-fi
+# SQLite のスキーマ・マイグレーションはアプリ起動時 (lifespan) に適用される
 
 if [ "${1:-}" = "dev" ]; then
   uvicorn app.main:app --host 0.0.0.0 --port $PORT --reload --reload-dir app --log-level debug